@@ -0,0 +1,91 @@
+# XEP-0138 stream compression benchmarks for gxmpp.xmlstream: the cost of
+# deflating writes at each level and flush mode, one stanza per write or
+# batched as XMLStream.send() coalesces them, and of inflating and parsing
+# received data. Bytes on the wire for each setting are printed first.
+# Run with: python -m benchmarks.bench_compress -h
+import zlib
+
+from benchmarks.bench_xmlstream import CORPORA, HEADER, STANZAS
+from benchmarks.harness import Suite, run_suite
+from gxmpp.xmlstream import XMLStream
+
+LEVELS = (1, 6, 9)
+FLUSH_MODES = {"sync": zlib.Z_SYNC_FLUSH, "full": zlib.Z_FULL_FLUSH}
+BATCH = 20  # stanzas per write when batched
+
+
+def deflate(stanza, level, flush_mode, batch):
+    """
+    Return the bytes STANZAS copies of ``stanza`` take on the wire, written
+    ``batch`` stanzas at a time.
+    """
+    deflater = zlib.compressobj(level)
+    data = stanza * batch
+    size = 0
+    for _ in range(STANZAS // batch):
+        size += len(deflater.compress(data)) + len(deflater.flush(flush_mode))
+    return size
+
+
+def add_deflate(suite, corpus, stanza):
+    for level in LEVELS:
+        for mode, flush_mode in FLUSH_MODES.items():
+            for writes, batch in (("stanza", 1), ("batch", BATCH)):
+                suite.add(
+                    "deflate.{}.{}.{}.{}".format(corpus, level, mode, writes),
+                    lambda a=(stanza, level, flush_mode, batch): deflate(*a),
+                    ops=STANZAS,
+                )
+
+
+def add_inflate(suite, corpus, stanza):
+    # what XMLStream.run() does with the data it receives
+    plain = stanza * STANZAS
+    deflater = zlib.compressobj()
+    compressed = deflater.compress(plain) + deflater.flush(zlib.Z_SYNC_FLUSH)
+
+    def bench(feed, data):
+        stream = XMLStream()
+        stream._inflater = zlib.decompressobj()
+        stream._feed(HEADER)
+        getattr(stream, feed)(data)
+        assert stream._events.qsize() == STANZAS
+
+    suite.add(
+        "inflate.{}.none".format(corpus),
+        lambda: bench("_feed", plain),
+        ops=STANZAS,
+    )
+    suite.add(
+        "inflate.{}.zlib".format(corpus),
+        lambda: bench("_feed_compressed", compressed),
+        ops=STANZAS,
+    )
+
+
+def print_ratios():
+    print("{:<40} {:>12} {:>8}".format("bytes on the wire", "per stanza", "ratio"))
+    for corpus, stanza in CORPORA.items():
+        plain = len(stanza) * STANZAS
+        for level in LEVELS:
+            for mode, flush_mode in FLUSH_MODES.items():
+                for writes, batch in (("stanza", 1), ("batch", BATCH)):
+                    size = deflate(stanza, level, flush_mode, batch)
+                    print(
+                        "{:<40} {:>12.1f} {:>8.1%}".format(
+                            "{}.{}.{}.{}".format(corpus, level, mode, writes),
+                            size / STANZAS,
+                            size / plain,
+                        )
+                    )
+    print()
+
+
+suite = Suite("compress")
+for _corpus, _stanza in CORPORA.items():
+    add_deflate(suite, _corpus, _stanza)
+    add_inflate(suite, _corpus, _stanza)
+
+if __name__ == "__main__":
+    print_ratios()
+    run_suite(suite)
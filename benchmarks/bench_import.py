@@ -0,0 +1,37 @@
+# Import-time benchmarks. Every import runs in a fresh interpreter, so results
+# include interpreter startup; compare them against "python" to see the cost
+# of the import itself. Run with: python -m benchmarks.bench_import -h
+import subprocess
+import sys
+
+from benchmarks.harness import Suite, run_suite
+
+MODULES = (
+    "gxmpp.jid",
+    "gxmpp.resolver",
+    "gxmpp.routing",
+    "gxmpp.xmlstream",
+)
+
+
+def _importer(stmt):
+    argv = [sys.executable, "-c", stmt]
+
+    def bench():
+        subprocess.check_call(argv)
+
+    return bench
+
+
+suite = Suite("import")
+suite.add("python", _importer("pass"))
+for _module in MODULES:
+    suite.add("import." + _module, _importer("import " + _module))
+# first use pulls in the lazily imported dependencies
+suite.add(
+    "first_use.gxmpp.jid",
+    _importer("from gxmpp.jid import JID; JID.create('Ünïcode', 'example.org')"),
+)
+
+if __name__ == "__main__":
+    run_suite(suite)
@@ -0,0 +1,113 @@
+# Micro-benchmarks for gxmpp.jid. Run with: python -m benchmarks.bench_jid -h
+import itertools
+
+from benchmarks.harness import Suite, run_suite
+from gxmpp import jid
+
+# (local, domain, resource) as passed to JID.create; 64 distinct entries each
+CORPORA = {
+    "ascii": [
+        ("user{}".format(i), "example.org", "phone{}".format(i % 4))
+        for i in range(64)
+    ],
+    "idn": [
+        ("Ünïcode{}".format(i), "銃士{}.example".format(i % 8), "téléphone")
+        for i in range(64)
+    ],
+    "escaped": [
+        ("user{}@mail.example.com".format(i), "gateway.example.org", None)
+        for i in range(64)
+    ],
+    "ip": [
+        (
+            "user{}".format(i),
+            "[2001:db8::{:x}]".format(i) if i % 2 else "192.0.2.1",
+            "r",
+        )
+        for i in range(64)
+    ],
+    "longres": [
+        ("user{}".format(i), "example.org", "res-" + "x" * 512 + str(i))
+        for i in range(64)
+    ],
+}
+
+
+def add_corpus(suite, name, parts):
+    create = jid.JID.create
+    parse = jid.JID.parse
+    n = len(parts)
+    jids = [create(*p) for p in parts]
+    strings = [str(j) for j in jids]
+    twins = [jid.JID(j.local, j.domain, j.resource) for j in jids]
+
+    def bench_create_cold():
+        jid.create_cache.clear()
+        for p in parts:
+            create(*p)
+
+    def bench_create_warm():
+        for p in parts:
+            create(*p)
+
+    def bench_parse_cold():
+        jid.parse_cache.clear()
+        for s in strings:
+            parse(s)
+
+    def bench_parse_warm():
+        for s in strings:
+            parse(s)
+
+    def bench_str():
+        for j in jids:
+            str(j)
+
+    def bench_eq():
+        # fresh, equal objects so that identity does not short-circuit
+        for a, b in zip(jids, twins):
+            a == b  # noqa:B015
+
+    def bench_hash_fresh():
+        for j in jids:
+            hash(jid.JID(j.local, j.domain, j.resource))
+
+    def bench_dict_lookup():
+        for j in twins:
+            table[j]
+
+    def bench_bare():
+        for j in jids:
+            jid.JID(j.local, j.domain, j.resource).bare
+
+    def bench_bare_jid():
+        for j in jids:
+            jid.JID(j.local, j.domain, j.resource).bare_jid
+
+    def bench_unescaped():
+        for j in jids:
+            jid.JID(j.local, j.domain, j.resource).unescaped
+
+    table = dict(zip(jids, itertools.count()))
+    for op, fn in (
+        ("create_cold", bench_create_cold),
+        ("create_warm", bench_create_warm),
+        ("parse_cold", bench_parse_cold),
+        ("parse_warm", bench_parse_warm),
+        ("str", bench_str),
+        ("eq", bench_eq),
+        ("hash_fresh", bench_hash_fresh),
+        ("dict_lookup", bench_dict_lookup),
+        ("bare", bench_bare),
+        ("bare_jid", bench_bare_jid),
+        ("unescaped", bench_unescaped),
+    ):
+        suite.add("{}.{}".format(name, op), fn, ops=n)
+
+
+suite = Suite("jid")
+for _name, _parts in CORPORA.items():
+    add_corpus(suite, _name, _parts)
+
+if __name__ == "__main__":
+    run_suite(suite)
@@ -0,0 +1,89 @@
+# Memory benchmark for gxmpp.xmlstream: feeds a large number of stanzas through
+# each parser engine, restarting the stream now and then, and samples the RSS
+# of the process as it goes. Once warmed up, RSS should stay flat.
+# Run with: python -m benchmarks.bench_memory -h
+import argparse
+import os
+import resource
+import sys
+
+from benchmarks.bench_xmlstream import CORPORA, HEADER, CountingStream
+from gxmpp.xmlstream import PULL_ENGINE, RAW_ENGINE, TARGET_ENGINE
+
+DEFAULT_STANZAS = 10 ** 6
+DEFAULT_THRESHOLD = 0.10  # RSS growth after the first sample that fails the run
+CHUNK = 100  # stanzas per feed
+RESTART_EVERY = 10 ** 5  # stanzas between stream restarts
+SAMPLES = 10
+
+
+def rss():
+    """
+    Return the current resident set size in bytes, or the peak one where the
+    current one is not available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_engine(engine, stanza, stanzas):
+    """
+    Feed ``stanzas`` stanzas to a stream and return RSS samples taken at
+    regular intervals as a list of ``(stanzas fed, rss)`` pairs.
+    """
+    stream = CountingStream(engine)
+    stream._feed(HEADER)
+    chunk = stanza * CHUNK
+    every = max(stanzas // SAMPLES, CHUNK)
+    samples = []
+    for fed in range(CHUNK, stanzas + 1, CHUNK):
+        stream._feed(chunk)
+        if fed % RESTART_EVERY == 0:
+            stream._reset_parser()
+            stream._feed(HEADER)
+        if fed % every == 0:
+            samples.append((fed, rss()))
+    assert stream.count == stanzas - stanzas % CHUNK
+    return samples
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="xmlstream memory benchmark")
+    parser.add_argument("-n", "--stanzas", type=int, default=DEFAULT_STANZAS)
+    parser.add_argument("-c", "--corpus", choices=CORPORA, default="message")
+    parser.add_argument(
+        "-e",
+        "--engine",
+        action="append",
+        choices=(TARGET_ENGINE, PULL_ENGINE, RAW_ENGINE),
+        help="engines to run, all by default",
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="relative RSS growth reported as a leak",
+    )
+    args = parser.parse_args(argv)
+
+    leaks = []
+    for engine in args.engine or (TARGET_ENGINE, PULL_ENGINE, RAW_ENGINE):
+        samples = run_engine(engine, CORPORA[args.corpus], args.stanzas)
+        for fed, size in samples:
+            print("{:<8} {:>10} {:>10.1f}MiB".format(engine, fed, size / 2 ** 20))
+        growth = samples[-1][1] / samples[0][1] - 1
+        mark = ""
+        if growth > args.threshold:
+            leaks.append(engine)
+            mark = " LEAK"
+        print("{:<8} {:>+21.1%}{}".format(engine, growth, mark))
+    return 1 if leaks else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+# Compares gxmpp.util.xep0106 against the character-by-character codec it
+# replaced. Run with: python -m benchmarks.bench_xep0106
+import timeit
+
+from gxmpp.util import xep0106
+
+
+def legacy_escape(local):
+    es = ""
+    i = 0
+    m = len(local)
+    while i < m:
+        c = local[i]
+        es += xep0106.ESCAPE.get(c, c)
+        i += 1
+    return es
+
+
+def legacy_unescape(local):
+    un = ""
+    i = 0
+    m = len(local)
+    seq = ""
+    while i < m:
+        c = local[i]
+        ls = len(seq)
+        if ls:
+            seq += c
+            if ls == 2:
+                un += xep0106.UNESCAPE.get(seq, seq)
+                seq = ""
+            i += 1
+            continue
+        if c == "\\":
+            seq = "\\"
+        else:
+            un += c
+        i += 1
+    return un
+
+
+CORPORA = {
+    "short": "d'artagnan",
+    "email": "athos.de.la.fere@musketeers.example.com",
+    "irc": "#musketeers:irc.example.net/" * 8,
+    "long": "c'est l'homme@\\ & <la> \"plume\" " * 32,
+}
+
+
+def bench(fn, arg, number):
+    return min(timeit.repeat(lambda: fn(arg), number=number, repeat=5)) / number
+
+
+def main():
+    print(
+        "{:<8} {:<9} {:>12} {:>12} {:>8}".format("corpus", "op", "legacy", "new", "x")
+    )
+    for name, raw in CORPORA.items():
+        escaped = xep0106.escape(raw)
+        number = max(100, 100000 // len(raw))
+        for op, old, new, arg in (
+            ("escape", legacy_escape, xep0106.escape, raw),
+            ("unescape", legacy_unescape, xep0106.unescape, escaped),
+        ):
+            assert old(arg) == new(arg)
+            t_old = bench(old, arg, number)
+            t_new = bench(new, arg, number)
+            print(
+                "{:<8} {:<9} {:>10.2f}us {:>10.2f}us {:>7.1f}x".format(
+                    name, op, t_old * 1e6, t_new * 1e6, t_old / t_new
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+# Parser engine benchmarks for gxmpp.xmlstream.
+# Run with: python -m benchmarks.bench_xmlstream -h
+from gevent import socket
+from lxml import etree
+
+from benchmarks.harness import Suite, run_suite
+from gxmpp.xmlstream import (
+    PULL_ENGINE,
+    RAW_ENGINE,
+    TARGET_ENGINE,
+    BaseXMLStream,
+    RawStanza,
+    XMLStream,
+    template,
+)
+
+STANZAS = 200
+HEADER = (
+    b"<stream:stream xmlns='jabber:client' "
+    b"xmlns:stream='http://etherx.jabber.org/streams' "
+    b"from='musketeers.lit' id='s1' version='1.0'>"
+)
+
+CORPORA = {
+    "message": (
+        b"<message from='athos@musketeers.lit/horse' to='porthos@musketeers.lit' "
+        b"type='chat' id='m1'><body>All for one, one for all!</body></message>"
+    ),
+    "presence": b"<presence from='athos@musketeers.lit/horse'/>",
+    "pubsub": (
+        b"<message from='pubsub.musketeers.lit' to='athos@musketeers.lit'>"
+        b"<event xmlns='http://jabber.org/protocol/pubsub#event'>"
+        b"<items node='urn:xmpp:microblog:0'><item id='i1'>"
+        b"<entry xmlns='http://www.w3.org/2005/Atom'>"
+        + b"<title type='text'>swords</title><link rel='alternate' href='x'/>" * 20
+        + b"</entry></item></items></event></message>"
+    ),
+    "mam": (
+        b"<message to='athos@musketeers.lit/horse'>"
+        b"<result xmlns='urn:xmpp:mam:2' queryid='q1' id='r1'>"
+        b"<forwarded xmlns='urn:xmpp:forward:0'>"
+        b"<delay xmlns='urn:xmpp:delay' stamp='2010-07-10T23:08:25Z'/>"
+        b"<message xmlns='jabber:client' from='porthos@musketeers.lit/sword' "
+        b"to='athos@musketeers.lit' type='chat'><body>"
+        + b"En garde! " * 40
+        + b"</body><active xmlns='http://jabber.org/protocol/chatstates'/>"
+        b"</message></forwarded></result></message>"
+    ),
+}
+
+
+def _serialize(elem):
+    return elem.raw if isinstance(elem, RawStanza) else etree.tostring(elem)
+
+
+class CountingStream(BaseXMLStream):
+    __slots__ = ("count", "forward")
+
+    def __init__(self, engine, forward=False):
+        super().__init__(engine=engine)
+        self.count = 0
+        self.forward = forward
+
+    def handle_stream_start(self, elem):
+        pass
+
+    def handle_element(self, elem):
+        self.count += 1
+        if self.forward:  # what a router would send on
+            _serialize(elem)
+
+    def handle_parse_error(self, exc_type, exc_value, exc_traceback):
+        raise exc_value.with_traceback(exc_traceback)
+
+    def handle_stream_end(self):
+        pass
+
+    def handle_close(self):
+        pass
+
+
+def add_engine(suite, engine, corpus, stanza, forward=False):
+    data = HEADER + stanza * STANZAS
+
+    def bench():
+        stream = CountingStream(engine, forward)
+        stream._feed(data)
+        assert stream.count == STANZAS
+
+    name = "{}.{}{}".format(corpus, "forward." if forward else "", engine)
+    suite.add(name, bench, ops=STANZAS)
+
+
+def add_send(suite):
+    # a presence storm: every stanza written separately, as applications had
+    # to, against XMLStream.send() coalescing them
+    a, b = socket.socketpair()
+    stream = XMLStream()
+    stream.sock = a
+    presence = etree.fromstring(CORPORA["presence"])
+    size = len(etree.tostring(presence)) * STANZAS
+
+    def drain():
+        n = 0
+        while n < size:
+            n += len(b.recv(size - n))
+
+    def bench_sendall():
+        for _ in range(STANZAS):
+            a.sendall(etree.tostring(presence))
+        drain()
+
+    def bench_send():
+        for _ in range(STANZAS):
+            stream.send(presence)
+        stream.flush()
+        drain()
+
+    suite.add("presence.send.sendall", bench_sendall, ops=STANZAS)
+    suite.add("presence.send.coalesced", bench_send, ops=STANZAS)
+
+
+def add_templates(suite):
+    # building and serializing a tree per stanza, against rendering templates
+    to, from_ = "athos@musketeers.lit/horse", "porthos@musketeers.lit/sword"
+
+    def build_chat():
+        elem = etree.Element("message", {"type": "chat"})
+        elem.set("to", to)
+        elem.set("from", from_)
+        elem.set("id", "m1")
+        etree.SubElement(elem, "body").text = "All for one, one for all!"
+        return etree.tostring(elem)
+
+    def build_presence():
+        elem = etree.Element("presence")
+        elem.set("to", to)
+        elem.set("from", from_)
+        return etree.tostring(elem)
+
+    def build_ping():
+        elem = etree.Element("iq", {"type": "get"})
+        elem.set("to", to)
+        elem.set("id", "p1")
+        etree.SubElement(elem, "{urn:xmpp:ping}ping", nsmap={None: "urn:xmpp:ping"})
+        return etree.tostring(elem)
+
+    for name, build, tmpl, values in (
+        (
+            "chat",
+            build_chat,
+            template.CHAT,
+            {
+                "to": to,
+                "from_": from_,
+                "id": "m1",
+                "body": "All for one, one for all!",
+            },
+        ),
+        ("presence", build_presence, template.PRESENCE, {"to": to, "from_": from_}),
+        ("ping", build_ping, template.PING, {"to": to, "id": "p1"}),
+    ):
+        assert build() == tmpl.render(**values)
+        suite.add("template.{}.tostring".format(name), build)
+        suite.add(
+            "template.{}.render".format(name),
+            lambda tmpl=tmpl, values=values: tmpl.render(**values),
+        )
+
+
+suite = Suite("xmlstream")
+for _corpus, _stanza in CORPORA.items():
+    for _engine in (TARGET_ENGINE, PULL_ENGINE, RAW_ENGINE):
+        add_engine(suite, _engine, _corpus, _stanza)
+    for _engine in (TARGET_ENGINE, RAW_ENGINE):
+        add_engine(suite, _engine, _corpus, _stanza, forward=True)
+add_send(suite)
+add_templates(suite)
+
+if __name__ == "__main__":
+    run_suite(suite)
@@ -0,0 +1,132 @@
+# A tiny benchmark harness. Results are written as JSON so that a later run
+# can be compared against a stored baseline:
+#
+#   python -m benchmarks.bench_jid -o baseline.json
+#   ... change things ...
+#   python -m benchmarks.bench_jid -b baseline.json
+import argparse
+import json
+import platform
+import re
+import sys
+import timeit
+from collections import OrderedDict
+
+DEFAULT_THRESHOLD = 0.10  # 10% slower than the baseline is a regression
+
+
+class Suite:
+    def __init__(self, name):
+        self.name = name
+        self._benchmarks = OrderedDict()
+
+    def add(self, name, fn, ops=1, setup=None):
+        """
+        Register ``fn`` under ``name``. ``ops`` is the number of operations a
+        single call to ``fn`` performs, so that results are reported per
+        operation. ``setup`` is called before every timing round.
+        """
+        if name in self._benchmarks:
+            raise ValueError("duplicate benchmark {!r}".format(name))
+        self._benchmarks[name] = (fn, ops, setup)
+
+    @staticmethod
+    def measure(fn, ops=1, setup=None, repeat=5, min_time=0.05):
+        """
+        Return the best time per operation of ``fn`` over ``repeat`` rounds.
+        """
+        number = 1
+        while True:  # calibrate so that one round takes at least min_time
+            if setup:
+                setup()
+            t = timeit.timeit(fn, number=number)
+            if t >= min_time:
+                break
+            number *= 2
+        best = t
+        for _ in range(repeat - 1):
+            if setup:
+                setup()
+            best = min(best, timeit.timeit(fn, number=number))
+        return best / (number * ops)
+
+    def run(self, pattern=None, repeat=5, min_time=0.05):
+        results = OrderedDict()
+        for name, (fn, ops, setup) in self._benchmarks.items():
+            if pattern and not re.search(pattern, name):
+                continue
+            results[name] = self.measure(fn, ops, setup, repeat, min_time)
+            print("{:<40} {:>12.3f}us".format(name, results[name] * 1e6))
+        return results
+
+    def main(self, argv=None):
+        parser = argparse.ArgumentParser(
+            description="{} benchmarks".format(self.name)
+        )
+        parser.add_argument("-k", dest="pattern", help="only run matching benchmarks")
+        parser.add_argument("-o", "--output", help="write results to a JSON file")
+        parser.add_argument("-b", "--baseline", help="compare to a JSON results file")
+        parser.add_argument(
+            "-t",
+            "--threshold",
+            type=float,
+            default=DEFAULT_THRESHOLD,
+            help="relative slowdown reported as a regression",
+        )
+        parser.add_argument("-r", "--repeat", type=int, default=5)
+        args = parser.parse_args(argv)
+
+        results = self.run(pattern=args.pattern, repeat=args.repeat)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(
+                    {
+                        "suite": self.name,
+                        "python": platform.python_version(),
+                        "implementation": platform.python_implementation(),
+                        "results": results,
+                    },
+                    f,
+                    indent=2,
+                )
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)["results"]
+            regressions = compare(baseline, results, args.threshold)
+            if regressions:
+                return 1
+        return 0
+
+
+def compare(baseline, results, threshold=DEFAULT_THRESHOLD):
+    """
+    Print a comparison of ``results`` against ``baseline`` and return the
+    names of benchmarks that got slower by more than ``threshold``.
+    """
+    regressions = []
+    print()
+    print(
+        "{:<40} {:>12} {:>12} {:>8}".format(
+            "benchmark", "baseline", "current", "delta"
+        )
+    )
+    for name, t in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print("{:<40} {:>12} {:>10.3f}us".format(name, "-", t * 1e6))
+            continue
+        delta = t / base - 1
+        mark = ""
+        if delta > threshold:
+            regressions.append(name)
+            mark = " REGRESSION"
+        print(
+            "{:<40} {:>10.3f}us {:>10.3f}us {:>+7.1%}{}".format(
+                name, base * 1e6, t * 1e6, delta, mark
+            )
+        )
+    return regressions
+
+
+def run_suite(suite):
+    sys.exit(suite.main())
@@ -1,23 +1,40 @@
 # jid.py implements RFC 7622 and XEP-0106
-import socket
+import itertools
+import re
 from collections import namedtuple
 from functools import lru_cache
 
-import idna
-import precis_i18n
-
+from gxmpp.util import xep0106
 from gxmpp.util.decos import slot_reify
+from gxmpp.util.intern import InternTable
 
-_UsernameCaseMapped = precis_i18n.get_profile("UsernameCaseMapped")
-_OpaqueString = precis_i18n.get_profile("OpaqueString")
 UnescapedJID = namedtuple("UnescapedJID", "local domain resource")
 
+# interning tables backing JID.parse and JID.create; use resize() to fit
+# them to the expected number of live JIDs and info() to check hit rates
+parse_cache = InternTable(maxsize=4096)
+create_cache = InternTable(maxsize=1024)
 
-def _normalize_localpart(local):
-    if local is None:
-        return None
+BULK_CHUNK_SIZE = 256
+BULK_WINDOW = 4
+BULK_WORKERS = 2
+_bulk_executor = None
+
+
+# precis_i18n, idna and socket are slow to import and only needed for input
+# that misses the ASCII fast path, so they are imported on first use
+
+
+@lru_cache(maxsize=None)
+def _precis_profile(name):
+    import precis_i18n
+
+    return precis_i18n.get_profile(name)
+
+
+def _normalize_localpart_full(local):
     try:
-        local = _UsernameCaseMapped.enforce(local)
+        local = _precis_profile("UsernameCaseMapped").enforce(local)
     except UnicodeDecodeError as e:
         raise ValueError(
             "localpart failed to validate against UsernameCaseMapped PRECIS class"
@@ -28,11 +45,9 @@ def _normalize_localpart(local):
     return local
 
 
-def _normalize_resourcepart(resource):
-    if resource is None:
-        return None
+def _normalize_resourcepart_full(resource):
     try:
-        resource = _OpaqueString.enforce(resource)
+        resource = _precis_profile("OpaqueString").enforce(resource)
     except UnicodeDecodeError as e:
         raise ValueError(
             "resourcepart failed to validate against OpaqueString PRECIS class"
@@ -43,9 +58,11 @@ def _normalize_resourcepart(resource):
     return resource
 
 
-def _normalize_domainpart(domain):
-    if domain is None:
-        return None
+def _normalize_domainpart_full(domain):
+    import socket
+
+    import idna
+
     try:
         socket.inet_pton(socket.AF_INET, domain)
         return domain
@@ -69,68 +86,128 @@ def _normalize_domainpart(domain):
     return domain.decode("utf-8")
 
 
-_XEP_0106_ESCAPE = {
-    " ": r"\20",
-    '"': r"\22",
-    "&": r"\26",
-    "'": r"\27",
-    "/": r"\2f",
-    ":": r"\3a",
-    "<": r"\3c",
-    ">": r"\3e",
-    "@": r"\40",
-    "\\": r"\5c",
-}
-_XEP_0106_ESCAPE_SEQ = set(_XEP_0106_ESCAPE.keys())
-_XEP_0106_UNESCAPE = dict(((v, k) for k, v in _XEP_0106_ESCAPE.items()))
+# Already canonical ASCII input is returned as-is by the full PRECIS and IDNA
+# paths, so it can skip them. Localparts: printable ASCII except SPACE and
+# uppercase letters (UsernameCaseMapped maps those). Resourceparts: all
+# printable ASCII (OpaqueString). Domainparts: LDH labels without leading or
+# trailing hyphens or "--" at positions 3-4 (which includes A-labels).
+_ASCII_LOCALPART = re.compile(r"[!-@\[-~]{1,1023}\Z")
+_ASCII_RESOURCEPART = re.compile(r"[ -~]{1,1023}\Z")
+_ASCII_LABEL = r"(?![a-z0-9-]{2}--)[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?"
+_ASCII_DOMAINPART = re.compile(r"{0}(?:\.{0})*\Z".format(_ASCII_LABEL))
+
+
+def _normalize_localpart(local):
+    if local is None:
+        return None
+    if _ASCII_LOCALPART.match(local):
+        return local
+    return _normalize_localpart_full(local)
+
+
+def _normalize_resourcepart(resource):
+    if resource is None:
+        return None
+    if _ASCII_RESOURCEPART.match(resource):
+        return resource
+    return _normalize_resourcepart_full(resource)
+
+
+def _normalize_domainpart(domain):
+    if domain is None:
+        return None
+    if len(domain) <= 253 and _ASCII_DOMAINPART.match(domain):
+        return domain
+    return _normalize_domainpart_full(domain)
+
+
+@lru_cache(maxsize=1024)
+def _domain_key(domain):
+    import idna
+
+    # IP literals and other non-IDN domains of unvalidated JIDs compare as-is
+    try:
+        return idna.encode(domain).decode("ascii")
+    except idna.IDNAError:
+        return domain
+
+
+_XEP_0106_ESCAPE_SEQ = set(xep0106.ESCAPE.keys())
 
 
 def _escape_localpart(local):
     if local is None:
         return None
-    if local[0] == " " or local[-1] == " ":
+    if local[:1] == " " or local[-1:] == " ":
         raise ValueError(
             "localpart must not start or end with the SPACE character (0x20)"
         )
-    es = ""
-    i = 0
-    m = len(local)
-    while i < m:
-        c = local[i]
-        es += _XEP_0106_ESCAPE.get(c, c)
-        i += 1
-    return es
+    return xep0106.escape(local)
 
 
 def _unescape_localpart(local):
-    un = ""
-    i = 0
-    m = len(local)
-    seq = ""
-    while i < m:
-        c = local[i]
-        ls = len(seq)
-        if ls:
-            seq += c
-            if ls == 2:
-                un += _XEP_0106_UNESCAPE.get(seq, seq)
-                seq = ""
-            i += 1
-            continue
-        if c == "\\":
-            seq = "\\"
-        else:
-            un += c
-        i += 1
-    return un
+    if local is None:
+        return None
+    return xep0106.unescape(local)
+
+
+def _validate_parts(local, domain, resource):
+    return (
+        _normalize_localpart(_escape_localpart(local)),
+        _normalize_domainpart(domain),
+        _normalize_resourcepart(resource),
+    )
+
+
+def _validate_chunk(chunk):
+    # runs on a worker; results must be picklable for process pools. An
+    # entry of the wrong type fails on its own instead of the whole chunk
+    results = []
+    for parts in chunk:
+        try:
+            results.append((True, _validate_parts(*parts)))
+        except Exception as e:
+            results.append((False, e))
+    return results
+
+
+def _get_bulk_executor():
+    global _bulk_executor
+    if _bulk_executor is None:
+        from gevent.threadpool import ThreadPoolExecutor
+
+        _bulk_executor = ThreadPoolExecutor(max_workers=BULK_WORKERS)
+    return _bulk_executor
+
+
+def _wait_bulk_result(executor, future):
+    import gevent
+    from gevent.monkey import is_module_patched
+    from gevent.threadpool import ThreadPoolExecutor
+
+    if isinstance(executor, ThreadPoolExecutor) or is_module_patched("threading"):
+        return future.result()
+    # futures of foreign executors (e.g. process pools) are completed from
+    # native threads, so wait for them on one instead of blocking the hub
+    return gevent.get_hub().threadpool.apply(future.result)
 
 
 class JID:
     """
-    A JID. JID objects are immutable and their creation is cached.
+    A JID. JID objects are immutable and their creation is interned.
     """
 
-    __slots__ = ("local", "domain", "resource", "_bare", "_unescaped")
+    __slots__ = (
+        "local",
+        "domain",
+        "resource",
+        "_bare",
+        "_bare_jid",
+        "_unescaped",
+        "_key",
+        "_hash",
+        "__weakref__",
+    )
 
     def __init__(self, local, domain, resource=None):
         """
@@ -143,11 +220,14 @@ class JID:
         super().__setattr__("resource", resource)
 
     @classmethod
-    @lru_cache(maxsize=1024)
     def parse(cls, escaped):
         """
         Parse a JID from an escaped string. This method does NOT validate the JID
         """
+        return parse_cache.lookup((cls, escaped), cls._parse, escaped)
+
+    @classmethod
+    def _parse(cls, escaped):
         try:
             rest, resource = escaped.split("/", 1)
         except ValueError:
@@ -161,17 +241,84 @@ class JID:
         return cls(local, domain, resource)
 
     @classmethod
-    @lru_cache(maxsize=128)
     def create(cls, local, domain, resource=None):
         """
         Create a JID from unescaped parts. This method validates the JID.
         """
-        return cls(
-            local=_normalize_localpart(_escape_localpart(local)),
-            domain=_normalize_domainpart(domain),
-            resource=_normalize_resourcepart(resource),
+        return create_cache.lookup(
+            (cls, local, domain, resource), cls._create, local, domain, resource
         )
 
+    @classmethod
+    def create_many(cls, parts, executor=None, chunksize=BULK_CHUNK_SIZE):
+        """
+        Create JIDs in bulk. Returns a list as produced by validate_iter().
+        """
+        return list(cls.validate_iter(parts, executor=executor, chunksize=chunksize))
+
+    @classmethod
+    def validate_iter(cls, parts, executor=None, chunksize=BULK_CHUNK_SIZE):
+        """
+        Create JIDs in bulk from an iterable of ``(local, domain[, resource])``
+        tuples of unescaped parts, as accepted by create(). Yields, in input
+        order, a JID for every valid entry or the exception it failed with,
+        a ValueError for invalid parts and e.g. a TypeError for non-strings.
+
+        Duplicate and already interned entries are validated only once. The
+        rest is validated in chunks of ``chunksize`` on ``executor``, a
+        concurrent.futures executor defaulting to a small gevent thread pool,
+        so that the hub stays responsive during large imports. Pass a
+        ProcessPoolExecutor to validate on several cores. Note that once
+        threading is monkey-patched, the workers of the standard library
+        ThreadPoolExecutor are greenlets that block the hub while they
+        validate; the default pool runs on native threads either way.
+        """
+        if executor is None:
+            executor = _get_bulk_executor()
+        it = iter(parts)
+        while True:
+            batch = list(itertools.islice(it, chunksize * BULK_WINDOW))
+            if not batch:
+                return
+            yield from cls._validate_batch(batch, executor, chunksize)
+
+    @classmethod
+    def _validate_batch(cls, batch, executor, chunksize):
+        keys = []
+        results = {}
+        pending = []
+        for parts in batch:
+            try:
+                key = (cls,) + tuple(parts) + (None,) * (3 - len(parts))
+                known = key in results
+            except Exception as e:
+                keys.append(e)  # not a tuple of hashable parts
+                continue
+            keys.append(key)
+            if known:
+                continue
+            results[key] = create_cache.get(key)
+            if results[key] is None:
+                pending.append(key)
+        futures = [
+            executor.submit(
+                _validate_chunk, [key[1:] for key in pending[i : i + chunksize]]
+            )
+            for i in range(0, len(pending), chunksize)
+        ]
+        for i, future in enumerate(futures):
+            chunk = pending[i * chunksize : (i + 1) * chunksize]
+            for key, (ok, value) in zip(chunk, _wait_bulk_result(executor, future)):
+                if ok:
+                    value = create_cache.lookup(key, cls, *value)
+                results[key] = value
+        for key in keys:
+            yield key if isinstance(key, Exception) else results[key]
+
+    @classmethod
+    def _create(cls, local, domain, resource=None):
+        return cls(*_validate_parts(local, domain, resource))
+
     @slot_reify  # associated with __bare slot
     def bare(self):
         """
@@ -181,6 +328,38 @@ class JID:
             return self.local + "@" + self.domain
         return self.domain
 
+    @property
+    def bare_jid(self):
+        """
+        Form a bare JID as a JID object. The result is interned along with
+        parsed JIDs and shares this JID's comparison key.
+        """
+        if self.resource is None:
+            # not kept in the _bare_jid slot: a reference to itself would
+            # keep an interned JID alive until the cyclic GC runs
+            return self
+        try:
+            return self._bare_jid
+        except AttributeError:
+            pass
+        cls = self.__class__
+        bare = parse_cache.lookup((cls, self.bare), cls, self.local, self.domain)
+        try:
+            bare._key
+        except AttributeError:
+            local, domain, _ = self.key
+            object.__setattr__(bare, "_key", (local, domain, None))
+        object.__setattr__(self, "_bare_jid", bare)
+        return bare
+
+    @slot_reify  # associated with __key slot
+    def key(self):
+        """
+        The canonical comparison key of this JID, computed once. Two JIDs are
+        equal if and only if their keys are equal.
+        """
+        return (self.local, _domain_key(self.domain), self.resource)
+
     @slot_reify  # associated with __unescaped slot
     def unescaped(self):
         """
@@ -211,14 +390,15 @@ class JID:
             return True
         elif not isinstance(other, JID):
             return False
-        return (
-            self.local == other.local
-            and idna.encode(self.domain) == idna.encode(other.domain)
-            and self.resource == other.resource
-        )
+        return self.key == other.key
 
     def __hash__(self):
-        return hash((self.local, idna.encode(self.domain), self.resource))
+        try:
+            return self._hash
+        except AttributeError:
+            h = hash(self.key)
+            object.__setattr__(self, "_hash", h)
+            return h
 
     def __setattr__(self, name, value):
         if name not in self.__slots__:
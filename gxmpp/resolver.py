@@ -1,92 +1,516 @@
 import itertools
 import random
 import warnings
+from collections import OrderedDict, deque
 
-import dns.rdatatype
-import dns.resolver
-from gevent import socket
+import gevent
+from gevent import event, socket, time
 
 from gxmpp.util.log import Log
 
+DNS_CACHE_SIZE = 4096  # default number of (qname, rdtype) entries cached
+STALE_TTL = 300  # default seconds an expired entry is served while refreshed
+MAX_TTL = 86400  # TTLs are capped at a day
+SCOREBOARD_SIZE = 4096  # default number of SRV targets a scoreboard remembers
+LATENCY_REF = 0.1  # seconds of latency above which a target scores lower
+LATENCY_ALPHA = 0.3  # weight of a new sample in the latency averages
+FAILURE_HALF_LIFE = 300  # seconds after which a failure counts half
+PENALTY_TIME = 5  # seconds in the penalty box after a failure
+MAX_PENALTY_TIME = 300
+PENALTY_FACTOR = 0.001  # how much less likely penalized targets are picked
+ZERO_WEIGHT = 0.01  # the weight zero-weight targets are picked with
+
+
+class TargetHealth:
+    """
+    What a TargetScoreboard remembers about a target: moving averages of the
+    seconds connecting and the TLS handshake took, or None if unknown, the
+    number of recent failures, which halves every FAILURE_HALF_LIFE seconds,
+    and until when the target is in the penalty box.
+    """
+
+    __slots__ = (
+        "connect_time",
+        "tls_time",
+        "consecutive_failures",
+        "penalty_until",
+        "_failures",
+        "_failed_at",
+    )
+
+    def __init__(self):
+        self.connect_time = None
+        self.tls_time = None
+        self.consecutive_failures = 0
+        self.penalty_until = 0.0
+        self._failures = 0.0
+        self._failed_at = 0.0
+
+    def failures(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        return self._failures * 0.5 ** ((now - self._failed_at) / FAILURE_HALF_LIFE)
+
+    def __repr__(self):
+        return (
+            "TargetHealth(connect_time={}, tls_time={}, failures={:.2f}, "
+            "penalty={:.1f}s)".format(
+                self.connect_time,
+                self.tls_time,
+                self.failures(),
+                max(0.0, self.penalty_until - time.monotonic()),
+            )
+        )
+
+
+def _average(average, sample):
+    return sample if average is None else average + LATENCY_ALPHA * (sample - average)
+
+
+class TargetScoreboard:
+    """
+    A bounded record of the health of SRV targets, keyed by ``(target,
+    port)``, which ServerPicker uses to bias its choice within a priority
+    group toward targets that were fast and did not fail recently. Once
+    ``maxsize`` targets are recorded, the least recently updated one is
+    dropped.
+
+    Every failure puts a target in the penalty box for PENALTY_TIME seconds,
+    doubling with every consecutive failure up to MAX_PENALTY_TIME, during
+    which its score is scaled down by PENALTY_FACTOR. A successful connection
+    lets it out early.
+    """
+
+    __slots__ = ("maxsize", "_targets")
+
+    def __init__(self, maxsize=SCOREBOARD_SIZE):
+        self.maxsize = maxsize
+        self._targets = OrderedDict()
+
+    def __len__(self):
+        return len(self._targets)
+
+    def __iter__(self):
+        return iter(self._targets.items())
+
+    def get(self, target, port):
+        """
+        Return the TargetHealth of ``target`` and ``port``, or None.
+        """
+        return self._targets.get((str(target).lower(), port))
+
+    def _update(self, target, port):
+        key = (str(target).lower(), port)
+        health = self._targets.get(key)
+        if health is None:
+            health = self._targets[key] = TargetHealth()
+            while len(self._targets) > self.maxsize:
+                self._targets.popitem(last=False)
+        else:
+            self._targets.move_to_end(key)
+        return health
+
+    def record_connect(self, target, port, seconds):
+        health = self._update(target, port)
+        health.connect_time = _average(health.connect_time, seconds)
+        health.consecutive_failures = 0
+        health.penalty_until = 0.0
+
+    def record_tls(self, target, port, seconds):
+        health = self._update(target, port)
+        health.tls_time = _average(health.tls_time, seconds)
+
+    def record_failure(self, target, port):
+        health = self._update(target, port)
+        now = time.monotonic()
+        health._failures = health.failures(now) + 1
+        health._failed_at = now
+        health.consecutive_failures += 1
+        penalty = PENALTY_TIME * 2 ** (health.consecutive_failures - 1)
+        health.penalty_until = now + min(penalty, MAX_PENALTY_TIME)
+
+    def score(self, target, port, now=None):
+        """
+        Return how healthy ``target`` and ``port`` is, from 1 for a target
+        that is fast or unknown down to PENALTY_FACTOR or less for one in
+        the penalty box.
+        """
+        health = self.get(target, port)
+        if health is None:
+            return 1.0
+        if now is None:
+            now = time.monotonic()
+        score = 1.0 / (1.0 + health.failures(now))
+        latency = (health.connect_time or 0.0) + (health.tls_time or 0.0)
+        if latency > LATENCY_REF:
+            score *= LATENCY_REF / latency
+        if now < health.penalty_until:
+            score *= PENALTY_FACTOR
+        return score
+
+    def clear(self):
+        self._targets.clear()
+
+
+class _WeightTree:
+    # a Fenwick tree of weights, for weighted random sampling without
+    # replacement in O(log n)
+
+    __slots__ = ("_weights", "_tree", "_top")
+
+    def __init__(self, weights):
+        n = len(weights)
+        self._weights = list(weights)
+        tree = [0.0] + self._weights
+        for i in range(1, n + 1):
+            parent = i + (i & -i)
+            if parent <= n:
+                tree[parent] += tree[i]
+        self._tree = tree
+        self._top = 1 << n.bit_length() if n else 0
+
+    def total(self):
+        total = 0.0
+        i = len(self._weights)
+        while i:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def remove(self, index):
+        weight = self._weights[index]
+        self._weights[index] = 0.0
+        tree = self._tree
+        i = index + 1
+        while i < len(tree):
+            tree[i] -= weight
+            i += i & -i
+
+    def sample(self, x):
+        # the index at which the running sum of weights exceeds x
+        tree = self._tree
+        n = len(tree) - 1
+        pos = 0
+        step = self._top
+        while step:
+            if pos + step <= n and tree[pos + step] <= x:
+                pos += step
+                x -= tree[pos]
+            step >>= 1
+        if pos < n and self._weights[pos] > 0:
+            return pos
+        # rounding ran past the end: the last index with any weight left
+        for i in range(n - 1, -1, -1):
+            if self._weights[i] > 0:
+                return i
+        return -1
+
+
+class Candidate(tuple):
+    """
+    A candidate tuple as yielded by ServerPicker, which also carries
+    ``target``, the ``(target, port)`` of the SRV record it was resolved
+    from, so that the health of the target can be recorded once connecting
+    to it succeeded or failed.
+    """
+
+    def __new__(cls, items, target):
+        self = super().__new__(cls, items)
+        self.target = target
+        return self
+
 
 class ServerPicker:
-    def __init__(self, resolver, priority_groups):
+    """
+    Picks the targets of an SRV answer in the order RFC 2782 describes:
+    priority groups from the lowest priority up, and within a group at
+    random, in proportion to their weight. With a ``scoreboard``, the weight
+    of a target is scaled by its TargetScoreboard.score(), so that slow or
+    failing targets are tried later. Zero-weight targets are picked with
+    ZERO_WEIGHT instead.
+
+    Yields ``(ipv4, ipv6, port)`` tuples, or with ``with_tls``,
+    ``(ipv4, ipv6, port, direct_tls)`` tuples, ``direct_tls`` telling
+    whether the target is one for XEP-0368 direct TLS.
+
+    The tuples are Candidate objects, whose ``target`` is the ``(target,
+    port)`` they were resolved from. ``current`` is that of the last target
+    picked, which record_connect(), record_tls() and record_failure() report
+    on; when several candidates are tried at once, as by race_connect(), use
+    the scoreboard with their ``target`` instead.
+    """
+
+    def __init__(self, resolver, priority_groups, scoreboard=None, with_tls=False):
         self._resolver = resolver
-        self._priority_groups = priority_groups
+        self._priority_groups = deque(priority_groups)
         self._current_group = self.PriorityGroup([])
+        self.scoreboard = scoreboard
+        self.with_tls = with_tls
+        self.current = None
 
     @classmethod
-    def from_srv_answer(cls, resolver, answer):
-        prios = []
-        for k, g in itertools.groupby(
-            sorted(answer, key=lambda s: (s.priority, s.weight), reverse=True),
-            key=lambda s: s.priority,
-        ):
-            entries = []
-            total_weight = 0
-            for entry in g:
-                entries.append(entry)
-                total_weight += entry.weight
-            prios.append(
-                ServerPicker.PriorityGroup(entries=entries, total_weight=total_weight)
+    def from_srv_answer(cls, resolver, answer, scoreboard=None, tls_answer=None):
+        """
+        Make a picker for the targets of ``answer`` and ``tls_answer``, the
+        answers to the SRV queries for STARTTLS and direct TLS. At equal
+        priority, direct TLS targets are picked first. Unless ``tls_answer``
+        is given, even if empty, the picker yields tuples without the
+        direct_tls flag.
+        """
+        with_tls = tls_answer is not None
+        tls_answer = tls_answer or ()
+        records = [(rec, True) for rec in tls_answer]
+        records.extend((rec, False) for rec in answer)
+        prios = [
+            ServerPicker.PriorityGroup(entries=[rec for rec, _ in g], direct_tls=tls)
+            for (_, tls), g in itertools.groupby(
+                sorted(records, key=lambda r: (r[0].priority, not r[1])),
+                key=lambda r: (r[0].priority, r[1]),
             )
-        return cls(resolver, prios)
+        ]
+        return cls(resolver, prios, scoreboard, with_tls)
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        if not self._current_group.entries:
-            try:
-                self._current_group = self._priority_groups.pop(0)
-            except IndexError:
-                raise StopIteration()
-        choice = -1
-        if self._current_group.total_weight > 0:
-            rweight = random.randint(1, self._current_group.total_weight)
-            sweight = 0
-            for i, entry in enumerate(self._current_group.entries):
-                sweight += entry.weight
-                if sweight >= rweight:
-                    choice = i
-                    break
-        else:  # only 0-weighed targets remain
-            choice = random.randint(0, len(self._current_group.entries) - 1)
-        if choice == -1:
-            warnings.warn("__next__ failed to pick a server?")
-            choice = 0
-        rec = self._current_group.entries.pop(choice)
-        self._current_group.total_weight -= rec.weight
-        resolved = self._resolver.resolveaddrs(rec.target)
-        try:
-            ipv4, ipv6 = resolved.pop()
-            return ipv4, ipv6, rec.port
-        except IndexError:
-            return next(self)  # FIXME: yeaaah, this is no good
+        # every target of the current priority group is resolved as soon as
+        # the group is reached, so that picking one only waits for its own
+        # lookup, which has likely finished by then
+        while True:
+            group = self._current_group
+            if not group.remaining:
+                try:
+                    group = self._current_group = self._priority_groups.popleft()
+                except IndexError:
+                    raise StopIteration()
+                group.prefetch(self._resolver, self.scoreboard)
+            choice = group.tree.sample(random.random() * group.tree.total())
+            if choice == -1:
+                warnings.warn("__next__ failed to pick a server?")
+                choice = next(i for i, g in enumerate(group.lookups) if g is not None)
+            group.tree.remove(choice)
+            group.remaining -= 1
+            rec = group.entries[choice]
+            lookup = group.lookups[choice]
+            group.lookups[choice] = None
+            self.current = (rec.target, rec.port)
+            resolved = lookup.get()
+            if resolved:
+                ipv4, ipv6 = resolved.pop()
+                if self.with_tls:
+                    items = (ipv4, ipv6, rec.port, group.direct_tls)
+                else:
+                    items = (ipv4, ipv6, rec.port)
+                return Candidate(items, self.current)
+            # a target without addresses is skipped
+
+    def record_connect(self, seconds):
+        if self.scoreboard is not None and self.current is not None:
+            self.scoreboard.record_connect(*self.current, seconds)
+
+    def record_tls(self, seconds):
+        if self.scoreboard is not None and self.current is not None:
+            self.scoreboard.record_tls(*self.current, seconds)
+
+    def record_failure(self):
+        if self.scoreboard is not None and self.current is not None:
+            self.scoreboard.record_failure(*self.current)
 
     class PriorityGroup:
-        def __init__(self, entries, total_weight=0):
+        def __init__(self, entries, direct_tls=False):
             self.entries = entries
-            self.total_weight = total_weight
+            self.direct_tls = direct_tls
+            self.remaining = len(entries)
+            self.lookups = []
+            self.tree = None
+
+        def prefetch(self, resolver, scoreboard=None):
+            now = time.monotonic()
+            weights = []
+            for entry in self.entries:
+                weight = entry.weight or ZERO_WEIGHT
+                if scoreboard is not None:
+                    weight *= scoreboard.score(entry.target, entry.port, now)
+                weights.append(weight)
+            self.tree = _WeightTree(weights)
+            self.lookups = [
+                gevent.spawn(resolver.resolveaddrs, entry.target)
+                for entry in self.entries
+            ]
+
+
+class DNSCache(Log):
+    """
+    A bounded cache of DNS answers, keyed by ``(qname, rdtype)`` and kept for
+    the TTL of the answer. Negative answers are kept for the TTL given by the
+    SOA record the server returned with them, if any. Once ``maxsize``
+    entries are cached, the least recently used one is dropped.
+
+    An entry that expired less than ``stale_ttl`` seconds ago is still
+    returned, while a greenlet refreshes it in the background. Concurrent
+    lookups of the same missing entry share a single query.
+
+    ``hits`` counts lookups answered by fresh entries, ``stale_hits`` those
+    answered by stale ones and ``misses`` those that had to wait for a query.
+    """
+
+    def __init__(self, maxsize=DNS_CACHE_SIZE, stale_ttl=STALE_TTL, max_ttl=MAX_TTL):
+        self.maxsize = maxsize
+        self.stale_ttl = stale_ttl
+        self.max_ttl = max_ttl
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (qname, rdtype) -> (records, expires)
+        self._pending = {}  # (qname, rdtype) -> AsyncResult of a running query
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        """
+        The share of lookups so far answered from the cache, stale or not.
+        """
+        total = self.hits + self.stale_hits + self.misses
+        return (self.hits + self.stale_hits) / total if total else 0.0
+
+    def get(self, qname, rdtype, lookup):
+        """
+        Return the records cached for ``qname``, a string or dns.name.Name,
+        and ``rdtype``, or look them up with ``lookup(qname, rdtype)``, which
+        returns a sequence of records and the TTL to cache them for. Errors
+        raised by ``lookup`` are not cached.
+        """
+        key = (str(qname).lower(), rdtype)
+        entry = self._entries.get(key)
+        if entry is not None:
+            records, expires = entry
+            now = time.monotonic()
+            if now < expires:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return records
+            if now < expires + self.stale_ttl:
+                self.stale_hits += 1
+                self._entries.move_to_end(key)
+                if key not in self._pending:
+                    gevent.spawn(self._refresh, key, lookup)
+                return records
+            del self._entries[key]
+        self.misses += 1
+        pending = self._pending.get(key)
+        if pending is not None:
+            return pending.get()
+        return self._fetch(key, lookup)
+
+    def put(self, qname, rdtype, records, ttl):
+        if ttl <= 0:
+            return
+        key = (str(qname).lower(), rdtype)
+        expires = time.monotonic() + min(ttl, self.max_ttl)
+        self._entries[key] = (records, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def _fetch(self, key, lookup):
+        result = self._pending[key] = event.AsyncResult()
+        try:
+            records, ttl = lookup(*key)
+        except BaseException as e:
+            result.set_exception(e)
+            raise
+        else:
+            self.put(key[0], key[1], records, ttl)
+            result.set(records)
+            return records
+        finally:
+            del self._pending[key]
+
+    def _refresh(self, key, lookup):
+        try:
+            self._fetch(key, lookup)
+        except Exception:
+            # the stale entry is served until it runs out
+            self.log.debug("_refresh: failed to refresh %r", key, exc_info=True)
+
 
+default_cache = DNSCache()  # shared by resolvers by default
+default_scoreboard = TargetScoreboard()  # shared by resolvers by default
+_default = object()
 
+
+# dnspython is imported by the methods that query DNS, since it would otherwise
+# account for most of the import time of this module
 class Resolver(Log):
-    def __init__(self, service_name, service_proto="tcp", resolver=None):
+    """
+    Looks up XMPP servers through DNS. For the xmpp-client and xmpp-server
+    services, getaddrs() can look up the XEP-0368 direct TLS services as
+    well, unless ``direct_tls`` is false. Answers are cached in ``cache``, a
+    DNSCache, and ServerPicker weighs SRV targets by their health in
+    ``scoreboard``, a TargetScoreboard. Both default to ones shared by all
+    resolvers; None disables them.
+    """
+
+    def __init__(
+        self,
+        service_name,
+        service_proto="tcp",
+        resolver=None,
+        cache=_default,
+        scoreboard=_default,
+        direct_tls=True,
+    ):
         self.service_prefix = "_" + service_name + "._" + service_proto + "."
-        self._resolver = resolver or dns.resolver.get_default_resolver()
+        self.tls_service_prefix = None
+        if direct_tls and service_name.startswith("xmpp-"):
+            self.tls_service_prefix = (
+                "_xmpps-" + service_name[5:] + "._" + service_proto + "."
+            )
+        self._resolver = resolver
+        self.cache = default_cache if cache is _default else cache
+        self.scoreboard = default_scoreboard if scoreboard is _default else scoreboard
+
+    def getaddrs(self, host, port=None, with_tls=False):
+        """
+        Return an iterator of ``(ipv4, ipv6, port)`` candidates for ``host``,
+        in the order they should be tried. Without SRV records, the addresses
+        of ``host`` itself are returned with ``port``.
 
-    def getaddrs(self, host, port=None):
+        With ``with_tls``, the SRV records for XEP-0368 direct TLS are
+        queried along with those for STARTTLS, and the candidates are
+        ``(ipv4, ipv6, port, direct_tls)`` tuples.
+        """
+        import dns.rdatatype
+
+        flag = (False,) if with_tls else ()
         ipv4, ipv6 = self._try_inet(host)
         if ipv4 or ipv6:
-            return iter([(ipv4, ipv6, port)])
+            return iter([(ipv4, ipv6, port) + flag])
 
-        ans = self._query(self.service_prefix + host, dns.rdatatype.SRV)
-        if not ans:
-            return map(lambda ph: (ph[0], ph[1], port), self.resolveaddrs(host))
+        srv = dns.rdatatype.SRV
+        if with_tls and self.tls_service_prefix is not None:
+            plain = gevent.spawn(self._query, self.service_prefix + host, srv)
+            tls_ans = self._query(self.tls_service_prefix + host, srv)
+            ans = plain.get()
+        else:
+            ans = self._query(self.service_prefix + host, srv)
+            tls_ans = () if with_tls else None
+        if not ans and not tls_ans:
+            return map(
+                lambda ph: (ph[0], ph[1], port) + flag, self.resolveaddrs(host)
+            )
 
-        return ServerPicker.from_srv_answer(self, ans)
+        return ServerPicker.from_srv_answer(self, ans, self.scoreboard, tls_ans)
 
     def resolveaddrs(self, qname):
+        import dns.rdatatype
+
         def map_address_pair(p):
             ipv4, ipv6 = p
             if ipv4:
@@ -95,15 +519,11 @@ class Resolver(Log):
                 ipv6 = ipv6.address
             return ipv4, ipv6
 
-        return list(
-            map(
-                map_address_pair,
-                itertools.zip_longest(
-                    self._query(qname, dns.rdatatype.A),
-                    self._query(qname, dns.rdatatype.AAAA),
-                ),
-            )
-        )
+        # both families are queried at once
+        a = gevent.spawn(self._query, qname, dns.rdatatype.A)
+        aaaa = gevent.spawn(self._query, qname, dns.rdatatype.AAAA)
+        gevent.joinall((a, aaaa), raise_error=True)
+        return list(map(map_address_pair, itertools.zip_longest(a.value, aaaa.value)))
 
     def _try_inet(self, host):
         host = host.strip("[]")
@@ -121,23 +541,59 @@ class Resolver(Log):
 
         return None, None
 
-    def _query(self, qname, *args, **kwargs):
-        kwargs.setdefault("raise_on_no_answer", True)
-        rdtype = kwargs.get("rdtype", 1)
-        rdtype_s = dns.rdatatype.to_text(rdtype)
+    def _query(self, qname, rdtype):
+        import dns.exception
+        import dns.rdatatype
+
         try:
-            return self._resolver.query(qname, *args, **kwargs)
-        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
-            self.log.debug("_query: missing %s record for %s", rdtype_s, qname)
+            if self.cache is None:
+                return self._lookup(qname, rdtype)[0]
+            return self.cache.get(qname, rdtype, self._lookup)
         except dns.exception.Timeout:
             self.log.warning(
-                "_query: timed out while querying %s record for %s", rdtype_s, qname
+                "_query: timed out while querying %s record for %s",
+                dns.rdatatype.to_text(rdtype),
+                qname,
             )
         except dns.exception.DNSException:
             self.log.error(
                 "_query: DNS failed while querying %s record for %s",
-                rdtype_s,
+                dns.rdatatype.to_text(rdtype),
                 qname,
                 exc_info=True,
             )
-        return []  # FIXME: kinda nasty but oh well
+        return ()  # FIXME: kinda nasty but oh well
+
+    def _lookup(self, qname, rdtype):
+        # returns the records and the TTL to cache them for; missing records
+        # are cached for the negative TTL of the response, if it has one
+        import dns.resolver
+
+        if self._resolver is None:
+            self._resolver = dns.resolver.get_default_resolver()
+        try:
+            answer = self._resolver.query(qname, rdtype, raise_on_no_answer=True)
+        except dns.resolver.NXDOMAIN as e:
+            responses = e.kwargs.get("responses") or {}
+            response = next(iter(responses.values()), None)
+        except dns.resolver.NoAnswer as e:
+            response = e.kwargs.get("response")
+        else:
+            return tuple(answer), answer.rrset.ttl
+        self.log.debug(
+            "_lookup: missing %s record for %s",
+            dns.rdatatype.to_text(rdtype),
+            qname,
+        )
+        return (), _negative_ttl(response)
+
+
+def _negative_ttl(response):
+    # RFC 2308: the TTL of the SOA record, capped by its minimum field
+    import dns.rdatatype
+
+    if response is not None:
+        for rrset in response.authority:
+            if rrset.rdtype == dns.rdatatype.SOA:
+                return min(rrset.ttl, rrset[0].minimum)
+    return 0
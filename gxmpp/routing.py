@@ -0,0 +1,216 @@
+# routing.py implements a JID-keyed routing table
+from gxmpp.jid import JID, _domain_key
+
+_MISSING = object()
+
+
+class _Node:
+    # a domain or bare JID: the route for the node itself and its children,
+    # localparts for domains and resourceparts for bare JIDs
+    __slots__ = ("value", "children")
+
+    def __init__(self):
+        self.value = _MISSING
+        self.children = None
+
+
+class JIDRoutingTable:
+    """
+    A mapping of JIDs to routes, organized as domain -> bare JID -> resource.
+    Entries are keyed by the canonical JID key, so JIDs that compare equal
+    address the same entry. A domainpart of the form ``*.example.org``
+    registers a wildcard route for all subdomains of ``example.org``.
+
+    Only the parts of the JIDs are kept, not the JID objects themselves,
+    which keeps the table compact at large sizes.
+    """
+
+    __slots__ = ("_domains", "_wildcards", "_len")
+
+    def __init__(self, routes=()):
+        self._domains = {}
+        self._wildcards = {}
+        self._len = 0
+        for jid, value in routes:
+            self[jid] = value
+
+    def __setitem__(self, jid, value):
+        local, domain, resource = jid.key
+        if domain.startswith("*."):
+            if local is not None or resource is not None:
+                raise ValueError(
+                    "wildcard routes must not have a localpart or resourcepart"
+                )
+            domain = _domain_key(domain[2:])
+            if domain not in self._wildcards:
+                self._len += 1
+            self._wildcards[domain] = value
+            return
+        if resource is not None and local is None:
+            raise ValueError("routes with a resourcepart must have a localpart")
+        node = self._domains.get(domain)
+        if node is None:
+            node = self._domains[domain] = _Node()
+        if local is not None:
+            if node.children is None:
+                node.children = {}
+            bare = node.children.get(local)
+            if bare is None:
+                bare = node.children[local] = _Node()
+            node = bare
+        if resource is not None:
+            if node.children is None:
+                node.children = {}
+            if resource not in node.children:
+                self._len += 1
+            node.children[resource] = value
+            return
+        if node.value is _MISSING:
+            self._len += 1
+        node.value = value
+
+    def __getitem__(self, jid):
+        value = self.get(jid, _MISSING)
+        if value is _MISSING:
+            raise KeyError(jid)
+        return value
+
+    def __delitem__(self, jid):
+        local, domain, resource = jid.key
+        if domain.startswith("*."):
+            if local is not None or resource is not None:
+                raise KeyError(jid)
+            try:
+                del self._wildcards[_domain_key(domain[2:])]
+            except KeyError:
+                raise KeyError(jid) from None
+            self._len -= 1
+            return
+        dnode = self._domains.get(domain)
+        if dnode is None or resource is not None and local is None:
+            raise KeyError(jid)
+        node = dnode
+        if local is not None:
+            node = (dnode.children or {}).get(local)
+            if node is None:
+                raise KeyError(jid)
+        if resource is not None:
+            try:
+                del (node.children or {})[resource]
+            except KeyError:
+                raise KeyError(jid) from None
+        elif node.value is _MISSING:
+            raise KeyError(jid)
+        else:
+            node.value = _MISSING
+        self._len -= 1
+        # prune nodes left without routes
+        if local is not None and node.value is _MISSING and not node.children:
+            del dnode.children[local]
+        if dnode.value is _MISSING and not dnode.children:
+            del self._domains[domain]
+
+    def __contains__(self, jid):
+        return self.get(jid, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for jid, _ in self.items():
+            yield jid
+
+    def get(self, jid, default=None):
+        """
+        Return the route registered for exactly ``jid``, or ``default``.
+        """
+        local, domain, resource = jid.key
+        if domain.startswith("*."):
+            if local is not None or resource is not None:
+                return default
+            return self._wildcards.get(_domain_key(domain[2:]), default)
+        if resource is not None and local is None:
+            return default  # never routed, see __setitem__
+        node = self._domains.get(domain)
+        if node is None:
+            return default
+        if local is not None:
+            if node.children is None:
+                return default
+            node = node.children.get(local)
+            if node is None:
+                return default
+        if resource is not None:
+            if node.children is None:
+                return default
+            return node.children.get(resource, default)
+        value = node.value
+        return default if value is _MISSING else value
+
+    def lookup(self, jid, default=None):
+        """
+        Return the most specific route for ``jid``: its full JID, then its
+        bare JID, then its domain, then the closest wildcard covering the
+        domain. Returns ``default`` if nothing matches.
+        """
+        local, domain, resource = jid.key
+        dnode = self._domains.get(domain)
+        if dnode is not None:
+            if local is not None and dnode.children is not None:
+                node = dnode.children.get(local)
+                if node is not None:
+                    if resource is not None and node.children is not None:
+                        value = node.children.get(resource, _MISSING)
+                        if value is not _MISSING:
+                            return value
+                    if node.value is not _MISSING:
+                        return node.value
+            if dnode.value is not _MISSING:
+                return dnode.value
+        wildcards = self._wildcards
+        if wildcards:
+            i = domain.find(".")
+            while i != -1:
+                domain = domain[i + 1 :]
+                value = wildcards.get(domain, _MISSING)
+                if value is not _MISSING:
+                    return value
+                i = domain.find(".")
+        return default
+
+    def resources(self, jid):
+        """
+        Return a view of the ``(resource, route)`` pairs registered under the
+        bare JID of ``jid``. The view is live and must not be iterated over
+        while the table is modified.
+        """
+        local, domain, _ = jid.key
+        node = self._domains.get(domain)
+        if node is None or local is None or node.children is None:
+            return ()
+        node = node.children.get(local)
+        if node is None or node.children is None:
+            return ()
+        return node.children.items()
+
+    def items(self):
+        """
+        Iterate over ``(jid, route)`` pairs. The JIDs are rebuilt from their
+        canonical parts, so they compare equal to, but are not necessarily
+        the same objects as, the JIDs the routes were registered with.
+        """
+        for domain, dnode in self._domains.items():
+            if dnode.value is not _MISSING:
+                yield JID(None, domain), dnode.value
+            for local, node in (dnode.children or {}).items():
+                if node.value is not _MISSING:
+                    yield JID(local, domain), node.value
+                for resource, value in (node.children or {}).items():
+                    yield JID(local, domain, resource), value
+        for domain, value in self._wildcards.items():
+            yield JID(None, "*." + domain), value
+
+    def clear(self):
+        self._domains.clear()
+        self._wildcards.clear()
+        self._len = 0
@@ -4,12 +4,14 @@
 import errno
 import ipaddress
 import logging
+from collections import deque
 
 import gevent
 from gevent import event, pool, queue, socket, time
 
 RESOLVE_DELAY = 0.050  # 50 ms
 CONNECT_DELAY = 0.100  # 100 ms
+CONNECT_TIMEOUT = 10.0  # per race_connect attempt
 MIN_TIMEOUT = 0.001  # 1 ms
 
 _log = logging.getLogger(__name__)
@@ -33,7 +35,7 @@ def _create_connection(
         af, socktype, proto, canonname, sa = res
         sock = None
         try:
-            sock = socket(af, socktype, proto)
+            sock = socket.socket(af, socktype, proto)
             if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
                 sock.settimeout(timeout)
             if source_address:
@@ -212,3 +214,154 @@ def create_connection(
         raise socket.timeout("timed out")
     finally:
         group.kill(_Cancel)
+
+
+def _interleave(candidates):
+    # RFC 8305 section 4: alternate between address families, starting with
+    # IPv6, pulling candidates only when the family due next has run out
+    candidates = iter(candidates)
+    queues = {socket.AF_INET6: deque(), socket.AF_INET: deque()}
+    other = {socket.AF_INET6: socket.AF_INET, socket.AF_INET: socket.AF_INET6}
+    family = socket.AF_INET6
+    exhausted = False
+    while True:
+        while not queues[family] and not exhausted:
+            try:
+                candidate = next(candidates)
+            except StopIteration:
+                exhausted = True
+                break
+            ipv4, ipv6, port = candidate[:3]
+            if ipv6:
+                queues[socket.AF_INET6].append(((ipv6, port, 0, 0), candidate))
+            if ipv4:
+                queues[socket.AF_INET].append(((ipv4, port), candidate))
+        if not queues[family]:
+            family = other[family]
+            if not queues[family]:
+                return
+        addr, candidate = queues[family].popleft()
+        yield family, addr, candidate
+        family = other[family]
+
+
+def race_connect(
+    candidates,
+    timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+    source_address=None,
+    prepare=None,
+    attempt_delay=CONNECT_DELAY,
+    connect_timeout=CONNECT_TIMEOUT,
+    scoreboard=None,
+):
+    """
+    Connect to the first of ``candidates`` that answers, such as the
+    ``(ipv4, ipv6, port[, direct_tls])`` tuples Resolver.getaddrs() yields.
+    Their addresses are tried in turn, alternating between IPv6 and IPv4,
+    with a new attempt started every ``attempt_delay`` seconds, or as soon
+    as the previous one failed, while earlier ones are still running. An
+    attempt fails after ``connect_timeout`` seconds. Returns the socket and
+    the candidate it connected to; the other attempts are cancelled.
+
+    With a ``scoreboard``, a TargetScoreboard, the outcome is recorded for
+    the SRV targets of candidates that carry one, as the Candidate objects
+    of ServerPicker do: the connect time of the one that connected, and a
+    failure for those on which every attempt made failed.
+    """
+    _log.debug("race_connect")
+    group = pool.Group()
+    # (1, (sock, candidate)) = success
+    # (-1, (candidate, addr, exc)) = fail (connect)
+    # (0, exc) = no addresses left, or exc raised getting them
+    bus = queue.Queue()
+    failed = event.Event()
+    # id(candidate) -> [candidate, attempts started, attempts failed]
+    attempts = {}
+
+    def _do_connect(family, addr, candidate):
+        _log.debug("race_connect: started family=%s, addr=%s", family, addr)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            if source_address:
+                sock.bind(source_address)
+            if prepare:
+                prepare(sock)
+            sock_timeout = sock.gettimeout()
+            sock.settimeout(connect_timeout)
+            started = time.monotonic()
+            sock.connect(addr)
+            sock.settimeout(sock_timeout)
+        except _Cancel:
+            _log.debug("race_connect: cancelled family=%s, addr=%s", family, addr)
+        except Exception as e:
+            attempts[id(candidate)][2] += 1
+            bus.put((-1, (candidate, addr, e)))
+            failed.set()
+        except BaseException:
+            sock.close()
+            raise
+        else:
+            target = getattr(candidate, "target", None)
+            if scoreboard is not None and target is not None:
+                scoreboard.record_connect(*target, time.monotonic() - started)
+            return bus.put((1, (sock, candidate)))
+        sock.close()
+
+    def _schedule():
+        try:
+            for family, addr, candidate in _interleave(candidates):
+                failed.clear()
+                bus.put((2, None))
+                attempts.setdefault(id(candidate), [candidate, 0, 0])[1] += 1
+                group.spawn(_do_connect, family, addr, candidate)
+                failed.wait(timeout=attempt_delay)
+        except _Cancel:
+            return
+        except Exception as e:
+            return bus.put((0, e))
+        bus.put((0, None))
+
+    group.spawn(_schedule)
+
+    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+        timeout = None
+
+    started = time.monotonic()
+    pending = 0
+    scheduled = False
+    errors = []
+    t = timeout
+    try:
+        while True:
+            if t is not None:
+                t = max(MIN_TIMEOUT, timeout - (time.monotonic() - started))
+            op, rest = bus.get(timeout=t)
+            if op == 1:
+                return rest
+            elif op == 2:
+                pending += 1
+                continue
+            elif op == -1:
+                errors.append(rest)
+                pending -= 1
+            elif rest is not None:
+                errors.append((None, None, rest))
+                scheduled = True
+            else:
+                scheduled = True
+            if scheduled and pending <= 0:
+                raise socket.error(errors or "no addresses to connect to")
+    except queue.Empty:
+        raise socket.timeout("timed out")
+    finally:
+        group.kill(_Cancel)
+        # attempts that connected after the winner
+        while not bus.empty():
+            op, rest = bus.get()
+            if op == 1:
+                rest[0].close()
+        if scoreboard is not None:
+            for candidate, started, failures in attempts.values():
+                target = getattr(candidate, "target", None)
+                if target is not None and failures == started:
+                    scoreboard.record_failure(*target)
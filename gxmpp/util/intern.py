@@ -0,0 +1,102 @@
+import weakref
+from collections import OrderedDict, namedtuple
+
+InternInfo = namedtuple("InternInfo", "hits misses evictions maxsize strong weak")
+
+
+class InternTable:
+    """
+    An interning table. Values are held weakly, so that identical keys map to
+    one shared object for as long as anything references it, while the
+    ``maxsize`` most recently used values are additionally kept alive by a
+    strong LRU. Values must be weak-referenceable.
+    """
+
+    __slots__ = ("maxsize", "hits", "misses", "evictions", "_strong", "_weak")
+
+    def __init__(self, maxsize=1024):
+        if maxsize < 0:
+            raise ValueError("maxsize must not be negative")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._strong = OrderedDict()
+        self._weak = weakref.WeakValueDictionary()
+
+    def lookup(self, key, factory, *args):
+        """
+        Return the value interned under ``key``, calling ``factory(*args)`` to
+        create it on a miss. Exceptions raised by ``factory`` propagate and
+        nothing is interned.
+        """
+        value = self._weak.get(key)
+        if value is None:
+            self.misses += 1
+            value = factory(*args)
+            self._weak[key] = value
+        else:
+            self.hits += 1
+        self._keep(key, value)
+        return value
+
+    def get(self, key, default=None):
+        """
+        Return the value interned under ``key`` or ``default``. Only hits are
+        counted, so that a miss followed by lookup() is counted once.
+        """
+        value = self._weak.get(key)
+        if value is None:
+            return default
+        self.hits += 1
+        self._keep(key, value)
+        return value
+
+    def _keep(self, key, value):
+        if not self.maxsize:
+            return
+        strong = self._strong
+        if key in strong:
+            strong.move_to_end(key)
+            return
+        strong[key] = value
+        if len(strong) > self.maxsize:
+            strong.popitem(last=False)
+            self.evictions += 1
+
+    def resize(self, maxsize):
+        """
+        Change the size of the strong LRU, evicting the least recently used
+        entries if it shrinks.
+        """
+        if maxsize < 0:
+            raise ValueError("maxsize must not be negative")
+        self.maxsize = maxsize
+        strong = self._strong
+        while len(strong) > maxsize:
+            strong.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Drop all entries and reset the counters.
+        """
+        self._strong.clear()
+        self._weak.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        return InternInfo(
+            self.hits,
+            self.misses,
+            self.evictions,
+            self.maxsize,
+            len(self._strong),
+            len(self._weak),
+        )
+
+    def __len__(self):
+        return len(self._weak)
+
+    def __contains__(self, key):
+        return key in self._weak
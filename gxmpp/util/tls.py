@@ -0,0 +1,144 @@
+# tls.py implements TLS for STARTTLS and direct TLS connections, resuming
+# sessions across reconnects
+import time
+from collections import OrderedDict
+
+from gevent import ssl
+
+from gxmpp.util import happyeyeballs
+
+DEFAULT_MAXSIZE = 1024  # sessions kept by a TLSSessionCache
+
+
+def create_context(cafile=None):
+    """
+    Return a client SSLContext that verifies certificates against
+    ``cafile``, or the default CA certificates. Unlike
+    ssl.create_default_context(), it makes a gevent SSLContext whether or
+    not ssl is monkey-patched.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    if cafile is None:
+        context.load_default_certs()
+    else:
+        context.load_verify_locations(cafile)
+    return context
+
+
+class TLSSessionCache:
+    """
+    A bounded cache of TLS sessions, keyed by the domain a connection is for
+    and the target it was made to, so that reconnecting resumes the session
+    with an abbreviated handshake instead of doing a full one. Sessions can
+    only be resumed with the SSLContext they were made with, ``context``.
+    Once ``maxsize`` sessions are cached, the least recently used one is
+    dropped.
+
+    ``hits`` counts handshakes that resumed a cached session, ``misses``
+    those that had no session to resume, and ``rejected`` those where the
+    peer refused the cached session and did a full handshake.
+    """
+
+    __slots__ = ("context", "maxsize", "hits", "misses", "rejected", "_sessions")
+
+    def __init__(self, context=None, maxsize=DEFAULT_MAXSIZE):
+        self.context = context or create_context()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self._sessions = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @property
+    def hit_rate(self):
+        """
+        The share of handshakes so far that resumed a session.
+        """
+        total = self.hits + self.misses + self.rejected
+        return self.hits / total if total else 0.0
+
+    def get(self, domain, target=None):
+        """
+        Return the session cached for ``domain`` and ``target``, or None if
+        there is none or it has expired.
+        """
+        key = (domain, target)
+        session = self._sessions.get(key)
+        if session is None:
+            return None
+        if session.time + session.timeout <= time.time():
+            del self._sessions[key]
+            return None
+        self._sessions.move_to_end(key)
+        return session
+
+    def save(self, sock, domain, target=None):
+        """
+        Cache the session of ``sock`` for ``domain`` and ``target``. With TLS
+        1.3 the session can only be resumed once the server has sent a ticket
+        for it after the handshake, so this should be called again once data
+        has been received.
+        """
+        session = sock.session
+        if session is None or not session.has_ticket and not session.id:
+            return
+        key = (domain, target)
+        self._sessions[key] = session
+        self._sessions.move_to_end(key)
+        while len(self._sessions) > self.maxsize:
+            self._sessions.popitem(last=False)
+
+    def discard(self, domain, target=None):
+        self._sessions.pop((domain, target), None)
+
+    def clear(self):
+        self._sessions.clear()
+
+    def wrap_socket(self, sock, domain, target=None):
+        """
+        Do a TLS handshake on ``sock`` for ``domain``, resuming the session
+        cached for ``domain`` and ``target`` if there is one. Returns the
+        SSLSocket.
+        """
+        session = self.get(domain, target)
+        tls_sock = self.context.wrap_socket(
+            sock, server_hostname=domain, session=session
+        )
+        if tls_sock.session_reused:
+            self.hits += 1
+        elif session is None:
+            self.misses += 1
+        else:
+            self.rejected += 1
+            self.discard(domain, target)
+        self.save(tls_sock, domain, target)
+        return tls_sock
+
+
+def starttls(sock, domain, cache=None, target=None):
+    """
+    Upgrade ``sock`` to TLS once the server has sent <proceed/>, resuming a
+    session from ``cache`` if it has one for ``domain`` and ``target``, the
+    ``(host, port)`` the connection was made to. Without ``cache``, a full
+    handshake is done with the default SSLContext.
+    """
+    if cache is None:
+        return create_context().wrap_socket(sock, server_hostname=domain)
+    return cache.wrap_socket(sock, domain, target)
+
+
+def create_connection(address, domain, cache=None, **kwargs):
+    """
+    Connect to ``address`` with happyeyeballs.create_connection() and do
+    a direct TLS handshake for ``domain``, resuming a session from ``cache``
+    if it has one for ``domain`` and ``address``.
+    """
+    sock = happyeyeballs.create_connection(address, **kwargs)
+    try:
+        return starttls(sock, domain, cache, tuple(address[:2]))
+    except BaseException:
+        sock.close()
+        raise
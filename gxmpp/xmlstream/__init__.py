@@ -2,47 +2,169 @@
 # since mocket doesn't quite work
 # oh well!
 import sys
+import zlib
 from abc import ABC, abstractmethod
 
 import gevent
-from gevent import event, queue
+from gevent import event, lock, queue, time
 from lxml import etree
 
 from gxmpp.util import reraise
+from gxmpp.xmlstream.limits import PolicyViolation, StreamLimits
+from gxmpp.xmlstream.raw import RawParser, RawStanza  # noqa:F401
+from gxmpp.xmlstream.template import StanzaTemplate  # noqa:F401
 
-MAX_EVENT_QUEUE = 512
+MAX_EVENT_QUEUE = 512  # default high-water mark of the event queue
+MIN_EVENT_QUEUE = 128  # default low-water mark of the event queue
+MIN_RECV_BUF = 2 ** 12
 MAX_RECV_BUF = 2 ** 16
+RECV_SHRINK_AFTER = 16  # small reads in a row before the buffer shrinks
+MAX_SEND_BUF = 2 ** 18  # default high-water mark of the output buffer, in bytes
+MIN_SEND_BUF = 2 ** 16  # default low-water mark of the output buffer, in bytes
+COMPRESS_LEVEL = 6  # default zlib level of XEP-0138 stream compression
+
+# queued for consumers waiting on a reader that stopped, as the stream ended
+# or as it returned an element with once=True and left reading to them
+_EOF = object()
+_TAKEOVER = object()
+
+
+class RecvBuffer:
+    """
+    A reusable receive buffer. Data is received into a preallocated bytearray
+    with recv_into() instead of allocating a MAX_RECV_BUF sized bytes object
+    on every read. As lxml only parses bytes, each read is then copied out
+    once into a bytes object of the size that was actually received.
+
+    The buffer grows while reads fill it, up to ``max_size``, and shrinks
+    after ``RECV_SHRINK_AFTER`` reads in a row used less than a quarter of it.
+    """
+
+    __slots__ = ("min_size", "max_size", "_buf", "_view", "_small")
+
+    def __init__(self, min_size=MIN_RECV_BUF, max_size=MAX_RECV_BUF):
+        self.min_size = min_size
+        self.max_size = max_size
+        self._small = 0
+        self._resize(min_size)
+
+    @property
+    def size(self):
+        return len(self._buf)
+
+    def _resize(self, size):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+
+    def recv(self, sock):
+        n = sock.recv_into(self._buf)
+        data = self._view[:n].tobytes()
+        size = len(self._buf)
+        if n == size:
+            self._small = 0
+            if size < self.max_size:
+                self._resize(min(size * 2, self.max_size))
+        elif n < size // 4 and size > self.min_size:
+            self._small += 1
+            if self._small >= RECV_SHRINK_AFTER:
+                self._small = 0
+                self._resize(max(size // 2, self.min_size))
+        else:
+            self._small = 0
+        return data
 
 
-class ParseTarget:
-    __slots__ = ("stream", "depth", "root", "current")
+def _attrib_size(attrib):
+    return sum(map(len, attrib.keys())) + sum(map(len, attrib.values()))
 
-    def __init__(self, stream):
+
+class ParseTarget:
+    __slots__ = (
+        "stream",
+        "depth",
+        "root",
+        "current",
+        "limits",
+        "size",
+        "text",
+        "recycling",
+        "buffered",
+    )
+
+    def __init__(self, stream, limits):
         self.stream = stream
         self.depth = 0
         self.root = None
-        self.current = etree.TreeBuilder()
+        # a TreeBuilder per stanza: stanzas are built as documents of their
+        # own, and nothing of them is left in the builder once delivered
+        self.current = None
+        self.limits = limits
+        self.size = 0  # of the current stanza, checked before it is built
+        self.text = 0  # length of the current run of character data
+        self.recycling = False  # the parser is closed to be reused
+        self.buffered = 0  # bytes fed since the last callback
+
+    def feed(self, parser, data):
+        # lxml buffers incomplete markup, such as a start tag that never ends,
+        # without calling back, so data is fed in slices, and no more than
+        # max_stanza_size bytes are fed without a callback
+        limit = self.limits.max_stanza_size
+        while data:
+            if self.buffered >= limit:
+                raise PolicyViolation("max_stanza_size", limit)
+            n = limit - self.buffered
+            chunk, data = data[:n], data[n:]
+            counted = self.buffered = self.buffered + len(chunk)
+            parser.feed(chunk)  # callbacks reset buffered
+            if self.buffered == counted and self.depth <= 1 and not chunk.strip():
+                self.buffered -= len(chunk)  # whitespace between stanzas
 
     def start(self, tag, attrib):
+        self.buffered = 0
+        limits = self.limits
+        if len(attrib) > limits.max_attributes:
+            raise PolicyViolation("max_attributes", limits.max_attributes)
         if self.depth == 0:
             self.root = etree.Element(tag, attrib)
             self.stream.handle_stream_start(self.root)
+        else:
+            if self.depth > limits.max_depth:
+                raise PolicyViolation("max_depth", limits.max_depth)
+            if self.depth == 1:
+                self.size = 0
+                self.current = etree.TreeBuilder()
+            self.size += len(tag) + (_attrib_size(attrib) if attrib else 0)
+            if self.size > limits.max_stanza_size:
+                raise PolicyViolation("max_stanza_size", limits.max_stanza_size)
+            self.current.start(tag, attrib)
+        self.text = 0
         self.depth += 1
-        self.current.start(tag, attrib)
 
     def end(self, tag):
+        self.buffered = 0
+        self.text = 0
         self.depth -= 1
         if self.depth == 0:
             self.stream.handle_stream_end()
             return
         if self.depth == 1:
-            self.stream.handle_element(self.current.end(tag))
+            elem = self.current.end(tag)
+            self.current = None
+            self.stream.handle_element(elem)
         else:
             self.current.end(tag)
 
     def data(self, data):
+        self.buffered = 0
         if self.depth <= 1:
             return  # TODO: check spec?
+        limits = self.limits
+        self.text += len(data)
+        if self.text > limits.max_text:
+            raise PolicyViolation("max_text", limits.max_text)
+        self.size += len(data)
+        if self.size > limits.max_stanza_size:
+            raise PolicyViolation("max_stanza_size", limits.max_stanza_size)
         self.current.data(data)
 
     # def comment(self, text): pass
@@ -51,22 +173,237 @@ class ParseTarget:
         self.depth = 0
         self.root = None
         self.current = None
+        self.buffered = 0
+        if not self.recycling:
+            self.stream.handle_close()
+
+
+class PullParser:
+    """
+    A parser engine built on etree.XMLPullParser. Unlike ParseTarget, which
+    lxml calls back for every start tag, end tag and text node, the tree is
+    built in C and Python only sees a lightweight start/end event per
+    element. Completed top-level elements are detached from the stream root
+    and handed to the stream like ParseTarget does.
+
+    As events are only read after lxml parsed the data fed to it, limits
+    are checked after every feed, on the elements started and ended since the
+    last one and on the run of text that is still open. Incomplete markup is
+    buffered by lxml without any event, so data is fed in slices, and no more
+    than ``max_stanza_size`` bytes are fed without an event being read.
+
+    Comments and processing instructions are dropped, as with ParseTarget.
+    """
+
+    __slots__ = (
+        "stream",
+        "depth",
+        "root",
+        "parser",
+        "limits",
+        "size",
+        "last",
+        "buffered",
+    )
+
+    def __init__(self, stream, limits):
+        self.stream = stream
+        self.depth = 0
+        self.root = None
+        self.parser = etree.XMLPullParser(
+            events=("start", "end"), remove_comments=True, remove_pis=True
+        )
+        self.limits = limits
+        self.size = 0
+        # the last event: a run of text ends at every event, and is the text
+        # of the element if that was a start event or its tail if it was not
+        self.last = (None, False)
+        self.buffered = 0  # bytes fed since the last event
+
+    def feed(self, data):
+        limit = self.limits.max_stanza_size
+        try:
+            while data:
+                if self.buffered >= limit:
+                    raise PolicyViolation("max_stanza_size", limit)
+                n = limit - self.buffered
+                chunk, data = data[:n], data[n:]
+                try:
+                    self.parser.feed(chunk)
+                except etree.ParseError:
+                    self._dispatch()
+                    raise
+                if self._dispatch():
+                    self.buffered = 0
+                elif self.depth >= 2 or chunk.strip():
+                    # whitespace between stanzas is not kept
+                    self.buffered += len(chunk)
+        except etree.ParseError:
+            self.close()
+            raise
+
+    def _dispatch(self):
+        depth = self.depth
+        stream = self.stream
+        limits = self.limits
+        max_text = limits.max_text
+        size = self.size
+        last, last_start = self.last
+        ev = None
+        for ev, elem in self.parser.read_events():
+            start = ev == "start"
+            if not start:
+                depth -= 1
+            if depth >= 2 or depth == 1 and not start:  # text within a stanza
+                text = last.text if last_start else last.tail
+                if text:
+                    if len(text) > max_text:
+                        raise PolicyViolation("max_text", max_text)
+                    size += len(text)
+            last, last_start = elem, start
+            if start:
+                if depth == 0:
+                    attrib = elem.attrib
+                    if len(attrib) > limits.max_attributes:
+                        raise PolicyViolation("max_attributes", limits.max_attributes)
+                    self.root = elem
+                    stream.handle_stream_start(etree.Element(elem.tag, attrib))
+                else:
+                    if depth > limits.max_depth:
+                        raise PolicyViolation("max_depth", limits.max_depth)
+                    if depth == 1:
+                        size = 0
+                    size += len(elem.tag)
+                    items = elem.items()
+                    if items:
+                        if len(items) > limits.max_attributes:
+                            raise PolicyViolation(
+                                "max_attributes", limits.max_attributes
+                            )
+                        for key, value in items:
+                            size += len(key) + len(value)
+                if size > limits.max_stanza_size:
+                    raise PolicyViolation("max_stanza_size", limits.max_stanza_size)
+                depth += 1
+                continue
+            if size > limits.max_stanza_size:
+                raise PolicyViolation("max_stanza_size", limits.max_stanza_size)
+            if depth == 1:
+                self.root.remove(elem)
+                elem.tail = None
+                self.root.text = None  # whitespace between elements
+                self.depth = depth
+                stream.handle_element(elem)
+            elif depth == 0:
+                self.depth = depth
+                stream.handle_stream_end()
+        self.depth = depth
+        self.size = size
+        self.last = (last, last_start)
+        if depth >= 2:
+            text = last.text if last_start else last.tail
+            if text and len(text) > max_text:
+                raise PolicyViolation("max_text", max_text)
+        return ev is not None
+
+    def reset(self):
+        try:
+            self.parser.close()
+        except etree.ParseError:
+            pass  # the stream did not end
+        for _ in self.parser.read_events():
+            pass  # left over from the old stream
+        self.depth = 0
+        self.root = None
+        self.size = 0
+        self.last = (None, False)
+        self.buffered = 0
+
+    def close(self):
+        self.depth = 0
+        self.root = None
+        self.last = (None, False)
+        self.buffered = 0
         self.stream.handle_close()
 
 
+def _serialize(stanza):
+    if isinstance(stanza, bytes):
+        return stanza
+    if isinstance(stanza, RawStanza):
+        return stanza.raw
+    if isinstance(stanza, str):
+        return stanza.encode("utf-8")
+    return etree.tostring(stanza)
+
+
+TARGET_ENGINE = "target"
+PULL_ENGINE = "pull"
+RAW_ENGINE = "raw"
+
+
 # XXX: NOT GREENLET-SAFE
 class BaseXMLStream(ABC):
-    __slots__ = ("__parser",)
-
-    def __init__(self):
-        self.__parser = etree.XMLParser(target=ParseTarget(self))
+    """
+    Base class of incremental XML stream parsers. ``engine`` selects how
+    the stream is parsed: TARGET_ENGINE, the default, drives a TreeBuilder
+    from a Python parser target, while PULL_ENGINE builds elements in C with
+    a pull parser and has less per-node overhead for deeply nested stanzas.
+    RAW_ENGINE only delimits top-level elements and passes RawStanza objects
+    instead of elements to handle_element(), for streams whose stanzas are
+    mostly forwarded as-is. All engines report to the same handle_* methods.
+
+    Incoming stanzas are checked against ``limits``, a StreamLimits instance,
+    while they are parsed. A stanza exceeding them is reported to
+    handle_parse_error() as a PolicyViolation before it is fully received.
+    """
+
+    __slots__ = ("limits", "__parser")
+
+    def __init__(self, engine=TARGET_ENGINE, limits=None):
+        if limits is None:
+            limits = StreamLimits()
+        self.limits = limits
+        if engine == TARGET_ENGINE:
+            self.__parser = etree.XMLParser(target=ParseTarget(self, limits))
+        elif engine == PULL_ENGINE:
+            self.__parser = PullParser(self, limits)
+        elif engine == RAW_ENGINE:
+            self.__parser = RawParser(self, limits)
+        else:
+            raise ValueError("unknown parser engine {!r}".format(engine))
 
     def _feed(self, data):
+        parser = self.__parser
         try:
-            self.__parser.feed(data)
+            if isinstance(parser, etree.XMLParser):
+                parser.target.feed(parser, data)
+            else:
+                parser.feed(data)
         except etree.ParseError:
             self.handle_parse_error(*sys.exc_info())
 
+    def _reset_parser(self):
+        """
+        Make the parser ready for a new stream, as after a stream restart,
+        whether or not the current one ended. The parser is reused rather
+        than reallocated.
+        """
+        parser = self.__parser
+        if not isinstance(parser, etree.XMLParser):
+            parser.reset()
+            return
+        # TARGET_ENGINE: closing the parser makes it start a new document,
+        # but must not be reported as the stream closing
+        target = parser.target
+        target.recycling = True
+        try:
+            parser.close()
+        except etree.ParseError:
+            pass  # the stream did not end
+        finally:
+            target.recycling = False
+
     @abstractmethod
     def handle_stream_start(self, elem):
         pass  # pragma: no cover
@@ -89,61 +426,344 @@ class BaseXMLStream(ABC):
 
 
 class XMLStream(BaseXMLStream):
-    __slots__ = ("sock", "started", "_events", "_shutdown", "_exc_info", "_running")
-
-    def __init__(self):
-        super().__init__()
+    """
+    An XML stream read from ``sock``. Parsed elements are queued until they
+    are returned by run().
+
+    Reading is flow controlled: once ``high_water`` elements are queued, run()
+    stops receiving until consumers have taken enough elements for the queue
+    to drop to ``low_water``. ``paused`` tells whether the stream is currently
+    waiting, ``pause_count`` how often and ``paused_time`` for how many seconds
+    in total it has waited so far.
+
+    A reader greenlet may run() the stream while consumers in other greenlets
+    take elements with run(once=True) or run_batch(), which then wait for the
+    reader to queue one instead of receiving themselves, and return None or
+    an empty list once it has stopped. Errors are raised by the reader.
+
+    Stanzas passed to send() are serialized into an output buffer, which a
+    writer greenlet writes to ``sock`` with a single sendall() once the
+    sending greenlet yields, so that stanzas sent in a burst share a write.
+    Senders block while ``send_high_water`` bytes are buffered or being
+    written, until that drops to ``send_low_water``. flush() writes the
+    buffer right away. ``write_count`` counts the writes made so far.
+
+    Once XEP-0138 compression is negotiated, compress() starts compressing
+    both directions of the stream.
+    """
+
+    __slots__ = (
+        "sock",
+        "started",
+        "high_water",
+        "low_water",
+        "paused",
+        "pause_count",
+        "paused_time",
+        "_recvbuf",
+        "_events",
+        "_resume",
+        "_shutdown",
+        "_exc_info",
+        "_running",
+        "_waiting",
+        "send_high_water",
+        "send_low_water",
+        "write_count",
+        "_outbuf",
+        "_outsize",
+        "_drained",
+        "_write_lock",
+        "_writer",
+        "_send_exc_info",
+        "_deflater",
+        "_inflater",
+        "_compress_flush",
+    )
+
+    def __init__(
+        self,
+        high_water=MAX_EVENT_QUEUE,
+        low_water=MIN_EVENT_QUEUE,
+        engine=TARGET_ENGINE,
+        limits=None,
+        send_high_water=MAX_SEND_BUF,
+        send_low_water=MIN_SEND_BUF,
+    ):
+        if not 0 <= low_water < high_water:
+            raise ValueError("low_water must be at least 0 and below high_water")
+        if not 0 <= send_low_water < send_high_water:
+            raise ValueError(
+                "send_low_water must be at least 0 and below send_high_water"
+            )
+        super().__init__(engine=engine, limits=limits)
         self.sock = None
         self.started = False
-        # ...
-        self._events = queue.Queue(MAX_EVENT_QUEUE)
+        self.high_water = high_water
+        self.low_water = low_water
+        self.paused = False
+        self.pause_count = 0
+        self.paused_time = 0.0
+        self._recvbuf = RecvBuffer()
+        # not bounded by itself: a single read may complete many elements, so
+        # the queue can exceed high_water by at most one read's worth
+        self._events = queue.Queue()
+        self._resume = event.Event()
         self._shutdown = event.Event()
         self._exc_info = None
         self._running = False
+        self._waiting = 0  # consumers waiting on the reader
+        self.send_high_water = send_high_water
+        self.send_low_water = send_low_water
+        self.write_count = 0
+        self._outbuf = []
+        self._outsize = 0  # buffered bytes, and bytes being written
+        self._drained = event.Event()
+        self._drained.set()
+        self._write_lock = lock.Semaphore()
+        self._writer = None
+        self._send_exc_info = None
+        self._deflater = None
+        self._inflater = None
+        self._compress_flush = None
+
+    def _pop_event(self):
+        elem = self._events.get_nowait()
+        while elem is _EOF or elem is _TAKEOVER:  # left by a consumer timing out
+            elem = self._events.get_nowait()
+        if self.paused and self._events.qsize() <= self.low_water:
+            self._resume.set()
+        return elem
+
+    def _wait_event(self, timeout):
+        # another greenlet is receiving: wait for it to queue an element
+        self._waiting += 1
+        try:
+            elem = gevent.with_timeout(timeout, self._events.get)
+        finally:
+            self._waiting -= 1
+        if elem is _EOF:
+            return None
+        if elem is _TAKEOVER:
+            return self.run(once=True, timeout=timeout)
+        if self.paused and self._events.qsize() <= self.low_water:
+            self._resume.set()
+        return elem
+
+    def _pause(self):
+        self.paused = True
+        self.pause_count += 1
+        self._resume.clear()
+        started = time.monotonic()
+        try:
+            self._resume.wait()
+        finally:
+            self.paused_time += time.monotonic() - started
+            self.paused = False
 
     def run(self, once=False, timeout=None):
         if timeout and not once:
             raise RuntimeError("using a receive timeout value without once=True")
 
         try:
-            return self._events.get_nowait()
+            return self._pop_event()
         except queue.Empty:
             pass
 
         if self._running:
+            if once:
+                return self._wait_event(timeout)
             raise RuntimeError("already running")
         self._running = True
+        wakeup = _TAKEOVER
         try:
             while not self._shutdown.is_set():
                 # TODO: we might need to iwait for a shutdown event?
                 # though realistically nothing outside methods invoked by
                 # _feed -> XMLParser sets _shutdown so?
-                buf = gevent.with_timeout(timeout, self.sock.recv, MAX_RECV_BUF)
+                if self._events.qsize() >= self.high_water:
+                    # only reachable with once=False, as once=True returns
+                    # any queued element before reading
+                    self._pause()
+                    continue
+                buf = gevent.with_timeout(timeout, self._recvbuf.recv, self.sock)
                 if not buf:
                     break
-                self._feed(buf)
+                if self._inflater is None:
+                    self._feed(buf)
+                else:
+                    self._feed_compressed(buf)
                 if not once:
                     continue
                 try:
-                    return self._events.get_nowait()
+                    return self._pop_event()
                 except queue.Empty:
                     continue
+            wakeup = _EOF
             exc_info = self.reset()
             if exc_info:
                 reraise(*exc_info)
             return None
         finally:
             self._running = False
+            for _ in range(self._waiting):
+                self._events.put_nowait(wakeup)
+
+    def _feed_compressed(self, data):
+        # inflate at most MAX_RECV_BUF bytes at a time, so that the parser
+        # limits apply before a few bytes can expand into a lot of them
+        inflater = self._inflater
+        try:
+            while data and not self._shutdown.is_set():
+                out = inflater.decompress(data, MAX_RECV_BUF)
+                data = inflater.unconsumed_tail
+                if out:
+                    self._feed(out)
+        except zlib.error:
+            self.handle_parse_error(*sys.exc_info())
+
+    def run_batch(self, max_items=None, timeout=None):
+        """
+        Return a list of up to ``max_items`` queued elements. If none are
+        queued, receive until at least one element is complete and return it
+        along with every other element parsed from the same data. Returns an
+        empty list once the stream has ended.
+        """
+        if max_items is not None and max_items < 1:
+            raise ValueError("max_items must be at least 1")
+        batch = self._drain(max_items)
+        if batch:
+            return batch
+        elem = self.run(once=True, timeout=timeout)
+        if elem is None:
+            return batch
+        batch.append(elem)
+        batch.extend(self._drain(max_items - 1 if max_items else None))
+        return batch
+
+    def iter_batches(self, max_items=None):
+        """
+        Iterate over lists of elements as returned by run_batch() until the
+        stream ends.
+        """
+        while True:
+            batch = self.run_batch(max_items)
+            if not batch:
+                return
+            yield batch
+
+    def _drain(self, max_items=None):
+        batch = []
+        while max_items is None or len(batch) < max_items:
+            try:
+                batch.append(self._pop_event())
+            except queue.Empty:
+                break
+        return batch
+
+    def send(self, stanza):
+        """
+        Queue ``stanza`` to be written to the stream. ``stanza`` is an element,
+        a RawStanza, whose raw bytes are sent as they are, or bytes or str
+        with serialized XML. Blocks while the output buffer is full, and
+        raises the error that made a previous write fail, if any.
+        """
+        data = _serialize(stanza)
+        while self._outsize >= self.send_high_water and not self._send_exc_info:
+            self._drained.clear()
+            self._drained.wait()
+        if self._send_exc_info:
+            reraise(*self._send_exc_info)
+        self._enqueue(data)
+
+    def _enqueue(self, data):
+        # buffer serialized data without waiting for room in the buffer
+        self._outbuf.append(data)
+        self._outsize += len(data)
+        if self._writer is None:
+            self._writer = gevent.spawn(self._write)
+
+    def flush(self):
+        """
+        Write the output buffer now rather than once the writer greenlet gets
+        to run, and wait until everything sent so far is written.
+        """
+        if self._send_exc_info:
+            reraise(*self._send_exc_info)
+        with self._write_lock:
+            self._write_buffered()
+
+    def _write(self):
+        try:
+            while self._outbuf:
+                with self._write_lock:
+                    self._write_buffered()
+        except OSError:
+            pass  # raised to the next sender
+        finally:
+            self._writer = None
+
+    def _write_buffered(self):
+        if not self._outbuf:
+            return
+        outbuf = self._outbuf
+        self._outbuf = []
+        data = outbuf[0] if len(outbuf) == 1 else b"".join(outbuf)
+        size = len(data)
+        if self._deflater is not None:
+            data = self._deflater.compress(data)
+            data += self._deflater.flush(self._compress_flush)
+        try:
+            self.sock.sendall(data)
+        except OSError:
+            self._send_exc_info = sys.exc_info()
+            self._outbuf = []
+            self._outsize = 0
+            raise
+        else:
+            self.write_count += 1
+            self._outsize -= size
+        finally:
+            if self._outsize <= self.send_low_water:
+                self._drained.set()
+
+    @property
+    def compressed(self):
+        return self._deflater is not None
+
+    def compress(self, level=COMPRESS_LEVEL, flush_mode=zlib.Z_SYNC_FLUSH):
+        """
+        Start XEP-0138 zlib compression in both directions: call it once
+        <compressed/> is sent or received, then restart the stream. Anything
+        still queued is written uncompressed first. Compression lasts for the
+        rest of the connection, across reset().
+
+        ``level`` is the zlib compression level. Every write is flushed with
+        ``flush_mode``, so that the peer can parse it right away: Z_SYNC_FLUSH,
+        or Z_FULL_FLUSH, which also resets the compression history, at the
+        cost of compressing worse.
+        """
+        if flush_mode not in (zlib.Z_SYNC_FLUSH, zlib.Z_FULL_FLUSH):
+            raise ValueError("flush_mode must be Z_SYNC_FLUSH or Z_FULL_FLUSH")
+        if self._deflater is not None:
+            raise RuntimeError("the stream is already compressed")
+        self.flush()
+        self._deflater = zlib.compressobj(level)
+        self._inflater = zlib.decompressobj()
+        self._compress_flush = flush_mode
 
     def reset(self):
         self.started = False
+        self._reset_parser()
         while True:
             try:
                 self._events.get_nowait()
             except queue.Empty:
                 break
+        self._resume.set()
         self._shutdown.clear()
         self._running = False
+        self._send_exc_info = None
         exc_info = self._exc_info
         self._exc_info = None
         return exc_info
@@ -152,12 +772,7 @@ class XMLStream(BaseXMLStream):
         self.started = True
 
     def handle_element(self, elem):
-        try:
-            self._events.put_nowait(elem)
-        except queue.Full:
-            raise RuntimeError(
-                "Event queue exceeded {} items".format(MAX_EVENT_QUEUE)
-            )
+        self._events.put_nowait(elem)
 
     def handle_parse_error(self, exc_type, exc_value, exc_traceback):
         self._shutdown.set()
@@ -0,0 +1,60 @@
+# limits.py defines the resource limits parser engines enforce on stanzas
+from lxml import etree
+
+MAX_STANZA_SIZE = 2 ** 18
+MAX_DEPTH = 64
+MAX_ATTRIBUTES = 64
+MAX_TEXT_SIZE = 2 ** 17
+
+
+class PolicyViolation(etree.ParseError):
+    """
+    Raised by parser engines when a peer exceeds one of the StreamLimits.
+    ``limit`` is the name of the limit that was exceeded. The stream should
+    be closed with a ``condition`` stream error.
+    """
+
+    condition = "policy-violation"
+
+    def __init__(self, limit, value):
+        super().__init__("stanza exceeds {} of {}".format(limit, value), 0, 0, 0)
+        self.limit = limit
+
+
+class StreamLimits:
+    """
+    Per-stream limits on incoming stanzas, checked while they are parsed:
+
+    - ``max_stanza_size``: the size of a stanza. The target and pull engines
+      count the length of its element names, attribute names and values and
+      text, the raw engine the bytes it takes on the wire.
+    - ``max_depth``: how deeply elements nest, the stanza itself being 1.
+    - ``max_attributes``: attributes per element, namespace declarations not
+      included. Also applies to the stream header.
+    - ``max_text``: the length of a single run of character data.
+    """
+
+    __slots__ = ("max_stanza_size", "max_depth", "max_attributes", "max_text")
+
+    def __init__(
+        self,
+        max_stanza_size=MAX_STANZA_SIZE,
+        max_depth=MAX_DEPTH,
+        max_attributes=MAX_ATTRIBUTES,
+        max_text=MAX_TEXT_SIZE,
+    ):
+        self.max_stanza_size = max_stanza_size
+        self.max_depth = max_depth
+        self.max_attributes = max_attributes
+        self.max_text = max_text
+
+    def __repr__(self):
+        return (
+            "StreamLimits(max_stanza_size={}, max_depth={}, max_attributes={}, "
+            "max_text={})".format(
+                self.max_stanza_size,
+                self.max_depth,
+                self.max_attributes,
+                self.max_text,
+            )
+        )
@@ -0,0 +1,367 @@
+# raw.py implements a passthrough parser engine that delimits top-level
+# elements without building element trees for them
+import re
+
+from lxml import etree
+
+from gxmpp.xmlstream.limits import PolicyViolation
+
+MAX_MARKUP_SIZE = 2 ** 20  # longest incomplete tag, comment or CDATA section
+
+# character data followed by a tag, or by the opening of a comment, CDATA
+# section, PI or markup declaration, whose end is then searched for
+_MARKUP_RE = re.compile(
+    rb"([^<]*)<(?:(/?)([^\s/>\"'!?]+)((?:[^>\"']|\"[^\"]*\"|'[^']*')*?)(/?)>"
+    rb"|(!--|!\[CDATA\[|\?|!))"
+)
+_MARKUP_ENDS = {b"!--": b"-->", b"![CDATA[": b"]]>", b"?": b"?>"}
+_ATTR_RE = re.compile(r"\s+([^\s=/>]+)\s*=\s*(?:\"([^\"<]*)\"|'([^'<]*)')")
+_ATTRS_RE = re.compile(rb"(?:\s+[^\s=/>]+\s*=\s*(?:\"[^\"<]*\"|'[^'<]*'))*\s*\Z")
+_ATTR_NAME_RE = re.compile(rb"\s+([^\s=/>]+)\s*=\s*(?:\"[^\"]*\"|'[^']*')")
+_REF_RE = re.compile(r"&(?:#x([0-9a-fA-F]+)|#([0-9]+)|(lt|gt|amp|quot|apos));")
+_ENTITIES = {"lt": "<", "gt": ">", "amp": "&", "quot": '"', "apos": "'"}
+_XML_NS = "http://www.w3.org/XML/1998/namespace"
+
+
+def _unref(m):
+    hexa, dec, name = m.groups()
+    if name:
+        return _ENTITIES[name]
+    return chr(int(hexa, 16) if hexa else int(dec))
+
+
+def _quote(value):
+    value = value.replace("&", "&amp;").replace("'", "&apos;").replace("<", "&lt;")
+    return b"'" + value.encode("utf-8") + b"'"
+
+
+def _syntax_error(msg):
+    return etree.XMLSyntaxError(msg, 0, 0, 0)
+
+
+def _count_attrs(attrs):
+    return sum(
+        1
+        for name in _ATTR_NAME_RE.findall(attrs)
+        if name != b"xmlns" and not name.startswith(b"xmlns:")
+    )
+
+
+class RawStanza:
+    """
+    A top-level stream element as received. ``raw`` holds its bytes, which
+    can be forwarded without re-serializing. ``tag`` (in Clark notation) and
+    ``attrib`` are parsed from its start tag on first access, and the element
+    tree is only built when ``element`` is first accessed.
+
+    The raw bytes do not repeat namespace declarations made on the stream
+    header, so they are only meaningful within the namespace context of a
+    stream; ``element`` takes care of that.
+    """
+
+    __slots__ = ("raw", "_name", "_attrs", "_context", "_tag", "_attrib", "_element")
+
+    def __init__(self, raw, name, attrs, context):
+        self.raw = raw
+        self._name = name
+        self._attrs = attrs
+        self._context = context  # (nsmap, nsdecl) of the stream header
+        self._tag = None
+        self._attrib = None
+        self._element = None
+
+    @property
+    def tag(self):
+        if self._tag is None:
+            self._parse_head()
+        return self._tag
+
+    @property
+    def attrib(self):
+        if self._attrib is None:
+            self._parse_head()
+        return self._attrib
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+    def _parse_head(self):
+        nsmap = self._context[0]
+        attrib = {}
+        pending = []
+        for key, dq, sq in _ATTR_RE.findall(self._attrs.decode("utf-8")):
+            value = dq or sq
+            if "&" in value:
+                value = _REF_RE.sub(_unref, value)
+            if key == "xmlns" or key.startswith("xmlns:"):
+                if nsmap is self._context[0]:
+                    nsmap = dict(nsmap)
+                nsmap[key[6:] or None] = value
+            else:
+                pending.append((key, value))
+        for key, value in pending:
+            prefix, _, local = key.rpartition(":")
+            if prefix:
+                ns = _XML_NS if prefix == "xml" else nsmap.get(prefix)
+                if ns is None:
+                    raise _syntax_error(
+                        "undeclared namespace prefix {!r}".format(prefix)
+                    )
+                key = "{" + ns + "}" + local
+            attrib[key] = value
+        prefix, _, local = self._name.decode("utf-8").rpartition(":")
+        ns = nsmap.get(prefix or None)
+        if prefix and ns is None:
+            raise _syntax_error("undeclared namespace prefix {!r}".format(prefix))
+        self._tag = local if ns is None else "{" + ns + "}" + local
+        self._attrib = attrib
+
+    @property
+    def element(self):
+        """
+        The element tree of this stanza, parsed on first access. Raises
+        XMLSyntaxError if the stanza is not well-formed.
+        """
+        if self._element is None:
+            wrapper = etree.fromstring(
+                b"<w" + self._context[1] + b">" + self.raw + b"</w>"
+            )
+            # detaching the element from the wrapper would make lxml rename
+            # the inherited default namespace, so the wrapper stays its parent
+            self._element = wrapper[0]
+        return self._element
+
+    def __repr__(self):
+        return "<RawStanza {} ({} bytes) at {}>".format(
+            self.tag, len(self.raw), hex(id(self))
+        )
+
+
+class RawParser:
+    """
+    A parser engine that scans the stream for the boundaries of top-level
+    elements and hands them to the stream as RawStanza objects. Only the
+    stream header and the start tag of each stanza are parsed; the contents
+    of stanzas are checked for balanced tags, but are otherwise not
+    validated until RawStanza.element is accessed.
+    """
+
+    __slots__ = (
+        "stream",
+        "limits",
+        "depth",
+        "root",
+        "_buf",
+        "_pos",
+        "_names",
+        "_start",
+        "_head",
+        "_context",
+        "_closed",
+        "_markup_end",
+        "_markup_pos",
+    )
+
+    def __init__(self, stream, limits):
+        self.stream = stream
+        self.limits = limits
+        self.depth = 0
+        self.root = None
+        self._buf = bytearray()
+        self._pos = 0
+        self._names = []
+        self._start = 0
+        self._head = None
+        self._context = ({}, b"")
+        self._closed = False
+        # the terminator of the comment, CDATA section or PI open at _pos,
+        # and where to search for it from
+        self._markup_end = None
+        self._markup_pos = 0
+
+    def feed(self, data):
+        if self._closed:
+            raise _syntax_error("Extra content at the end of the document")
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._buf += data
+        try:
+            self._scan()
+        except etree.ParseError:
+            self.close()
+            raise
+        finally:
+            # drop everything that is not part of a pending stanza or tag
+            keep = self._start if self.depth > 1 else self._pos
+            if keep:
+                del self._buf[:keep]
+                self._pos -= keep
+                self._start -= keep
+                self._markup_pos -= keep
+
+    def _scan(self):
+        buf = self._buf
+        names = self._names
+        limits = self.limits
+        pos = self._pos
+        while True:
+            if self._markup_end is not None and not self._skip_markup():
+                break
+            pos = self._pos
+            m = _MARKUP_RE.match(buf, pos)
+            if m is None:
+                break  # incomplete markup at pos, or no more of it
+            end_slash, name = m.group(2, 3)
+            if self.depth <= 1:
+                self._check_text(m.start(), m.end(1))
+            elif m.end(1) - m.start() > limits.max_text:
+                raise PolicyViolation("max_text", limits.max_text)
+            if name is None:  # comment, CDATA section, PI or declaration
+                if not self._open_markup(m):
+                    break
+                continue
+            self._pos = pos = end = m.end()
+            if end_slash:
+                if not names or names.pop() != name:
+                    raise _syntax_error("Opening and ending tag mismatch")
+                self.depth -= 1
+                if self.depth == 1:
+                    self._check_size(end)
+                    self._stanza(end)
+                elif self.depth == 0:
+                    self._closed = True
+                    self.stream.handle_stream_end()
+                    self._check_text(end, len(buf))
+                    return
+                continue
+            attrs = m.group(4)
+            if (
+                attrs.count(b"=") > limits.max_attributes
+                and _count_attrs(attrs) > limits.max_attributes
+            ):
+                raise PolicyViolation("max_attributes", limits.max_attributes)
+            if self.depth > limits.max_depth:
+                raise PolicyViolation("max_depth", limits.max_depth)
+            if self.depth == 0:
+                if m.group(5):
+                    raise _syntax_error("empty stream")
+                self._check_attrs(m)
+                self._stream_start(m)
+            elif self.depth == 1:
+                # the buffer may be compacted before the stanza is complete,
+                # so the groups must be copied out of it now
+                self._check_attrs(m)
+                self._start = m.end(1)
+                self._head = m.group(3, 4)
+            if m.group(5):  # self-closing
+                if self.depth == 1:
+                    self._check_size(end)
+                    self._stanza(end)
+                continue
+            names.append(name)
+            self.depth += 1
+        pos = self._pos
+        lt = pos if self._markup_end is not None else buf.find(b"<", pos)
+        if self.depth <= 1:
+            self._check_text(pos, len(buf) if lt == -1 else lt)
+            if lt == -1:
+                self._pos = len(buf)
+            elif self.depth == 1 and len(buf) - lt > limits.max_stanza_size:
+                raise PolicyViolation("max_stanza_size", limits.max_stanza_size)
+        else:
+            if (len(buf) if lt == -1 else lt) - pos > limits.max_text:
+                raise PolicyViolation("max_text", limits.max_text)
+            self._check_size(len(buf))
+        if lt != -1 and len(buf) - lt > MAX_MARKUP_SIZE:
+            raise _syntax_error("markup exceeds {} bytes".format(MAX_MARKUP_SIZE))
+
+    def _open_markup(self, m):
+        opening = m.group(6)
+        if opening == b"!":
+            # a markup declaration such as <!DOCTYPE, unless more data makes
+            # it the opening of a comment or CDATA section
+            rest = bytes(self._buf[m.end() : m.end() + 7])
+            if b"--".startswith(rest) or b"[CDATA[".startswith(rest):
+                self._pos = m.end(1)
+                return False
+            raise _syntax_error("markup declarations are not allowed")
+        if opening == b"![CDATA[" and self.depth <= 1:
+            raise _syntax_error("CDATA section outside of an element")
+        self._pos = m.end(1)
+        self._markup_end = _MARKUP_ENDS[opening]
+        self._markup_pos = m.end()
+        return True
+
+    def _skip_markup(self):
+        # search the rest of the comment, CDATA section or PI open at _pos for
+        # its end, from where the previous search stopped
+        buf = self._buf
+        term = self._markup_end
+        end = buf.find(term, self._markup_pos)
+        if end == -1:
+            # the terminator may have been received in part
+            end = self._markup_pos = max(self._markup_pos, len(buf) - len(term) + 1)
+            if term == b"]]>" and end - self._pos - 9 > self.limits.max_text:
+                raise PolicyViolation("max_text", self.limits.max_text)
+            return False
+        if term == b"]]>" and end - self._pos - 9 > self.limits.max_text:
+            raise PolicyViolation("max_text", self.limits.max_text)
+        self._pos = end + len(term)
+        self._markup_end = None
+        return True
+
+    @staticmethod
+    def _check_attrs(m):
+        if not _ATTRS_RE.match(m.group(4)):
+            raise _syntax_error("malformed attributes in {!r}".format(m.group()))
+
+    def _check_text(self, start, end):
+        if self._buf[start:end].strip():
+            if self._closed:
+                raise _syntax_error("Extra content at the end of the document")
+            if self.depth == 0:
+                raise _syntax_error("Start tag expected, '<' not found")
+            # character data between stanzas is ignored, like ParseTarget does
+
+    def _check_size(self, end):
+        if end - self._start > self.limits.max_stanza_size:
+            raise PolicyViolation("max_stanza_size", self.limits.max_stanza_size)
+
+    def _stream_start(self, m):
+        start_tag = bytes(m.string[m.end(1) : m.end() - 1])
+        head = etree.fromstring(start_tag + b"></" + m.group(3) + b">")
+        self.root = head
+        nsmap = dict(head.nsmap)
+        nsdecl = b"".join(
+            b" xmlns" + (b":" + p.encode("utf-8") if p else b"") + b"=" + _quote(ns)
+            for p, ns in nsmap.items()
+        )
+        self._context = (nsmap, nsdecl)
+        self.stream.handle_stream_start(etree.Element(head.tag, head.attrib))
+
+    def _stanza(self, end):
+        name, attrs = self._head
+        raw = bytes(self._buf[self._start : end])
+        self._start = end
+        self._head = None
+        self.stream.handle_element(RawStanza(raw, name, attrs, self._context))
+
+    def reset(self):
+        self.depth = 0
+        self.root = None
+        del self._buf[:]
+        self._pos = 0
+        self._names.clear()
+        self._start = 0
+        self._head = None
+        self._context = ({}, b"")
+        self._closed = False
+        self._markup_end = None
+        self._markup_pos = 0
+
+    def close(self):
+        self.depth = 0
+        self.root = None
+        self._closed = True
+        self._names = []
+        self.stream.handle_close()
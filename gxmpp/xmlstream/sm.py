@@ -0,0 +1,322 @@
+# sm.py implements XEP-0198 stream management on top of XMLStream
+import re
+
+import gevent
+from gevent import event
+
+from gxmpp.xmlstream import XMLStream, _serialize, template
+
+SM_BUFFER = 256  # default capacity of the unacked stanza buffer
+SM_ACK_EVERY = 16  # default stanzas sent between ack requests
+SM_ACK_INTERVAL = 5.0  # default seconds before unacked stanzas are requested
+_MOD = 2 ** 32  # stanza counters wrap around at 2**32
+
+_STANZAS = ("message", "presence", "iq")
+_SM_TAG = "{" + template.NS_SM + "}"
+_STANZA_RE = re.compile(rb"\s*<(?:[^\s/>:]+:)?(?:message|presence|iq)[\s/>]")
+_COUNT_RE = re.compile(r"[0-9]{1,10}\Z")  # an xs:unsignedInt, range aside
+
+
+class RingBuffer:
+    """
+    A fixed-size FIFO buffer. Items are appended at the end and dropped from
+    the start without moving the rest.
+    """
+
+    __slots__ = ("_items", "_head", "_len")
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self._items = [None] * capacity
+        self._head = 0
+        self._len = 0
+
+    @property
+    def capacity(self):
+        return len(self._items)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        items = self._items
+        capacity = len(items)
+        for i in range(self._head, self._head + self._len):
+            yield items[i % capacity]
+
+    def full(self):
+        return self._len == len(self._items)
+
+    def append(self, item):
+        """
+        Append ``item``, raising OverflowError if the buffer is full.
+        """
+        items = self._items
+        if self._len == len(items):
+            raise OverflowError("ring buffer is full")
+        items[(self._head + self._len) % len(items)] = item
+        self._len += 1
+
+    def drop(self, n):
+        """
+        Drop the ``n`` oldest items.
+        """
+        if not 0 <= n <= self._len:
+            raise ValueError("cannot drop {} of {} items".format(n, self._len))
+        items = self._items
+        capacity = len(items)
+        for i in range(self._head, self._head + n):
+            items[i % capacity] = None
+        self._head = (self._head + n) % capacity
+        self._len -= n
+
+    def clear(self):
+        self.drop(self._len)
+
+
+class StreamManagementError(Exception):
+    """
+    Raised by run() when the peer breaks XEP-0198, e.g. by acknowledging
+    stanzas that were never sent. The stream should be closed with a
+    ``condition`` stream error.
+    """
+
+    condition = "undefined-condition"
+
+
+def _is_stanza(data):
+    return _STANZA_RE.match(data) is not None
+
+
+class ManagedXMLStream(XMLStream):
+    """
+    An XMLStream with XEP-0198 stream management. Once enable() has been
+    called, stanzas passed to send() are kept in ``unacked``, a RingBuffer
+    of ``buffer_size`` serialized stanzas, until the peer acknowledges them.
+    send() takes a single stanza at a time, and blocks while the buffer is
+    full, so another greenlet must be running run() for acks to come in.
+
+    Acks are requested with <r/> after every ``ack_every`` stanzas, or
+    ``ack_interval`` seconds after a stanza was sent, whichever comes first.
+    Requests from the peer are answered once the data they came in has been
+    parsed; neither they nor acks are returned by run(). <enabled/>,
+    <resumed/> and <failed/> are, once they have been handled.
+
+    The stream management state survives reset(). To resume the session on
+    a new connection, set ``sock``, restart the stream, authenticate and
+    call resume(): once the peer confirms it with <resumed/>, the stanzas it
+    has not received are sent again.
+    """
+
+    __slots__ = (
+        "buffer_size",
+        "ack_every",
+        "ack_interval",
+        "sm_enabled",
+        "sm_id",
+        "sm_max",
+        "inbound",
+        "unacked",
+        "_acked",
+        "_counting",
+        "_unrequested",
+        "_requester",
+        "_not_full",
+        "_ack_requested",
+        "_resend_pending",
+    )
+
+    def __init__(
+        self,
+        *args,
+        buffer_size=SM_BUFFER,
+        ack_every=SM_ACK_EVERY,
+        ack_interval=SM_ACK_INTERVAL,
+        **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.buffer_size = buffer_size
+        self.ack_every = ack_every
+        self.ack_interval = ack_interval
+        self.sm_enabled = False
+        self.sm_id = None  # the id to resume the session with
+        self.sm_max = None  # seconds the peer keeps the session for
+        self.inbound = 0  # stanzas handled, as reported to the peer
+        self.unacked = RingBuffer(buffer_size)
+        self._acked = 0  # stanzas sent that the peer acknowledged
+        self._counting = False  # whether inbound stanzas are counted
+        self._unrequested = 0  # stanzas sent since the last ack request
+        self._requester = None
+        self._not_full = event.Event()
+        self._not_full.set()
+        # answered and done once the data being parsed has been handled, as
+        # sending from parser callbacks could block the reader
+        self._ack_requested = False
+        self._resend_pending = False
+
+    @property
+    def outbound(self):
+        """
+        The number of stanzas sent, modulo 2**32.
+        """
+        return (self._acked + len(self.unacked)) % _MOD
+
+    def enable(self, resume=True, max_resume=None):
+        """
+        Ask the peer to enable stream management, and to allow resuming the
+        session for up to ``max_resume`` seconds if ``resume`` is set. Stanzas
+        left unacked by a previous session are dropped.
+        """
+        self.unacked.clear()
+        self._not_full.set()
+        self._acked = 0
+        self._unrequested = 0
+        self.sm_enabled = True
+        self.sm_id = None
+        super().send(
+            template.SM_ENABLE.render(
+                resume="true" if resume else None,
+                max=None if max_resume is None else str(max_resume),
+            )
+        )
+
+    def resume(self):
+        """
+        Ask the peer to resume the previous session on this stream.
+        """
+        if self.sm_id is None:
+            raise RuntimeError("there is no session to resume")
+        super().send(
+            template.SM_RESUME.render(previd=self.sm_id, h=str(self.inbound))
+        )
+
+    def request_ack(self):
+        """
+        Ask the peer to acknowledge the stanzas it has received, if any are
+        unacked.
+        """
+        self._unrequested = 0
+        if self.unacked:
+            super().send(template.SM_REQUEST.render())
+
+    def send(self, stanza):
+        data = _serialize(stanza)
+        if not self.sm_enabled or not _is_stanza(data):
+            return super().send(data)
+        while self.unacked.full():
+            self._not_full.clear()
+            if self._unrequested:
+                self.request_ack()
+            self._not_full.wait()
+        super().send(data)
+        self.unacked.append(data)
+        self._unrequested += 1
+        if self._unrequested >= self.ack_every:
+            self.request_ack()
+        elif self._requester is None:
+            self._requester = gevent.spawn_later(self.ack_interval, self._request)
+
+    def _request(self):
+        self._requester = None
+        if self._unrequested:
+            try:
+                self.request_ack()
+            except OSError:
+                pass  # raised to the next sender
+
+    def _error(self, msg):
+        exc = StreamManagementError(msg)
+        self.handle_parse_error(type(exc), exc, None)
+
+    def _parse_h(self, elem):
+        h = elem.get("h")
+        if h is None or not _COUNT_RE.match(h) or int(h) >= _MOD:
+            self._error("invalid h attribute {!r}".format(h))
+            return None
+        return int(h)
+
+    def _ack(self, elem):
+        """
+        Drop the stanzas acknowledged by the h attribute of ``elem``. Returns
+        False if the ack was reported as an error instead.
+        """
+        h = self._parse_h(elem)
+        if h is None:
+            return False
+        n = (h - self._acked) % _MOD
+        if n > len(self.unacked):
+            self._error(
+                "peer acknowledged {} stanzas, but only {} are unacked".format(
+                    n, len(self.unacked)
+                )
+            )
+            return False
+        self.unacked.drop(n)
+        self._acked = h
+        self._not_full.set()
+        return True
+
+    def _feed(self, data):
+        super()._feed(data)
+        if self._shutdown.is_set() or self._send_exc_info:
+            return  # the stream is done, or the next sender raises the error
+        if self._resend_pending:
+            self._resend_pending = False
+            self._resend()
+        if self._ack_requested:
+            self._ack_requested = False
+            self._enqueue(template.SM_ACK.render(h=str(self.inbound)))
+
+    def handle_element(self, elem):
+        tag = elem.tag
+        if not tag.startswith(_SM_TAG):
+            if self._counting and tag.rpartition("}")[2] in _STANZAS:
+                self.inbound = (self.inbound + 1) % _MOD
+            super().handle_element(elem)
+            return
+        name = tag[len(_SM_TAG) :]
+        if name == "r":
+            self._ack_requested = True
+            return
+        if name == "a":
+            self._ack(elem)
+            return
+        if name == "enabled":
+            self._counting = True
+            self.inbound = 0
+            if elem.get("resume") in ("true", "1"):
+                self.sm_id = elem.get("id")
+            max_ = elem.get("max")
+            self.sm_max = int(max_) if max_ and _COUNT_RE.match(max_) else None
+        elif name == "resumed":
+            if not self._ack(elem):
+                return  # raised by run() instead
+            self._resend_pending = True
+        elif name == "failed":
+            # stanzas the peer did not acknowledge are left in unacked, for
+            # the caller to send again on a new session
+            self.sm_enabled = False
+            self.sm_id = None
+            self._counting = False
+            if elem.get("h") is not None and not self._ack(elem):
+                return
+        super().handle_element(elem)
+
+    def _resend(self):
+        # at most buffer_size stanzas, buffered without waiting for room
+        pending = list(self.unacked)
+        self._unrequested = 0
+        for data in pending:
+            self._enqueue(data)
+        if pending:
+            self._enqueue(template.SM_REQUEST.render())
+
+    def reset(self):
+        # no ack requests are sent before the session is resumed
+        if self._requester is not None:
+            self._requester.kill()
+            self._requester = None
+        self._ack_requested = False
+        self._resend_pending = False
+        return super().reset()
@@ -0,0 +1,225 @@
+# template.py implements pre-rendered stanza templates
+import copy
+import re
+
+from lxml import etree
+
+# the characters lxml refuses in attribute values and text
+_INVALID_CHARS_RE = re.compile(
+    "[^\t\n\r\x20-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]"
+)
+_MARKER = 0xF0000  # private use plane, marks slots while a template is rendered
+
+_ATTR = 0
+_TEXT = 1
+
+MAX_FORMATS = 64  # combinations of slots a template caches a format string for
+
+# slots for the attributes every stanza has
+STANZA_SLOTS = {"to": (None, "to"), "from_": (None, "from"), "id": (None, "id")}
+
+
+def _check(value):
+    if _INVALID_CHARS_RE.search(value):
+        raise ValueError(
+            "All strings must be XML compatible: Unicode or ASCII, no NULL bytes "
+            "or control characters"
+        )
+
+
+def escape_attr(value):
+    """
+    Escape ``value`` for a double-quoted attribute value like etree.tostring()
+    does, except for non-ASCII characters, which are left to be encoded.
+    """
+    if "&" in value:
+        value = value.replace("&", "&amp;")
+    if "<" in value:
+        value = value.replace("<", "&lt;")
+    if ">" in value:
+        value = value.replace(">", "&gt;")
+    if '"' in value:
+        value = value.replace('"', "&quot;")
+    if not value.isprintable():
+        _check(value)
+        value = value.replace("\n", "&#10;").replace("\r", "&#13;")
+        value = value.replace("\t", "&#9;")
+    return value
+
+
+def escape_text(value):
+    """
+    Escape ``value`` for character data like etree.tostring() does, except
+    for non-ASCII characters, which are left to be encoded.
+    """
+    if "&" in value:
+        value = value.replace("&", "&amp;")
+    if "<" in value:
+        value = value.replace("<", "&lt;")
+    if ">" in value:
+        value = value.replace(">", "&gt;")
+    if not value.isprintable():
+        _check(value)
+        value = value.replace("\r", "&#13;")
+    return value
+
+
+class StanzaTemplate:
+    """
+    A stanza pre-rendered into fragments, with slots that render() fills by
+    escaping and concatenation, without building or serializing a tree. The
+    result is identical to etree.tostring() of ``elem`` with the slots set.
+
+    ``slots`` maps slot names to ``(path, attribute)`` pairs. ``path`` finds
+    the element the slot belongs to with ``elem.find()``, or is None for
+    ``elem`` itself. ``attribute`` is the name of the attribute the slot
+    sets, or None for a slot setting the text of the element.
+    """
+
+    __slots__ = ("slots", "_parts", "_tail", "_formats")
+
+    def __init__(self, elem, slots=STANZA_SLOTS):
+        self.slots = dict(slots)
+        proto = copy.deepcopy(elem)
+        proto.tail = None
+        markers = {}
+        for i, (name, (path, attr)) in enumerate(self.slots.items()):
+            target = proto if path is None else proto.find(path)
+            if target is None:
+                raise ValueError(
+                    "no element at {!r} for slot {!r}".format(path, name)
+                )
+            marker = chr(_MARKER + i)
+            if attr is None:
+                target.text = marker
+                markers[name] = (_TEXT, len(target) == 0)
+            else:
+                target.set(attr, marker)
+                markers[name] = (_ATTR, None)
+        # etree.tostring() output is ASCII
+        rendered = etree.tostring(proto).decode("ascii")
+        found = []
+        for i, name in enumerate(self.slots):
+            marker = "&#{};".format(_MARKER + i)
+            if rendered.count(marker) != 1:
+                raise ValueError("elem must not contain {!r}".format(marker))
+            start = rendered.index(marker)
+            found.append((start, start + len(marker), name))
+        found.sort()
+        # (literal, name, kind, extra): the literal preceding a slot, then the
+        # slot; extra is ' name="' for attributes, and the close tag or None
+        # for text
+        parts = []
+        pos = 0
+        for start, end, name in found:
+            kind, childless = markers[name]
+            if kind == _ATTR:
+                # ' name="' precedes the marker and '"' follows it
+                space = rendered.rindex(" ", pos, start)
+                parts.append((rendered[pos:space], name, kind, rendered[space:start]))
+                pos = end + 1
+            else:
+                # the start tag ends with '>' right before the marker, and the
+                # close tag follows it unless the element has children
+                close = None
+                if childless:
+                    close = rendered[end : rendered.index(">", end) + 1]
+                parts.append((rendered[pos : start - 1], name, kind, close))
+                pos = end + len(close or "")
+        self._parts = parts
+        self._tail = rendered[pos:]
+        self._formats = {}
+
+    def render(self, **values):
+        """
+        Return the serialized stanza, with slots set to the keyword arguments
+        of the same name. Attribute slots that are not given, or None, are
+        left out, as are text slots, which then render as an empty element.
+        """
+        try:
+            fmt, escapes = self._formats[tuple(values)]
+        except KeyError:
+            fmt, escapes = self._compile(values)
+        try:
+            out = fmt % tuple([escape(values[name]) for name, escape in escapes])
+        except TypeError:
+            if None not in values.values():
+                raise
+            return self.render(**{k: v for k, v in values.items() if v is not None})
+        # one pass for the character references of non-ASCII characters
+        return out.encode("ascii", "xmlcharrefreplace")
+
+    def _compile(self, names):
+        # a format string for rendering the slots in names and leaving out
+        # the others, cached by the order the slots were passed in
+        fmt = []
+        escapes = []
+        for literal, name, kind, extra in self._parts:
+            fmt.append(literal)
+            if name not in names:
+                if kind == _TEXT:
+                    fmt.append(">" if extra is None else "/>")
+            elif kind == _ATTR:
+                fmt.append(extra + '\0"')
+                escapes.append((name, escape_attr))
+            else:
+                fmt.append(">\0" + (extra or ""))
+                escapes.append((name, escape_text))
+        fmt.append(self._tail)
+        fmt = "".join(fmt).replace("%", "%%").replace("\0", "%s")
+        escapes = tuple(escapes)
+        if len(self._formats) < MAX_FORMATS:
+            self._formats[tuple(names)] = (fmt, escapes)
+        return fmt, escapes
+
+
+def _stanza(xml, **slots):
+    return StanzaTemplate(etree.fromstring(xml), dict(STANZA_SLOTS, **slots))
+
+
+NS_PING = "urn:xmpp:ping"
+NS_RECEIPTS = "urn:xmpp:receipts"
+NS_CHATSTATES = "http://jabber.org/protocol/chatstates"
+NS_COMPRESS = "http://jabber.org/protocol/compress"
+NS_SM = "urn:xmpp:sm:3"
+
+PRESENCE = _stanza("<presence/>", type=(None, "type"))
+CHAT = _stanza("<message type='chat'><body/></message>", body=("body", None))
+# XEP-0199
+PING = _stanza("<iq type='get'><ping xmlns='urn:xmpp:ping'/></iq>")
+IQ_RESULT = _stanza("<iq type='result'/>")
+# XEP-0184
+RECEIPT = _stanza(
+    "<message><received xmlns='urn:xmpp:receipts'/></message>",
+    receipt_id=("{urn:xmpp:receipts}received", "id"),
+)
+# XEP-0138
+COMPRESS = StanzaTemplate(
+    etree.fromstring(
+        "<compress xmlns='{}'><method>zlib</method></compress>".format(NS_COMPRESS)
+    ),
+    {},
+)
+COMPRESSED = StanzaTemplate(
+    etree.fromstring("<compressed xmlns='{}'/>".format(NS_COMPRESS)), {}
+)
+# XEP-0198
+SM_ENABLE = StanzaTemplate(
+    etree.fromstring("<enable xmlns='{}'/>".format(NS_SM)),
+    {"resume": (None, "resume"), "max": (None, "max")},
+)
+SM_REQUEST = StanzaTemplate(etree.fromstring("<r xmlns='{}'/>".format(NS_SM)), {})
+SM_ACK = StanzaTemplate(
+    etree.fromstring("<a xmlns='{}'/>".format(NS_SM)), {"h": (None, "h")}
+)
+SM_RESUME = StanzaTemplate(
+    etree.fromstring("<resume xmlns='{}'/>".format(NS_SM)),
+    {"previd": (None, "previd"), "h": (None, "h")},
+)
+# XEP-0085
+CHAT_STATES = {
+    state: _stanza(
+        "<message type='chat'><{} xmlns='{}'/></message>".format(state, NS_CHATSTATES)
+    )
+    for state in ("active", "composing", "paused", "inactive", "gone")
+}
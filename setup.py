@@ -28,7 +28,7 @@ setup(
     author="auri",
     author_email="me@aurieh.me",
     license="LGPL-3.0",
-    packages=["gxmpp", "gxmpp.util"],
+    packages=["gxmpp", "gxmpp.util", "gxmpp.xmlstream"],
     install_requires=[
         "gevent>=20.5.0",
         "gevent[dnspython]",
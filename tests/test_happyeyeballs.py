@@ -0,0 +1,160 @@
+import gevent
+import pytest
+from gevent import socket, time
+
+from gxmpp.resolver import Candidate, TargetScoreboard
+from gxmpp.util.happyeyeballs import _interleave, race_connect
+
+
+def _listener(family=socket.AF_INET, backlog=16):
+    sock = socket.socket(family)
+    sock.bind(("::1" if family == socket.AF_INET6 else "127.0.0.1", 0))
+    sock.listen(backlog)
+    return sock
+
+
+def _dead_listener():
+    # a listener whose accept queue is full, so that connecting to it hangs
+    # like connecting to a host that is down
+    sock = _listener(backlog=0)
+    filler = socket.create_connection(sock.getsockname())
+    return sock, filler
+
+
+def _closed_port():
+    sock = _listener()
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_interleave():
+    candidates = [
+        ("10.0.0.1", "fd00::1", 5223, True),
+        ("10.0.0.2", None, 5222, False),
+        ("10.0.0.3", None, 5222, False),
+        (None, "fd00::4", 5222, False),
+    ]
+    order = [(family, addr[0]) for family, addr, _ in _interleave(candidates)]
+    assert order == [
+        (socket.AF_INET6, "fd00::1"),
+        (socket.AF_INET, "10.0.0.1"),
+        (socket.AF_INET6, "fd00::4"),
+        (socket.AF_INET, "10.0.0.2"),
+        (socket.AF_INET, "10.0.0.3"),
+    ]
+    assert list(_interleave([])) == []
+
+
+def test_race_connect():
+    alive = _listener()
+    alive6 = _listener(socket.AF_INET6)
+    dead, filler = _dead_listener()
+    host, port = dead.getsockname()
+    try:
+        # a dead primary target costs attempt_delay rather than a timeout
+        candidates = [
+            (host, None, port, True),
+            ("127.0.0.1", None, alive.getsockname()[1], False),
+        ]
+        started = time.monotonic()
+        sock, candidate = race_connect(candidates, timeout=5, attempt_delay=0.05)
+        assert time.monotonic() - started < 0.5
+        assert candidate is candidates[1]
+        assert sock.getpeername() == alive.getsockname()
+        sock.close()
+
+        # a refused attempt starts the next one right away, and IPv6 goes
+        # first
+        candidates = [
+            ("127.0.0.1", "::1", _closed_port(), False),
+            (None, "::1", alive6.getsockname()[1], False),
+        ]
+        started = time.monotonic()
+        sock, candidate = race_connect(candidates, timeout=5, attempt_delay=1)
+        assert time.monotonic() - started < 0.5
+        assert candidate is candidates[1] and sock.family == socket.AF_INET6
+        sock.close()
+
+        # candidates are pulled lazily, as they are resolved
+        def lazy():
+            yield (host, None, port, False)
+            gevent.sleep(0.05)
+            yield ("127.0.0.1", None, alive.getsockname()[1], True)
+
+        sock, candidate = race_connect(lazy(), timeout=5, attempt_delay=0.01)
+        assert candidate[3] is True
+        sock.close()
+    finally:
+        for s in (alive, alive6, dead, filler):
+            s.close()
+
+
+def test_race_connect_failures():
+    with pytest.raises(socket.error) as excinfo:
+        race_connect([("127.0.0.1", None, _closed_port(), False)] * 2)
+    assert len(excinfo.value.args[0]) == 2
+    with pytest.raises(socket.error):
+        race_connect([])
+
+    dead, filler = _dead_listener()
+    try:
+        host, port = dead.getsockname()
+        started = time.monotonic()
+        with pytest.raises(socket.timeout):
+            race_connect([(host, None, port, False)], timeout=0.1)
+        assert time.monotonic() - started < 0.5
+    finally:
+        dead.close()
+        filler.close()
+
+    def broken():
+        yield ("127.0.0.1", None, _closed_port(), False)
+        raise ValueError("resolver blew up")
+
+    with pytest.raises(socket.error) as excinfo:
+        race_connect(broken())
+    assert isinstance(excinfo.value.args[0][-1][2], ValueError)
+
+
+def test_race_connect_attempts():
+    alive = _listener()
+    dead, filler = _dead_listener()
+    host, port = dead.getsockname()
+    refused = _closed_port()
+    try:
+        # a hanging attempt fails after connect_timeout, and the next one
+        # starts right away
+        candidates = [
+            Candidate((host, None, port), ("dead.lit", port)),
+            Candidate(("127.0.0.1", None, refused), ("refused.lit", refused)),
+            ("127.0.0.1", None, alive.getsockname()[1]),
+        ]
+        board = TargetScoreboard()
+        started = time.monotonic()
+        sock, candidate = race_connect(
+            candidates,
+            timeout=5,
+            attempt_delay=5,
+            connect_timeout=0.05,
+            scoreboard=board,
+        )
+        assert time.monotonic() - started < 0.5
+        assert candidate is candidates[2]
+        sock.close()
+        # failures are recorded for the SRV targets the candidates carry
+        assert board.get("dead.lit", port).consecutive_failures == 1
+        assert board.get("refused.lit", refused).consecutive_failures == 1
+        assert len(board) == 2
+
+        candidates = [
+            Candidate(("127.0.0.1", None, alive.getsockname()[1]), ("a.lit", 1))
+        ]
+        sock, candidate = race_connect(candidates, scoreboard=board)
+        assert candidate.target == ("a.lit", 1)
+        assert board.get("a.lit", 1).connect_time is not None
+        assert sock.gettimeout() is None
+        sock.close()
+    finally:
+        for s in (alive, dead, filler):
+            s.close()
@@ -1,8 +1,16 @@
+import gc
+import subprocess
+import sys
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
-from hypothesis import given
+from hypothesis import example, given, settings
 from hypothesis import strategies as strat
 
 from gxmpp import jid
+from gxmpp.util import xep0106
+from gxmpp.util.intern import InternTable
 
 
 def test_parse():
@@ -49,6 +57,15 @@ def test_dunders():
     j2 = jid.JID.create("porthos", "xn--zqs335k.lit")
     assert j1 == j2
     assert hash(j1) == hash(j2)
+    assert j1.key == j2.key == ("porthos", "xn--zqs335k.lit", None)
+    j3 = jid.JID.parse("porthos@[::1]/sword")
+    assert j3 != jid.JID.parse("porthos@[::1]")
+    assert j3.bare_jid == jid.JID.parse("porthos@[::1]")
+    assert hash(j3) == hash(j3)
+    j4 = jid.JID.parse("porthos@銃士.lit/sword")
+    assert j4.bare_jid is j1
+    assert j4.bare_jid.key == (j4.key[0], j4.key[1], None)
+    assert j1.bare_jid is j1
 
 
 _valid_xep_0106_ish = {
@@ -64,3 +81,151 @@ def test_xep_0106(localpart):
     ):  # we test this one separately in test_create
         return
     assert jid._unescape_localpart(jid._escape_localpart(localpart)) == localpart
+
+
+def test_interning():
+    jid.parse_cache.clear()
+    j1 = jid.JID.parse("athos@musketeers.lit/horse")
+    j2 = jid.JID.parse("athos@musketeers.lit/horse")
+    assert j1 is j2
+    info = jid.parse_cache.info()
+    assert (info.hits, info.misses) == (1, 1)
+
+    jid.parse_cache.resize(0)
+    assert jid.parse_cache.info().evictions == 1
+    # still alive through j1, so it must still be shared
+    assert jid.JID.parse("athos@musketeers.lit/horse") is j1
+    del j1, j2
+    assert (jid.JID, "athos@musketeers.lit/horse") not in jid.parse_cache
+    jid.parse_cache.resize(4096)
+
+    with pytest.raises(ValueError):
+        jid.JID.create("INVAL\u200BID", "example.org")
+    assert jid.JID.create("aramis", "musketeers.lit") is jid.JID.create(
+        "aramis", "musketeers.lit"
+    )
+
+
+def test_create_many():
+    parts = [
+        ("athos", "musketeers.lit"),
+        ("INVAL\u200BID", "example.org"),
+        ("Athos", "musketeers.lit", None),
+        ("porthos", "musketeers.lit", "sword"),
+        ("athos", "musketeers.lit"),
+        (42, "musketeers.lit"),
+    ]
+    for executor in (None, ThreadPoolExecutor(max_workers=2)):
+        jid.create_cache.clear()
+        results = jid.JID.create_many(parts, executor=executor, chunksize=2)
+        assert len(results) == len(parts)
+        assert results[0] is results[4] is jid.JID.create("athos", "musketeers.lit")
+        assert isinstance(results[1], ValueError)
+        assert results[2] == results[0]
+        assert str(results[3]) == "porthos@musketeers.lit/sword"
+        assert isinstance(results[5], TypeError)
+        assert jid.create_cache.info().misses == 3
+    streamed = list(jid.JID.validate_iter(iter(parts * 300)))
+    assert len(streamed) == 1800
+    assert isinstance(streamed[-5], ValueError)
+    expected = [results[i] for i in (0, 2, 3, 4)]
+    assert [streamed[i] for i in (-6, -4, -3, -2)] == expected
+
+
+def test_create_many_bad_entries():
+    parts = [
+        ("athos", "musketeers.lit"),
+        (["porthos"], "musketeers.lit"),
+        42,
+        ("aramis", "musketeers.lit"),
+    ]
+    results = jid.JID.create_many(parts)
+    assert str(results[0]) == "athos@musketeers.lit"
+    assert isinstance(results[1], TypeError) and isinstance(results[2], TypeError)
+    assert str(results[3]) == "aramis@musketeers.lit"
+
+
+def _same_normalization(fast, full, part):
+    try:
+        expected = full(part)
+    except Exception as e:
+        with pytest.raises(type(e)):
+            fast(part)
+    else:
+        assert fast(part) == expected
+
+
+_ascii = strat.characters(min_codepoint=0x20, max_codepoint=0x7E)
+_ldh = strat.sampled_from("abcxyzABZ0189-.")
+_labels = strat.lists(
+    strat.from_regex(r"[a0-][a0-]{0,4}[a0-]", fullmatch=True), min_size=1
+).map(".".join)
+
+
+@given(
+    local=strat.text(_ascii, max_size=24), resource=strat.text(_ascii, max_size=24)
+)
+def test_ascii_fast_path(local, resource):
+    _same_normalization(
+        jid._normalize_localpart, jid._normalize_localpart_full, local
+    )
+    _same_normalization(
+        jid._normalize_resourcepart, jid._normalize_resourcepart_full, resource
+    )
+
+
+@given(
+    domain=strat.text(_ldh, min_size=1, max_size=24)
+    | strat.text(_ldh, min_size=250)
+    | _labels
+)
+@example("a---a.lit")
+@example("xn--zqs335k.lit")
+@example("musketeers.lit.")
+@example("-musketeers.lit")
+@example("a" * 64 + ".lit")
+@settings(max_examples=300)
+def test_ascii_fast_path_domain(domain):
+    _same_normalization(
+        jid._normalize_domainpart, jid._normalize_domainpart_full, domain
+    )
+
+
+def test_xep_0106_malformed():
+    assert jid._unescape_localpart("a\\5") == "a\\5"
+    assert jid._unescape_localpart("a\\") == "a\\"
+    assert jid._unescape_localpart("a\\zz\\20") == "a\\zz "
+    assert jid._unescape_localpart("a\\5c20") == "a\\20"
+    assert jid._unescape_localpart("a\\2F") == "a\\2F"
+    assert jid.JID.parse("musketeers.lit").unescaped.local is None
+    assert list(xep0106.escape_iter(["d'artagnan", None])) == ["d\\27artagnan", None]
+    assert list(xep0106.unescape_iter(["d\\27artagnan", None])) == [
+        "d'artagnan",
+        None,
+    ]
+
+
+def test_lazy_imports():
+    code = (
+        "import sys, gxmpp.jid as j; "
+        "j.JID.create('athos', 'musketeers.lit', 'horse'); "
+        "assert not {'idna', 'precis_i18n'} & set(sys.modules); "
+        "j.JID.create('Athos', 'musketeers.lit', 'horse'); "
+        "assert 'precis_i18n' in sys.modules"
+    )
+    subprocess.check_call([sys.executable, "-c", code])
+
+
+def test_bare_jid_no_cycle(monkeypatch):
+    # freed by reference counting alone, without the cyclic GC
+    monkeypatch.setattr(jid, "parse_cache", InternTable(maxsize=0))
+    gc.disable()
+    try:
+        j = jid.JID.parse("athos@musketeers.lit/horse")
+        bare = j.bare_jid
+        ref = weakref.ref(bare)
+        assert j.bare_jid is bare and bare.bare_jid is bare
+        del j, bare
+        assert ref() is None
+    finally:
+        gc.enable()
@@ -0,0 +1,367 @@
+import collections
+import random
+import subprocess
+import sys
+import time
+import types
+
+import gevent
+import pytest
+from hypothesis import given
+from hypothesis import strategies as strat
+
+from gxmpp import resolver
+
+
+def test_lazy_imports():
+    code = (
+        "import sys, gxmpp.resolver as r; "
+        "r.Resolver('xmpp-client'); "
+        "assert 'dns' not in sys.modules"
+    )
+    subprocess.check_call([sys.executable, "-c", code])
+
+
+class _Answer(tuple):
+    def __new__(cls, records, ttl):
+        answer = super().__new__(cls, records)
+        answer.rrset = types.SimpleNamespace(ttl=ttl)
+        return answer
+
+
+class FakeResolver:
+    # answers from a zone of (qname, rdtype) -> (records, ttl), counting the
+    # queries made; missing names are NXDOMAIN with an SOA minimum of 60
+    def __init__(self, zone, delay=0):
+        self.zone = zone
+        self.delay = delay
+        self.queries = 0
+
+    def query(self, qname, rdtype, raise_on_no_answer=True):
+        import dns.message
+        import dns.rdatatype
+        import dns.resolver
+        import dns.rrset
+
+        self.queries += 1
+        if self.delay:
+            gevent.sleep(self.delay)
+        answer = self.zone.get((qname, rdtype))
+        if isinstance(answer, Exception):
+            raise answer
+        if answer is not None:
+            return _Answer(*answer)
+        response = dns.message.make_response(dns.message.make_query(qname, rdtype))
+        response.authority.append(
+            dns.rrset.from_text(
+                "lit.", 300, "IN", "SOA", "ns.lit. root.lit. 1 7200 900 86400 60"
+            )
+        )
+        raise dns.resolver.NXDOMAIN(qnames=[qname], responses={qname: response})
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(resolver, "time", clock)
+    return clock
+
+
+def test_dns_cache(clock):
+    import dns.exception
+    import dns.rdatatype
+
+    a = dns.rdatatype.A
+    fake = FakeResolver({("musketeers.lit", a): (["10.0.0.1"], 30)})
+    cache = resolver.DNSCache(stale_ttl=10)
+    r = resolver.Resolver("xmpp-client", resolver=fake, cache=cache)
+    for _ in range(3):
+        assert r._query("musketeers.lit", a) == ("10.0.0.1",)
+    assert r._query("Musketeers.LIT", a) == ("10.0.0.1",)
+    assert fake.queries == 1
+    assert (cache.hits, cache.misses) == (3, 1) and cache.hit_rate == 0.75
+
+    # stale entries are served while they are refreshed
+    fake.zone[("musketeers.lit", a)] = (["10.0.0.2"], 30)
+    clock.now += 35
+    assert r._query("musketeers.lit", a) == ("10.0.0.1",)
+    assert cache.stale_hits == 1
+    gevent.sleep(0)
+    assert fake.queries == 2
+    assert r._query("musketeers.lit", a) == ("10.0.0.2",)
+
+    # failed refreshes keep the stale entry until it runs out; errors are
+    # not cached
+    fake.zone[("musketeers.lit", a)] = dns.exception.Timeout()
+    clock.now += 35
+    assert r._query("musketeers.lit", a) == ("10.0.0.2",)
+    gevent.sleep(0)
+    assert fake.queries == 3
+    clock.now += 10
+    assert r._query("musketeers.lit", a) == ()
+    assert r._query("musketeers.lit", a) == ()
+    assert fake.queries == 5
+
+    # negative answers are cached for the SOA minimum
+    for _ in range(2):
+        assert r._query("aramis.lit", a) == ()
+    assert fake.queries == 6
+    clock.now += 70
+    assert r._query("aramis.lit", a) == ()
+    assert fake.queries == 7
+
+
+def test_dns_cache_bounds(clock):
+    cache = resolver.DNSCache(maxsize=2)
+    for i in range(3):
+        cache.put("{}.lit".format(i), 1, (i,), 30)
+    assert len(cache) == 2
+    lookups = []
+
+    def lookup(qname, rdtype):
+        lookups.append(qname)
+        return (), 0
+
+    assert cache.get("0.lit", 1, lookup) == () and lookups == ["0.lit"]
+    assert cache.get("2.lit", 1, lookup) == (2,)
+    # TTLs are capped at max_ttl, and a TTL of 0 is not cached
+    cache.put("3.lit", 1, (3,), 10 ** 9)
+    clock.now += resolver.MAX_TTL + resolver.STALE_TTL
+    assert cache.get("3.lit", 1, lookup) == () and len(cache) == 1
+
+
+def test_dns_cache_coalesces_queries():
+    import dns.rdatatype
+
+    a = dns.rdatatype.A
+    fake = FakeResolver({("musketeers.lit", a): (["10.0.0.1"], 30)}, delay=0.01)
+    r = resolver.Resolver("xmpp-client", resolver=fake, cache=resolver.DNSCache())
+    lookups = [gevent.spawn(r._query, "musketeers.lit", a) for _ in range(100)]
+    gevent.joinall(lookups, raise_error=True)
+    assert all(g.value == ("10.0.0.1",) for g in lookups)
+    assert fake.queries == 1
+    uncached = resolver.Resolver("xmpp-client", resolver=fake, cache=None)
+    assert uncached._query("musketeers.lit", a) == ("10.0.0.1",)
+    assert fake.queries == 2
+
+
+def _srv(priority, weight, port, target):
+    return types.SimpleNamespace(
+        priority=priority, weight=weight, port=port, target=target
+    )
+
+
+def _addr(address):
+    return types.SimpleNamespace(address=address)
+
+
+def test_server_picker_resolves_concurrently():
+    import dns.rdatatype
+
+    a, aaaa, srv = dns.rdatatype.A, dns.rdatatype.AAAA, dns.rdatatype.SRV
+    zone = {
+        ("_xmpp-client._tcp.musketeers.lit", srv): (
+            [
+                _srv(0, 10, 5222, "athos.musketeers.lit"),
+                _srv(0, 10, 5223, "porthos.musketeers.lit"),
+                _srv(0, 10, 5224, "aramis.musketeers.lit"),
+                _srv(0, 0, 5225, "gone.musketeers.lit"),
+            ],
+            300,
+        ),
+    }
+    for i, name in enumerate(("athos", "porthos", "aramis")):
+        zone[(name + ".musketeers.lit", a)] = ([_addr("10.0.0.{}".format(i))], 300)
+        zone[(name + ".musketeers.lit", aaaa)] = ([_addr("fd00::{}".format(i))], 300)
+    fake = FakeResolver(zone, delay=0.05)
+    r = resolver.Resolver("xmpp-client", resolver=fake, cache=None)
+    started = time.monotonic()
+    servers = list(r.getaddrs("musketeers.lit", with_tls=True))
+    elapsed = time.monotonic() - started
+    assert sorted(servers) == [
+        ("10.0.0.0", "fd00::0", 5222, False),
+        ("10.0.0.1", "fd00::1", 5223, False),
+        ("10.0.0.2", "fd00::2", 5224, False),
+    ]
+    # both SRV queries, then all A and AAAA queries at once, rather than 10
+    # queries in a row
+    assert fake.queries == 10
+    assert elapsed < 0.05 * 4
+
+
+@given(strat.lists(strat.floats(min_value=0.01, max_value=100), min_size=1))
+def test_weight_tree(weights):
+    tree = resolver._WeightTree(weights)
+    assert tree.total() == pytest.approx(sum(weights))
+    left = set(range(len(weights)))
+    # sampling at the start of every index's share of the total finds it
+    while left:
+        running = 0.0
+        for i in sorted(left):
+            assert tree.sample(running + weights[i] / 2) == i
+            running += weights[i]
+        i = tree.sample(random.random() * tree.total())
+        assert i in left
+        tree.remove(i)
+        left.remove(i)
+    assert tree.sample(0.0) == -1
+
+
+def test_target_scoreboard(clock):
+    board = resolver.TargetScoreboard(maxsize=2)
+    assert board.score("athos.lit", 5222) == 1.0
+    board.record_connect("athos.lit", 5222, 0.05)
+    board.record_tls("athos.lit", 5222, 0.05)
+    assert board.score("athos.lit", 5222) == 1.0
+    board.record_connect("porthos.lit", 5222, 0.4)
+    board.record_connect("porthos.lit", 5222, 0.4)
+    assert board.score("porthos.lit", 5222) == pytest.approx(0.25)
+
+    board.record_failure("Aramis.lit", 5222)
+    assert len(board) == 2 and board.get("athos.lit", 5222) is None
+    assert board.score("aramis.lit", 5222) == 0.5 * resolver.PENALTY_FACTOR
+    # the penalty doubles with every failure in a row, and failures decay
+    board.record_failure("aramis.lit", 5222)
+    health = board.get("aramis.lit", 5222)
+    assert health.penalty_until == clock.now + 2 * resolver.PENALTY_TIME
+    assert health.failures() == 2
+    clock.now += 2 * resolver.PENALTY_TIME
+    assert board.score("aramis.lit", 5222) == pytest.approx(1 / 3, rel=0.1)
+    clock.now += resolver.FAILURE_HALF_LIFE
+    assert health.failures() == pytest.approx(1, rel=0.1)
+    # a successful connection ends the penalty early
+    board.record_failure("aramis.lit", 5222)
+    assert board.score("aramis.lit", 5222) < resolver.PENALTY_FACTOR
+    board.record_connect("aramis.lit", 5222, 0.01)
+    assert health.consecutive_failures == 0 and health.penalty_until == 0.0
+    assert board.score("aramis.lit", 5222) > resolver.PENALTY_FACTOR
+    assert [key for key, _ in board] == [("porthos.lit", 5222), ("aramis.lit", 5222)]
+    assert "failures=" in repr(health)
+
+
+def _picker(board, *srvs):
+    zone = {}
+    for srv in srvs:
+        zone[(srv.target, 1)] = ([_addr(srv.target)], 300)
+    r = resolver.Resolver(
+        "xmpp-client", resolver=FakeResolver(zone), cache=None, scoreboard=board
+    )
+    return resolver.ServerPicker.from_srv_answer(r, srvs, board)
+
+
+def test_server_picker_health():
+    srvs = [_srv(10, 10, 5222, t) for t in ("athos", "porthos", "aramis")]
+    srvs.append(_srv(20, 10, 5222, "dartagnan"))
+    srvs.append(_srv(5, 0, 5222, "planchet"))
+    board = resolver.TargetScoreboard()
+    firsts = collections.Counter()
+    for _ in range(300):
+        picker = _picker(board, *srvs)
+        order = [ipv4 for ipv4, *_ in picker]
+        # priority groups are tried from the lowest priority up
+        assert order[0] == "planchet" and order[-1] == "dartagnan"
+        firsts[order[1]] += 1
+    assert all(firsts[t] > 50 for t in ("athos", "porthos", "aramis"))
+
+    # failing targets are tried last, slow ones later
+    board.record_failure("athos", 5222)
+    board.record_connect("porthos", 5222, 1.0)
+    firsts.clear()
+    lasts = collections.Counter()
+    for _ in range(300):
+        picker = _picker(board, *srvs)
+        order = [ipv4 for ipv4, *_ in picker]
+        firsts[order[1]] += 1
+        lasts[order[3]] += 1
+    assert firsts["aramis"] > 200 and lasts["athos"] > 280
+
+    picker = _picker(board, *srvs)
+    candidate = next(picker)
+    assert picker.current == candidate.target == ("planchet", 5222)
+    assert candidate == ("planchet", None, 5222)
+    picker.record_connect(0.01)
+    picker.record_tls(0.02)
+    picker.record_failure()
+    health = board.get("planchet", 5222)
+    assert health.tls_time == 0.02 and health.consecutive_failures == 1
+
+
+def test_direct_tls():
+    import dns.rdatatype
+
+    a, srv = dns.rdatatype.A, dns.rdatatype.SRV
+    zone = {
+        ("_xmpp-client._tcp.musketeers.lit", srv): (
+            [
+                _srv(0, 10, 5222, "athos.musketeers.lit"),
+                _srv(10, 10, 5222, "porthos.musketeers.lit"),
+            ],
+            300,
+        ),
+        ("_xmpps-client._tcp.musketeers.lit", srv): (
+            [
+                _srv(0, 10, 5223, "athos.musketeers.lit"),
+                _srv(20, 10, 443, "aramis.musketeers.lit"),
+            ],
+            300,
+        ),
+        ("_xmpp-client._tcp.aramis.lit", srv): (
+            [_srv(0, 10, 5222, "aramis.musketeers.lit")],
+            300,
+        ),
+    }
+    for name in ("athos", "porthos", "aramis"):
+        zone[(name + ".musketeers.lit", a)] = ([_addr(name)], 300)
+    fake = FakeResolver(zone, delay=0.05)
+    r = resolver.Resolver("xmpp-client", resolver=fake, cache=None, scoreboard=None)
+    assert r.tls_service_prefix == "_xmpps-client._tcp."
+    started = time.monotonic()
+    candidates = r.getaddrs("musketeers.lit", 5222, with_tls=True)
+    first = next(candidates)
+    # both SRV queries are made at once, then the first target is resolved
+    assert time.monotonic() - started < 0.05 * 3.5
+    candidates = [first] + list(candidates)
+    # direct TLS goes first at equal priority
+    assert candidates == [
+        ("athos", None, 5223, True),
+        ("athos", None, 5222, False),
+        ("porthos", None, 5222, False),
+        ("aramis", None, 443, True),
+    ]
+
+    # only one of them, or neither
+    assert list(r.getaddrs("aramis.lit", 5222, with_tls=True)) == [
+        ("aramis", None, 5222, False)
+    ]
+    zone[("dartagnan.lit", a)] = ([_addr("10.0.0.1")], 300)
+    assert list(r.getaddrs("dartagnan.lit", 5222, with_tls=True)) == [
+        ("10.0.0.1", None, 5222, False)
+    ]
+    assert list(r.getaddrs("127.0.0.1", 5222, with_tls=True)) == [
+        ("127.0.0.1", None, 5222, False)
+    ]
+    plain = resolver.Resolver(
+        "xmpp-client", resolver=fake, cache=None, scoreboard=None, direct_tls=False
+    )
+    assert plain.tls_service_prefix is None
+    flags = [c[3] for c in plain.getaddrs("musketeers.lit", with_tls=True)]
+    assert flags == [False, False]
+
+    # without with_tls, only STARTTLS targets are looked up, without the flag
+    queries = fake.queries
+    assert sorted(r.getaddrs("musketeers.lit", 5222)) == [
+        ("athos", None, 5222),
+        ("porthos", None, 5222),
+    ]
+    assert fake.queries == queries + 5  # one SRV query, A and AAAA for both
+    assert list(r.getaddrs("dartagnan.lit", 5222)) == [("10.0.0.1", None, 5222)]
+    assert list(r.getaddrs("127.0.0.1", 5222)) == [("127.0.0.1", None, 5222)]
+    assert resolver.Resolver("stun").tls_service_prefix is None
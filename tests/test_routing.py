@@ -0,0 +1,75 @@
+import pytest
+
+from gxmpp.jid import JID
+from gxmpp.routing import JIDRoutingTable
+
+
+def test_lookup():
+    p = JID.parse
+    t = JIDRoutingTable(
+        [
+            (p("athos@musketeers.lit/horse"), "full"),
+            (p("athos@musketeers.lit"), "bare"),
+            (p("musketeers.lit"), "domain"),
+            (p("*.銃士.lit"), "wildcard"),
+        ]
+    )
+    assert len(t) == 4
+    assert t.lookup(p("athos@musketeers.lit/horse")) == "full"
+    assert t.lookup(p("athos@musketeers.lit/sword")) == "bare"
+    assert t.lookup(p("athos@musketeers.lit")) == "bare"
+    assert t.lookup(p("porthos@musketeers.lit/sword")) == "domain"
+    assert t.lookup(p("porthos@muc.xn--zqs335k.lit/sword")) == "wildcard"
+    assert t.lookup(p("a.b.xn--zqs335k.lit")) == "wildcard"
+    assert t.lookup(p("porthos@銃士.lit")) is None
+    assert t.lookup(p("cardinal.lit"), "default") == "default"
+
+    assert t[p("athos@musketeers.lit")] == "bare"
+    assert p("porthos@musketeers.lit") not in t
+    assert p("*.xn--zqs335k.lit") in t
+    with pytest.raises(KeyError):
+        t[p("porthos@musketeers.lit")]
+    with pytest.raises(ValueError):
+        t[p("musketeers.lit/horse")] = "invalid"
+
+
+def test_resources_and_delete():
+    p = JID.parse
+    t = JIDRoutingTable()
+    for r in ("horse", "sword", "hat"):
+        t[p("athos@musketeers.lit/" + r)] = r
+    t[p("athos@musketeers.lit/hat")] = "HAT"
+    assert len(t) == 3
+    assert dict(t.resources(p("athos@musketeers.lit/whatever"))) == {
+        "horse": "horse",
+        "sword": "sword",
+        "hat": "HAT",
+    }
+    assert t.resources(p("porthos@musketeers.lit")) == ()
+    assert set(t) == {
+        p("athos@musketeers.lit/" + r) for r in ("horse", "sword", "hat")
+    }
+
+    for r in ("horse", "sword", "hat"):
+        del t[p("athos@musketeers.lit/" + r)]
+    with pytest.raises(KeyError):
+        del t[p("athos@musketeers.lit/hat")]
+    assert len(t) == 0
+    assert not t._domains
+
+
+def test_domain_with_resource():
+    # a resourcepart without a localpart is valid, but never routed
+    p = JID.parse
+    t = JIDRoutingTable()
+    t[p("athos@musketeers.lit/horse")] = "horse"
+    t[p("musketeers.lit")] = "domain"
+    jid = p("musketeers.lit/athos")
+    assert t.get(jid, "default") == "default"
+    assert jid not in t
+    with pytest.raises(KeyError):
+        t[jid]
+    with pytest.raises(KeyError):
+        del t[jid]
+    assert len(t) == 2
+    assert set(t) == {p("athos@musketeers.lit/horse"), p("musketeers.lit")}
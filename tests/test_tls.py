@@ -0,0 +1,165 @@
+import os
+import time
+import types
+
+import gevent
+import pytest
+from gevent import socket, ssl
+
+from gxmpp.util.tls import (
+    TLSSessionCache,
+    create_connection,
+    create_context,
+    starttls,
+)
+
+# a self-signed certificate for musketeers.lit, made with:
+# openssl req -x509 -newkey ec -pkeyopt ec_paramgen_curve:prime256v1 -nodes
+#   -days 36500 -subj /CN=musketeers.lit
+#   -addext subjectAltName=DNS:musketeers.lit,DNS:localhost
+#   -keyout musketeers.key -out musketeers.crt
+DATA = os.path.join(os.path.dirname(__file__), "data")
+CERT = os.path.join(DATA, "musketeers.crt")
+KEY = os.path.join(DATA, "musketeers.key")
+DOMAIN = "musketeers.lit"
+HEADER = b"<stream:stream from='musketeers.lit' version='1.0'>"
+
+
+def _server_context():
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(CERT, KEY)
+    return context
+
+
+class Listener:
+    # a TLS server that sends a stream header on every connection, and
+    # upgrades to TLS on a plain "<starttls/>" first when starttls is set
+    def __init__(self, starttls=False):
+        self.context = _server_context()
+        self.starttls = starttls
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(16)
+        self.address = self.sock.getsockname()
+        self._acceptor = gevent.spawn(self._accept)
+
+    def _accept(self):
+        while True:
+            conn, _ = self.sock.accept()
+            gevent.spawn(self._serve, conn)
+
+    def _serve(self, conn):
+        try:
+            if self.starttls:
+                assert conn.recv(64) == b"<starttls/>"
+                conn.sendall(b"<proceed/>")
+            conn = self.context.wrap_socket(conn, server_side=True)
+            conn.sendall(HEADER)
+            conn.recv(64)
+        except (OSError, ssl.SSLError):
+            pass
+        finally:
+            conn.close()
+
+    def close(self):
+        self._acceptor.kill()
+        self.sock.close()
+
+
+@pytest.fixture
+def listener():
+    listener = Listener()
+    yield listener
+    listener.close()
+
+
+def _client_context(version):
+    context = create_context(CERT)
+    context.maximum_version = version
+    return context
+
+
+def _connect(cache, address):
+    sock = create_connection(address, DOMAIN, cache)
+    # TLS 1.3 servers send tickets after the handshake, with the first data
+    assert sock.recv(64) == HEADER
+    cache.save(sock, DOMAIN, address)
+    reused = sock.session_reused
+    session = sock.session
+    sock.close()
+    return reused, session
+
+
+@pytest.mark.parametrize("version", [ssl.TLSVersion.TLSv1_2, ssl.TLSVersion.TLSv1_3])
+def test_tls_session_resumption(listener, version):
+    cache = TLSSessionCache(_client_context(version))
+    assert not _connect(cache, listener.address)[0]
+    assert (cache.hits, cache.misses, len(cache)) == (0, 1, 1)
+    for _ in range(3):
+        assert _connect(cache, listener.address)[0]
+    assert (cache.hits, cache.misses, cache.rejected) == (3, 1, 0)
+    assert cache.hit_rate == 0.75
+
+    # sessions are cached per domain and target
+    other = ("localhost", listener.address[1])
+    assert not _connect(cache, other)[0]
+    assert cache.misses == 2 and len(cache) == 2
+
+    # a server that lost its session state does a full handshake
+    listener.context = _server_context()
+    assert not _connect(cache, listener.address)[0]
+    assert cache.rejected == 1
+    assert _connect(cache, listener.address)[0]
+
+
+def test_tls_starttls():
+    listener = Listener(starttls=True)
+    cache = TLSSessionCache(_client_context(ssl.TLSVersion.TLSv1_3))
+    try:
+        for reused in (False, True):
+            sock = socket.create_connection(listener.address)
+            sock.sendall(b"<starttls/>")
+            assert sock.recv(64) == b"<proceed/>"
+            sock = starttls(sock, DOMAIN, cache, listener.address)
+            assert sock.recv(64) == HEADER
+            assert sock.session_reused == reused
+            cache.save(sock, DOMAIN, listener.address)
+            sock.close()
+    finally:
+        listener.close()
+
+
+def _session(timeout=300):
+    return types.SimpleNamespace(
+        time=int(time.time()), timeout=timeout, has_ticket=True, id=b"1"
+    )
+
+
+def _sock(session):
+    return types.SimpleNamespace(session=session)
+
+
+def test_tls_session_cache_bounds():
+    cache = TLSSessionCache(maxsize=2)
+    sessions = [_session() for _ in range(3)]
+    for i, session in enumerate(sessions):
+        cache.save(_sock(session), DOMAIN, ("musketeers.lit", 5222 + i))
+    assert len(cache) == 2
+    assert cache.get(DOMAIN, ("musketeers.lit", 5222)) is None
+    assert cache.get(DOMAIN, ("musketeers.lit", 5223)) is sessions[1]
+    # the least recently used session goes first
+    cache.save(_sock(_session()), "aramis.lit")
+    assert cache.get(DOMAIN, ("musketeers.lit", 5224)) is None
+    assert cache.get(DOMAIN, ("musketeers.lit", 5223)) is sessions[1]
+
+    # expired sessions are not resumed
+    cache.save(_sock(_session(timeout=0)), DOMAIN)
+    assert cache.get(DOMAIN) is None
+    assert len(cache) == 1
+
+
+def test_tls_handshake_failure(listener):
+    cache = TLSSessionCache(_client_context(ssl.TLSVersion.TLSv1_3))
+    with pytest.raises(ssl.SSLCertVerificationError):
+        create_connection(listener.address, "aramis.lit", cache)
+    assert len(cache) == 0 and cache.misses == 0
@@ -1,13 +1,35 @@
+import copy
+import itertools
+import zlib
+
 import gevent
 import pytest
 from gevent import queue, socket
+from hypothesis import given
+from hypothesis import strategies as strat
 from lxml import etree
 
 from gxmpp.util.xml import element_eq
-from gxmpp.xmlstream import BaseXMLStream, XMLStream
+from gxmpp.xmlstream import (
+    MAX_RECV_BUF,
+    MIN_RECV_BUF,
+    PULL_ENGINE,
+    RAW_ENGINE,
+    RECV_SHRINK_AFTER,
+    TARGET_ENGINE,
+    BaseXMLStream,
+    PolicyViolation,
+    RecvBuffer,
+    StanzaTemplate,
+    StreamLimits,
+    XMLStream,
+    template,
+)
+from gxmpp.xmlstream.sm import ManagedXMLStream, RingBuffer, StreamManagementError
 
 
-def test_basexmlstream():
+@pytest.mark.parametrize("engine", [TARGET_ENGINE, PULL_ENGINE])
+def test_basexmlstream(engine):
     q = queue.Queue()
 
     def expected(event, elem=None):
@@ -32,7 +54,7 @@ def test_basexmlstream():
         def handle_close(self):
             q.put(("close", None))
 
-    t = TestStream()
+    t = TestStream(engine=engine)
     t._feed("<stream key='value'>")
     expected("stream_start", etree.Element("stream", {"key": "value"}))
     e = etree.Element("message", {})
@@ -41,6 +63,11 @@ def test_basexmlstream():
     e.append(b)
     t._feed("<message><body>foobar</body></message>")
     expected("element", e)
+    t._feed("<iq><query><item><entry><title>a</title></entry></item></query></iq> ")
+    e = etree.fromstring(
+        "<iq><query><item><entry><title>a</title></entry></item></query></iq>"
+    )
+    expected("element", e)
     t._feed("</stream>")
     expected("stream_end")
     with pytest.raises(etree.XMLSyntaxError, match="[eE]xtra content"):
@@ -53,11 +80,11 @@ def test_xmlstream():
     q = queue.Queue()
     lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     lsock.bind(("127.0.0.1", 0))
+    lsock.listen()
     addr = lsock.getsockname()
 
     def _server():
         with lsock:
-            lsock.listen()
             conn, _ = lsock.accept()
             with conn:
                 for iq in q:
@@ -84,3 +111,770 @@ def test_xmlstream():
         assert not x.run(once=True)
     finally:
         serverlet.kill()
+
+
+def test_recvbuffer():
+    a, b = socket.socketpair()
+    with a, b:
+        r = RecvBuffer()
+        b.sendall(b"x" * MIN_RECV_BUF)
+        assert r.recv(a) == b"x" * MIN_RECV_BUF
+        assert r.size == MIN_RECV_BUF * 2
+        while r.size < MAX_RECV_BUF:
+            b.sendall(b"x" * r.size)
+            assert len(r.recv(a)) == r.size // 2
+        for _ in range(RECV_SHRINK_AFTER):
+            b.sendall(b"<a/>")
+            assert r.recv(a) == b"<a/>"
+        assert r.size == MAX_RECV_BUF // 2
+        b.close()
+        assert r.recv(a) == b""
+
+
+def test_xmlstream_backpressure():
+    a, b = socket.socketpair()
+    with a, b:
+        x = XMLStream(high_water=8, low_water=2)
+        x.sock = a
+        b.sendall(b"<stream>" + b"<message/>" * 10)
+        reader = gevent.spawn(x.run)
+        gevent.sleep(0.01)
+        assert x.paused and x.pause_count == 1
+        b.sendall(b"<message/>" * 10)
+        for _ in range(7):
+            assert x.run(once=True).tag == "message"
+        gevent.sleep(0.01)
+        assert x.paused  # 3 queued, above low_water
+        assert x.run(once=True).tag == "message"
+        gevent.sleep(0.01)
+        # resumed, read the second batch and paused again
+        assert x.paused and x.pause_count == 2
+        assert x.paused_time > 0
+        for _ in range(12):
+            assert x.run(once=True).tag == "message"
+        b.sendall(b"</stream>")
+        assert reader.get(timeout=1) is None
+    with pytest.raises(ValueError):
+        XMLStream(high_water=8, low_water=8)
+
+
+def test_xmlstream_consumers():
+    a, b = socket.socketpair()
+    with a, b:
+        x = XMLStream(high_water=8, low_water=2)
+        x.sock = a
+        reader = gevent.spawn(x.run)
+        consumers = [gevent.spawn(x.run, once=True) for _ in range(2)]
+        gevent.sleep(0.01)
+        b.sendall(b"<stream><message/><iq/>")
+        assert sorted(c.get(timeout=1).tag for c in consumers) == ["iq", "message"]
+        with pytest.raises(gevent.Timeout):
+            x.run(once=True, timeout=0.01)
+        batch = gevent.spawn(x.run_batch)
+        gevent.sleep(0.01)
+        b.sendall(b"<message/>" * 20)
+        # parsed from a single read, and returned together
+        assert len(batch.get(timeout=1)) == 20
+        with pytest.raises(RuntimeError):
+            x.run()
+        consumers = [gevent.spawn(x.run_batch) for _ in range(2)]
+        gevent.sleep(0.01)
+        b.sendall(b"</stream>")
+        assert reader.get(timeout=1) is None
+        assert [c.get(timeout=1) for c in consumers] == [[], []]
+
+
+def test_xmlstream_takeover():
+    a, b = socket.socketpair()
+    with a, b:
+        x = XMLStream()
+        x.sock = a
+        first = gevent.spawn(x.run, once=True)
+        second = gevent.spawn(x.run, once=True)
+        gevent.sleep(0.01)
+        b.sendall(b"<stream><message/>")
+        assert first.get(timeout=1).tag == "message"
+        # the first reader returned, and the second one receives in its place
+        gevent.sleep(0.01)
+        b.sendall(b"<iq/>")
+        assert second.get(timeout=1).tag == "iq"
+
+
+@pytest.mark.parametrize("engine", [TARGET_ENGINE, PULL_ENGINE])
+def test_xmlstream_batches(engine):
+    a, b = socket.socketpair()
+    with a, b:
+        x = XMLStream(engine=engine)
+        x.sock = a
+        b.sendall(b"<stream><message/><iq/><presence/>")
+        assert [e.tag for e in x.run_batch(max_items=2)] == ["message", "iq"]
+        assert [e.tag for e in x.run_batch()] == ["presence"]
+        b.sendall(b"<message><body>hi</bo")
+        with pytest.raises(gevent.Timeout):
+            x.run_batch(timeout=0.01)
+        b.sendall(b"dy></message>" + b"<message/>" * 3)
+        batches = x.iter_batches(max_items=3)
+        assert [len(batch) for batch in itertools.islice(batches, 2)] == [3, 1]
+        b.sendall(b"</stream>")
+        assert list(batches) == []
+        with pytest.raises(ValueError):
+            x.run_batch(max_items=0)
+
+
+def test_raw_engine():
+    events = []
+
+    class TestStream(BaseXMLStream):
+        def handle_stream_start(self, elem):
+            events.append(("stream_start", elem))
+
+        def handle_element(self, elem):
+            events.append(("element", elem))
+
+        def handle_parse_error(self, exc_type, exc_value, exc_traceback):
+            raise exc_value.with_traceback(exc_traceback)
+
+        def handle_stream_end(self):
+            events.append(("stream_end", None))
+
+        def handle_close(self):
+            events.append(("close", None))
+
+    header = (
+        b"<?xml version='1.0'?><stream:stream xmlns='jabber:client' "
+        b"xmlns:stream='http://etherx.jabber.org/streams' to='musketeers.lit'>"
+    )
+    stanzas = [
+        b"<message to='athos@musketeers.lit' id='a&amp;b&#x21;' xml:lang='fr'>"
+        b"<body>1 &lt; 2 > 0</body><!-- </message> --><x><![CDATA[</x>]]></x>"
+        b"</message>",
+        b'<presence from="porthos@musketeers.lit/sword" type="unavailable"/>',
+        b"<stream:features><bind xmlns='urn:ietf:params:xml:ns:xmpp-bind'/>"
+        b"</stream:features>",
+        b"<iq xmlns='jabber:component:accept' type='get' id=\"x'>\"/>",
+    ]
+    data = header + b"\n".join(stanzas) + b" </stream:stream>"
+    t = TestStream(engine=RAW_ENGINE)
+    for i in range(len(data)):  # worst case: one byte at a time
+        t._feed(data[i : i + 1])
+    assert [e for e, _ in events] == ["stream_start"] + ["element"] * 4 + [
+        "stream_end"
+    ]
+    assert events[0][1].tag == "{http://etherx.jabber.org/streams}stream"
+    assert events[0][1].get("to") == "musketeers.lit"
+    raws = [elem for e, elem in events if e == "element"]
+    assert [r.raw for r in raws] == stanzas
+    assert [r.tag for r in raws] == [
+        "{jabber:client}message",
+        "{jabber:client}presence",
+        "{http://etherx.jabber.org/streams}features",
+        "{jabber:component:accept}iq",
+    ]
+    assert raws[0].attrib == {
+        "to": "athos@musketeers.lit",
+        "id": "a&b!",
+        "{http://www.w3.org/XML/1998/namespace}lang": "fr",
+    }
+    assert raws[3].get("id") == "x'>"
+    full = etree.fromstring(data)
+    for raw, elem in zip(raws, full):
+        elem.tail = None
+        assert element_eq(raw.element, elem)
+        assert raw.element.nsmap.get(None) == elem.nsmap.get(None)
+
+    with pytest.raises(etree.XMLSyntaxError, match="[eE]xtra content"):
+        t._feed(b"<message/>")
+
+    for bad in (
+        b"<stream><message></iq></stream>",
+        b"<stream><message to=athos/></stream>",
+        b"junk<stream>",
+        b"<!DOCTYPE stream",  # rejected before it is complete
+        b"<stream><message><!E",
+        b"<stream><![CDATA[",
+    ):
+        t = TestStream(engine=RAW_ENGINE)
+        with pytest.raises(etree.XMLSyntaxError):
+            t._feed(bad)
+
+    # comments are searched for their end from where the last search stopped
+    t = TestStream(engine=RAW_ENGINE)
+    t._feed(b"<stream><!-")
+    t._feed(b"- ")
+    for _ in range(1000):
+        t._feed(b"<x> -- -")
+    parser = t._BaseXMLStream__parser
+    assert parser._markup_pos == len(parser._buf) - 2
+    del events[:]
+    t._feed(b"-><message/>")
+    assert [e for e, _ in events] == ["element"]
+
+    limits = StreamLimits(max_stanza_size=1024, max_text=256)
+    for chunks, limit in (
+        ([b"<stream><a><![CDATA["] + [b"x" * 64] * 4, None),
+        ([b"<stream><a><![CDATA["] + [b"x" * 64] * 5, "max_text"),
+        ([b"<stream><a><!--"] + [b"x" * 256] * 4, "max_stanza_size"),
+        ([b"<stream><?pi "] + [b"x" * 256] * 4, "max_stanza_size"),
+    ):
+        t = TestStream(engine=RAW_ENGINE, limits=limits)
+        if limit is None:
+            for chunk in chunks:
+                t._feed(chunk)
+            continue
+        with pytest.raises(PolicyViolation) as exc_info:
+            for chunk in chunks:
+                t._feed(chunk)
+        assert exc_info.value.limit == limit
+
+
+@pytest.mark.parametrize("engine", [TARGET_ENGINE, PULL_ENGINE, RAW_ENGINE])
+def test_stream_limits(engine):
+    class TestStream(BaseXMLStream):
+        def handle_stream_start(self, elem):
+            pass
+
+        def handle_element(self, elem):
+            self.elements.append(elem)
+
+        def handle_parse_error(self, exc_type, exc_value, exc_traceback):
+            self.error = exc_value
+
+        def handle_stream_end(self):
+            pass
+
+        def handle_close(self):
+            pass
+
+    limits = StreamLimits(
+        max_stanza_size=1024, max_depth=4, max_attributes=3, max_text=256
+    )
+
+    def feed(*chunks):
+        t = TestStream(engine=engine, limits=limits)
+        t.elements = []
+        t.error = None
+        for chunk in (b"<stream xmlns='jabber:client'>",) + chunks:
+            t._feed(chunk)
+            if t.error:
+                break
+        return t
+
+    within = [
+        b"<a><b><c><d/></c></b></a>",
+        b"<a x='1' y='2' xmlns:p='urn:p' p:z='3'/>",
+        b"<a>" + b"x" * 256 + b"<b/><![CDATA[" + b"x" * 256 + b"]]></a>",
+        b"<a>" + b"<b>xxxxxxxx</b>" * 32 + b"</a>",
+    ]
+    t = feed(*within)
+    assert t.error is None
+    assert len(t.elements) == len(within)
+
+    for limit, chunks in (
+        ("max_depth", [b"<a><b><c><d><e/></d></c></b></a>"]),
+        ("max_attributes", [b"<a w='0' x='1' y='2' z='3'/>"]),
+        ("max_text", [b"<a>", b"x" * 200, b"x" * 100]),
+        ("max_text", [b"<a><![CDATA[" + b"x" * 257 + b"]]></a>"]),
+        ("max_stanza_size", [b"<a>"] + [b"<b>xxxxxxxx</b>"] * 200),
+    ):
+        # none of the stanzas are closed: the limits are enforced before
+        # the stanza is complete
+        t = feed(*chunks)
+        assert isinstance(t.error, PolicyViolation), limit
+        assert t.error.limit == limit
+        assert t.error.condition == "policy-violation"
+        assert not t.elements
+
+    t = feed(b"<stream w='0' x='1' y='2' z='3'>")
+    assert isinstance(t.error, PolicyViolation)
+
+
+@pytest.mark.parametrize("engine", [TARGET_ENGINE, PULL_ENGINE])
+def test_buffered_limits(engine):
+    class TestStream(XMLStream):
+        def handle_element(self, elem):
+            self.elements.append(elem)
+
+    limits = StreamLimits(max_stanza_size=1024)
+    t = TestStream(engine=engine, limits=limits)
+    t.elements = []
+    # stanzas fed together may exceed the limit, as long as each is within it
+    t._feed(b"<stream>" + (b"<message>" + b"x" * 512 + b"</message>") * 8)
+    t._feed(b" " * 2048)
+    assert len(t.elements) == 8 and t._exc_info is None
+    # a start tag that never ends is buffered by lxml without any event
+    t._feed(b"<message to='" + b"x" * 1000)
+    assert t._exc_info is None
+    t._feed(b"x" * 20)
+    assert isinstance(t._exc_info[1], PolicyViolation)
+    assert t._exc_info[1].limit == "max_stanza_size"
+
+
+@pytest.mark.parametrize("engine", [TARGET_ENGINE, PULL_ENGINE])
+def test_comments_and_pis(engine):
+    class TestStream(XMLStream):
+        def handle_element(self, elem):
+            self.elements.append(elem)
+
+    t = TestStream(engine=engine)
+    t.elements = []
+    t._feed(b"<stream><!-- a --><?b c?><message>1<!-- d -->2<?e f?>3")
+    t._feed(b"<body>x</body><!--g-->y</message><?h?>")
+    assert t._exc_info is None
+    assert len(t.elements) == 1
+    assert element_eq(
+        t.elements[0], etree.fromstring("<message>123<body>x</body>y</message>")
+    )
+
+
+@pytest.mark.parametrize("engine", [TARGET_ENGINE, PULL_ENGINE, RAW_ENGINE])
+def test_stream_restart(engine):
+    events = []
+
+    class TestStream(BaseXMLStream):
+        def handle_stream_start(self, elem):
+            events.append(("stream_start", elem.tag))
+
+        def handle_element(self, elem):
+            events.append(("element", elem))
+
+        def handle_parse_error(self, exc_type, exc_value, exc_traceback):
+            raise exc_value.with_traceback(exc_traceback)
+
+        def handle_stream_end(self):
+            events.append(("stream_end", None))
+
+        def handle_close(self):
+            events.append(("close", None))
+
+    t = TestStream(engine=engine)
+    parser = t._BaseXMLStream__parser
+    # restarted mid-stream, as after STARTTLS, then after the stream ended
+    t._feed(b"<stream><message><body>a</body></message><iq><query")
+    t._reset_parser()
+    t._feed(b"<stream><iq/></stream>")
+    t._reset_parser()
+    t._feed(b"<stream><presence/>")
+    assert t._BaseXMLStream__parser is parser
+    assert [e for e, _ in events] == [
+        "stream_start",
+        "element",
+        "stream_start",
+        "element",
+        "stream_end",
+        "stream_start",
+        "element",
+    ]
+    stanzas = [elem for e, elem in events if e == "element"]
+    assert [elem.tag for elem in stanzas] == ["message", "iq", "presence"]
+    if engine == TARGET_ENGINE:
+        # stanzas are documents of their own
+        for elem in stanzas:
+            assert elem.getparent() is None
+            assert elem.getroottree().getroot() is elem
+
+
+def test_xmlstream_reset():
+    a, b = socket.socketpair()
+    with a, b:
+        x = XMLStream()
+        x.sock = a
+        b.sendall(b"<stream><message/><iq/>")
+        assert x.run(once=True).tag == "message"
+        x.reset()  # drops the queued iq along with the stream
+        b.sendall(b"<stream><presence/></stream>")
+        assert x.run(once=True).tag == "presence"
+        assert x.run(once=True) is None
+        b.sendall(b"<stream><message/>")
+        assert x.run(once=True).tag == "message"
+
+
+def _recv_exactly(sock, n):
+    data = b""
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        assert chunk
+        data += chunk
+    return data
+
+
+def test_xmlstream_send():
+    a, b = socket.socketpair()
+    with a, b:
+        x = XMLStream(engine=RAW_ENGINE)
+        x.sock = a
+        b.sendall(b"<stream><message to='athos'><body>hi</body></message>")
+        raw = x.run(once=True)
+        message = etree.Element("message", {"to": "porthos"})
+        expected = b"<stream>" + b'<message to="porthos"/>' * 100 + raw.raw
+        # stanzas sent without yielding in between share a single write
+        x.send(b"<stream>")
+        for _ in range(100):
+            x.send(message)
+        x.send(raw)
+        assert x.write_count == 0
+        assert _recv_exactly(b, len(expected)) == expected
+        assert x.write_count == 1
+        # flush() writes right away
+        x.send("<presence/>")
+        x.flush()
+        assert x.write_count == 2
+        b.setblocking(False)
+        assert b.recv(1024) == b"<presence/>"
+
+
+def test_xmlstream_send_backpressure():
+    a, b = socket.socketpair()
+    with a, b:
+        x = XMLStream(send_high_water=2 ** 16, send_low_water=2 ** 10)
+        x.sock = a
+        big = b"<message>" + b"x" * 2 ** 22 + b"</message>"
+        x.send(big)  # more than the socket buffers take in
+        sender = gevent.spawn(x.send, b"<presence/>")
+        gevent.sleep(0.01)
+        assert not sender.dead  # blocked until the write completes
+        assert _recv_exactly(b, len(big)) == big
+        sender.get(timeout=1)
+        x.flush()
+        assert _recv_exactly(b, 11) == b"<presence/>"
+        b.close()
+        with pytest.raises(OSError):
+            for _ in range(100):
+                x.send(big)
+                x.flush()
+        with pytest.raises(OSError):
+            x.send(b"<presence/>")
+    with pytest.raises(ValueError):
+        XMLStream(send_high_water=8, send_low_water=8)
+
+
+def _filled(tmpl, elem, values):
+    # what the template should render: elem with the slots set in order
+    elem = copy.deepcopy(elem)
+    for name, (path, attr) in tmpl.slots.items():
+        target = elem if path is None else elem.find(path)
+        value = values.get(name)
+        if attr is None:
+            target.text = value
+        elif value is None:
+            target.attrib.pop(attr, None)
+        else:
+            target.set(attr, value)
+    return elem
+
+
+# characters lxml accepts in attribute values and text
+_xml_text = strat.text(
+    strat.characters(blacklist_categories=("Cs",)).filter(
+        lambda c: c in "\t\n\r" or c >= " " and c not in "\ufffe\uffff"
+    ),
+    max_size=16,
+)
+
+
+@given(
+    values=strat.fixed_dictionaries(
+        {},
+        optional={
+            "to": _xml_text | strat.none(),
+            "from_": _xml_text,
+            "id": _xml_text,
+            "body": _xml_text | strat.none(),
+            "lang": _xml_text,
+        },
+    )
+)
+def test_stanza_template(values):
+    elem = etree.fromstring(
+        "<message type='chat' id='x'><body/><thread>50% off</thread>"
+        "<html xmlns='http://jabber.org/protocol/xhtml-im'><p>hi</p></html>"
+        "</message>"
+    )
+    slots = dict(
+        template.STANZA_SLOTS,
+        body=("body", None),
+        lang=("body", "{http://www.w3.org/XML/1998/namespace}lang"),
+    )
+    tmpl = StanzaTemplate(elem, slots)
+    rendered = tmpl.render(**values)
+    expected = etree.tostring(_filled(tmpl, elem, values))
+    assert rendered == expected
+    assert element_eq(etree.fromstring(rendered), etree.fromstring(expected))
+
+
+def test_stanza_templates():
+    values = {
+        "to": "athos@musketeers.lit",
+        "from_": "d'artagnan@musketeers.lit/\u00e9p\u00e9e",
+        "id": 'a&b<"c">\n',
+        "type": "unavailable",
+        "body": "1 < 2 & ]]> \r\n",
+        "receipt_id": "m1",
+    }
+    templates = [
+        template.PRESENCE,
+        template.CHAT,
+        template.PING,
+        template.IQ_RESULT,
+        template.RECEIPT,
+    ] + list(template.CHAT_STATES.values())
+    for tmpl in templates:
+        proto = etree.fromstring(tmpl.render())
+        for given_values in ({}, values):
+            given_values = {k: v for k, v in given_values.items() if k in tmpl.slots}
+            rendered = tmpl.render(**given_values)
+            expected = etree.tostring(_filled(tmpl, proto, given_values))
+            assert rendered == expected
+            assert element_eq(etree.fromstring(rendered), etree.fromstring(expected))
+    assert template.PING.render(to="a", id="p1") == (
+        b'<iq type="get" to="a" id="p1"><ping xmlns="urn:xmpp:ping"/></iq>'
+    )
+    # text slots on elements with children, and escaping of the text slot
+    elem = etree.fromstring("<message><body><b/></body></message>")
+    tmpl = StanzaTemplate(elem, {"body": ("body", None)})
+    assert tmpl.render() == etree.tostring(elem)
+    assert tmpl.render(body="&") == b"<message><body>&amp;<b/></body></message>"
+    with pytest.raises(ValueError, match="XML compatible"):
+        template.CHAT.render(body="\x00")
+    with pytest.raises(ValueError, match="XML compatible"):
+        template.CHAT.render(to="\x1b")
+    with pytest.raises(ValueError, match="slot"):
+        StanzaTemplate(elem, {"x": ("missing", None)})
+
+
+def test_xmlstream_compression():
+    # client <-> relay <-> server, the relay counting the bytes on the wire
+    client_sock, relay_client = socket.socketpair()
+    relay_server, server_sock = socket.socketpair()
+    wire = []
+
+    def relay(src, dst):
+        while True:
+            data = src.recv(2 ** 16)
+            if not data:
+                dst.close()
+                return
+            if src is relay_client:
+                wire.append(len(data))
+            dst.sendall(data)
+
+    relays = [
+        gevent.spawn(relay, relay_client, relay_server),
+        gevent.spawn(relay, relay_server, relay_client),
+    ]
+    try:
+        client, server = XMLStream(), XMLStream()
+        client.sock, server.sock = client_sock, server_sock
+        header = b"<stream:stream xmlns='jabber:client' xmlns:stream='s'>"
+        client.send(header)
+        client.send(template.COMPRESS.render())
+        assert server.run(once=True).tag == "{%s}compress" % template.NS_COMPRESS
+        server.send(header)
+        server.send(template.COMPRESSED.render())
+        server.compress(level=9)
+        assert client.run(once=True).tag == "{%s}compressed" % template.NS_COMPRESS
+        client.compress(flush_mode=zlib.Z_FULL_FLUSH)
+        assert client.compressed and server.compressed
+        with pytest.raises(RuntimeError):
+            client.compress()
+        gevent.sleep(0.01)
+        del wire[:]
+
+        client.reset()
+        server.reset()
+        client.send(header)
+        body = "All for one, one for all! " * 1000
+        client.send(template.CHAT.render(body=body))
+        client.flush()
+        elem = server.run(once=True)
+        assert elem.find("{jabber:client}body").text == body
+        assert 0 < sum(wire) < len(body) // 20
+        server.send(header)
+        for i in range(10):
+            server.send(template.PING.render(id=str(i)))
+        for i in range(10):
+            assert client.run(once=True).get("id") == str(i)
+
+        # corrupt compressed data is a stream error
+        server_sock.sendall(b"garbage")
+        with pytest.raises(zlib.error):
+            client.run(once=True)
+    finally:
+        gevent.killall(relays)
+    with pytest.raises(ValueError):
+        XMLStream().compress(flush_mode=zlib.Z_NO_FLUSH)
+
+
+def test_ring_buffer():
+    buf = RingBuffer(3)
+    with pytest.raises(ValueError):
+        RingBuffer(0)
+    for i in range(3):
+        buf.append(i)
+    assert buf.full() and list(buf) == [0, 1, 2]
+    with pytest.raises(OverflowError):
+        buf.append(3)
+    buf.drop(2)
+    buf.append(3)
+    buf.append(4)
+    assert list(buf) == [2, 3, 4] and len(buf) == 3
+    with pytest.raises(ValueError):
+        buf.drop(4)
+    buf.drop(1)
+    assert list(buf) == [3, 4]
+    buf.clear()
+    assert not buf and list(buf) == [] and buf.capacity == 3
+
+
+SM_HEADER = (
+    b"<stream:stream xmlns='jabber:client' "
+    b"xmlns:stream='http://etherx.jabber.org/streams'>"
+)
+
+
+def _sm(xml):
+    return "<{} xmlns='urn:xmpp:sm:3'/>".format(xml).encode()
+
+
+class FakeServer:
+    # the server end of a client stream, which can drop the connection
+    def __init__(self):
+        self.stream = None
+
+    def connect(self):
+        client_sock, server_sock = socket.socketpair()
+        self.stream = XMLStream()
+        self.stream.sock = server_sock
+        self.send(SM_HEADER)
+        return client_sock
+
+    def send(self, data):
+        self.stream.send(data)
+        self.stream.flush()
+
+    def recv(self):
+        elem = self.stream.run(once=True, timeout=1)
+        return etree.QName(elem).localname, elem
+
+    def drop(self):
+        self.stream.sock.close()
+
+
+def test_stream_management():
+    server = FakeServer()
+    client = ManagedXMLStream(ack_every=3, ack_interval=0.05)
+    client.sock = server.connect()
+    client.send(SM_HEADER)
+    client.enable(max_resume=60)
+    client.flush()
+    name, elem = server.recv()
+    assert name == "enable" and elem.get("resume") == "true"
+    assert elem.get("max") == "60"
+    server.send(_sm("enabled id='s1' resume='true' max='60'"))
+    assert etree.QName(client.run(once=True)).localname == "enabled"
+    assert (client.sm_id, client.sm_max) == ("s1", 60)
+
+    # an ack is requested after every third stanza, or once ack_interval
+    # has passed
+    for i in range(5):
+        client.send(template.CHAT.render(id=str(i), body="En garde!"))
+    client.send(b"<stream:features/>")
+    names = [server.recv()[0] for _ in range(8)]
+    assert names == ["message"] * 3 + ["r"] + ["message"] * 2 + ["features", "r"]
+    assert (client.outbound, len(client.unacked)) == (5, 5)
+
+    server.send(_sm("a h='2'") + template.PING.render(id="p1"))
+    assert client.run(once=True).get("id") == "p1"
+    assert [etree.fromstring(s).get("id") for s in client.unacked] == ["2", "3", "4"]
+    # answered once the data it came in is parsed, counting the ping after it
+    server.send(_sm("r") + template.PING.render(id="p2"))
+    assert client.run(once=True).get("id") == "p2"
+    assert server.recv()[1].get("h") == "2"
+    assert client.inbound == 2
+
+    # resuming on a new connection sends what the server did not get again
+    server.drop()
+    assert client.run(once=True) is None
+    client.sock = server.connect()
+    client.send(SM_HEADER)
+    client.resume()
+    client.flush()
+    name, elem = server.recv()
+    assert name == "resume" and (elem.get("previd"), elem.get("h")) == ("s1", "2")
+    server.send(_sm("resumed previd='s1' h='3'"))
+    assert etree.QName(client.run(once=True)).localname == "resumed"
+    assert [server.recv()[1].get("id") for _ in range(2)] == ["3", "4"]
+    assert server.recv()[0] == "r"
+    assert (client.outbound, len(client.unacked)) == (5, 2)
+
+    # acking stanzas that were never sent is a stream error
+    server.send(_sm("a h='10'"))
+    with pytest.raises(StreamManagementError):
+        client.run(once=True)
+
+
+@pytest.mark.parametrize("ack", ["a", "a h='x'", "a h='-1'", "a h='4294967296'"])
+def test_stream_management_invalid_ack(ack):
+    server = FakeServer()
+    client = ManagedXMLStream()
+    client.sock = server.connect()
+    client.send(SM_HEADER)
+    client.enable(resume=False)
+    server.send(_sm("enabled"))
+    client.run(once=True)
+    server.send(_sm(ack))
+    with pytest.raises(StreamManagementError):
+        client.run(once=True)
+
+
+def test_stream_management_invalid_resume():
+    server = FakeServer()
+    client = ManagedXMLStream()
+    client.sock = server.connect()
+    client.send(SM_HEADER)
+    client.enable()
+    server.send(_sm("enabled id='s1' resume='true'"))
+    client.run(once=True)
+    client.send(template.CHAT.render(id="1", body="En garde!"))
+    server.recv()
+    server.drop()
+    assert client.run(once=True) is None
+    client.sock = server.connect()
+    client.send(SM_HEADER)
+    client.resume()
+    assert server.recv()[0] == "resume"
+    server.send(_sm("resumed previd='s1' h='2'"))
+    with pytest.raises(StreamManagementError):
+        client.run(once=True)
+    # nothing was sent again after the error
+    server.send(b"</stream:stream>")
+    with pytest.raises(gevent.Timeout):
+        server.recv()
+
+
+def test_stream_management_backpressure():
+    server = FakeServer()
+    client = ManagedXMLStream(buffer_size=2, ack_every=10, ack_interval=10)
+    client.sock = server.connect()
+    client.send(SM_HEADER)
+    client.enable(resume=False)
+    server.send(_sm("enabled"))
+    assert client.run(once=True) is not None and client.sm_id is None
+    reader = gevent.spawn(client.run)
+    for i in range(2):
+        client.send(template.PING.render(id=str(i)))
+    sender = gevent.spawn(client.send, template.PING.render(id="2"))
+    gevent.sleep(0.01)
+    assert not sender.ready() and len(client.unacked) == 2
+    names = [server.recv()[0] for _ in range(4)]
+    assert names == ["enable", "iq", "iq", "r"]
+    server.send(_sm("a h='1'"))
+    sender.get(timeout=1)
+    assert [etree.fromstring(s).get("id") for s in client.unacked] == ["1", "2"]
+
+    # a failed session keeps what was not acked for the caller to send
+    server.send(_sm("failed h='2'"))
+    gevent.sleep(0.01)
+    assert not client.sm_enabled and list(client.unacked) == [
+        template.PING.render(id="2")
+    ]
+    reader.kill()